@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# Benchmark of the bulk CSV parser used by the FeatureVector and Time series
+# data loaders against the row-by-row csv.reader parser they used before. See
+# copyright notice at the end.
+#
+# Usage:
+#   python benchmarks/bench_csv_loader.py --rows 1000000 --cols 20
+
+import os
+import csv
+import time
+import tempfile
+import numpy as np
+import dora_exp_pipeline.dora_data_loader as dora_data_loader
+from dora_exp_pipeline.dora_data_loader import read_csv_matrix
+
+
+# The parser used by FeatureVectorLoader before the bulk parse path was added
+def read_csv_rows(file_path):
+    ids = []
+    data = []
+    with open(file_path, 'r') as csv_file:
+        csv_reader = csv.reader(csv_file)
+        for row in csv_reader:
+            ids.append(row[0])
+            data.append(np.array([float(v) for v in row[1:]]))
+
+    return ids, np.array(data)
+
+
+def make_csv(file_path, n_rows, n_cols, seed):
+    random_state = np.random.RandomState(seed)
+    data = random_state.normal(size=(n_rows, n_cols))
+    ids = np.arange(n_rows).reshape(-1, 1)
+    np.savetxt(file_path, np.hstack((ids, data)), delimiter=',',
+               fmt=['%d'] + ['%.17g'] * n_cols)
+
+
+def time_it(func, repeat):
+    elapsed = []
+    for _ in range(repeat):
+        t_start = time.perf_counter()
+        func()
+        elapsed.append(time.perf_counter() - t_start)
+
+    return min(elapsed)
+
+
+def main(rows, cols, repeat, seed):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        file_path = os.path.join(tmp_dir, 'bench.csv')
+        make_csv(file_path, rows, cols, seed)
+        print(f'{rows} rows x {cols} columns '
+              f'({os.path.getsize(file_path) / 1e6:.1f} MB)')
+
+        parsers = [('csv.reader (row by row)',
+                    lambda: read_csv_rows(file_path))]
+
+        pa_csv = dora_data_loader.pa_csv
+        dora_data_loader.pa_csv = None
+        parsers.append(('pandas C parser (float32)',
+                        lambda: read_csv_matrix(file_path, 'float32')))
+        parsers.append(('pandas C parser (float64)',
+                        lambda: read_csv_matrix(file_path, 'float64')))
+        dora_data_loader.pa_csv = pa_csv
+
+        for name, func in parsers:
+            print(f'{name:<30}: {time_it(func, repeat):8.3f} s')
+
+        if pa_csv is not None:
+            elapsed = time_it(lambda: read_csv_matrix(file_path, 'float32'),
+                              repeat)
+            print(f'{"pyarrow (float32)":<30}: {elapsed:8.3f} s')
+        else:
+            print('pyarrow is not installed')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the bulk CSV '
+                                                 'parser of the data loaders')
+    parser.add_argument('--rows', type=int, default=200000,
+                        help='Number of rows in the CSV file')
+    parser.add_argument('--cols', type=int, default=20,
+                        help='Number of value columns in the CSV file')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of repetitions; the best time is '
+                             'reported')
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='Seed for the random values in the CSV file')
+
+    args = parser.parse_args()
+    main(**vars(args))
+
+
+# Copyright (c) 2021 California Institute of Technology ("Caltech").
+# U.S. Government sponsorship acknowledged.
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of Caltech nor its operating division, the Jet Propulsion
+#   Laboratory, nor the names of its contributors may be used to endorse or
+#   promote products derived from this software without specific prior written
+#   permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
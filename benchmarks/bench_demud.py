@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+# Benchmark of the time DEMUD takes to rank all the items of a data set, for
+# data sets of increasing size, against the selection loop it used before,
+# which removed each selected item from the data with a copy. With
+# --batch_sizes, the rankings of batch selection are also compared to the
+# ranking of batch_size = 1, by the fraction of the top 1% and top 10% items
+# they have in common. See copyright notice at the end.
+#
+# The copying loop is quadratic in memory traffic, so it is only timed for
+# data sets of up to --copy_max_items items.
+#
+# Usage:
+#   python benchmarks/bench_demud.py --items 10000 20000 100000 --dims 10
+#   python benchmarks/bench_demud.py --items 100000 --batch_sizes 10 100 \
+#       --skip_copy
+
+import time
+import numpy as np
+from dora_exp_pipeline.demud_outlier_detection import DEMUDOutlierDetection
+
+
+# The selection loop of DEMUDOutlierDetection.demud() before the selected
+# items were swapped out of the data instead of being removed from it with a
+# copy
+def demud_copy(data, initdata, k, nsel, update='full'):
+    scores = []
+    sels = []
+
+    X = data
+    U, S, mu, n = DEMUDOutlierDetection.update_model(initdata, [], [], k,
+                                                     n=0, mu=[])
+    orig_ind = np.arange(X.shape[1])
+    seen = initdata
+    for i in range(nsel):
+        ind, _, score, _ = DEMUDOutlierDetection.select_next(X, U, mu)
+        sels.append(orig_ind[ind])
+        scores.append(score)
+
+        x = X[:, ind].reshape(-1, 1)
+        if update == 'incremental':
+            U, S, mu, n = DEMUDOutlierDetection.update_model_incremental(
+                x, U, S, k, n, mu)
+        else:
+            seen = np.hstack((seen, x))
+            U, S, mu, n = DEMUDOutlierDetection.update_model(seen, U, S, k,
+                                                             n, mu)
+
+        keep = list(range(X.shape[1]))
+        keep.remove(ind)
+        X = X[:, keep]
+        orig_ind = orig_ind[keep]
+
+    return scores, sels
+
+
+def time_it(func):
+    t_start = time.perf_counter()
+    ret = func()
+
+    return time.perf_counter() - t_start, ret
+
+
+# Fraction of the top `fraction` items of ranking `sels` that are also in
+# the top `fraction` items of ranking `correct_sels`
+def top_overlap(sels, correct_sels, fraction):
+    n_top = max(1, int(len(correct_sels) * fraction))
+
+    return len(set(sels[:n_top]) & set(correct_sels[:n_top])) / n_top
+
+
+def main(items, dims, init_items, k, update, batch_sizes, seed, skip_copy,
+         copy_max_items):
+    random_state = np.random.RandomState(seed)
+    initdata = random_state.normal(size=(dims, init_items))
+
+    print(f'{dims} dimensions, {init_items} initdata items, k = {k}, '
+          f'update = {update}')
+    for n_items in items:
+        data = random_state.normal(size=(dims, n_items))
+
+        elapsed, (scores, sels) = time_it(
+            lambda: DEMUDOutlierDetection.demud(data, initdata, k, n_items,
+                                                update=update))
+        print(f'{n_items:>8} items: {elapsed:8.2f} s', end='')
+
+        if not skip_copy and n_items <= copy_max_items:
+            copy_elapsed, (copy_scores, copy_sels) = time_it(
+                lambda: demud_copy(data, initdata, k, n_items, update))
+            assert copy_sels == sels
+            print(f'   column copies: {copy_elapsed:8.2f} s', end='')
+        print()
+
+        for batch_size in batch_sizes:
+            batch_elapsed, (_, batch_sels) = time_it(
+                lambda: DEMUDOutlierDetection.demud(
+                    data, initdata, k, n_items, update=update,
+                    batch_size=batch_size))
+            print(f'{"batch_size " + str(batch_size):>20}: '
+                  f'{batch_elapsed:8.2f} s   top 1% overlap: '
+                  f'{top_overlap(batch_sels, sels, 0.01):4.0%}   '
+                  f'top 10% overlap: {top_overlap(batch_sels, sels, 0.1):4.0%}')
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Benchmark the time DEMUD '
+                                                 'takes to rank all the items '
+                                                 'of a data set')
+    parser.add_argument('--items', type=int, nargs='+',
+                        default=[10000, 20000, 100000],
+                        help='Numbers of items in the data sets to rank')
+    parser.add_argument('--dims', type=int, default=10,
+                        help='Number of dimensions of the items')
+    parser.add_argument('--init_items', type=int, default=100,
+                        help='Number of items in initdata')
+    parser.add_argument('--k', type=int, default=3,
+                        help='Number of principal components')
+    parser.add_argument('--update', choices=['full', 'incremental'],
+                        default='incremental',
+                        help='DEMUD model update method')
+    parser.add_argument('--batch_sizes', type=int, nargs='*', default=[],
+                        help='DEMUD batch sizes to compare to batch_size = 1')
+    parser.add_argument('--seed', type=int, default=1234,
+                        help='Seed for the random data sets')
+    parser.add_argument('--skip_copy', action='store_true',
+                        help='Only time the current selection loop')
+    parser.add_argument('--copy_max_items', type=int, default=20000,
+                        help='Largest data set to time the copying selection '
+                             'loop on')
+
+    args = parser.parse_args()
+    main(**vars(args))
+
+
+# Copyright (c) 2021 California Institute of Technology ("Caltech").
+# U.S. Government sponsorship acknowledged.
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of Caltech nor its operating division, the Jet Propulsion
+#   Laboratory, nor the names of its contributors may be used to endorse or
+#   promote products derived from this software without specific prior written
+#   permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
@@ -8,7 +8,23 @@
 
 import numpy as np
 from tqdm import tqdm
+from scipy.sparse.linalg import svds
 from dora_exp_pipeline.outlier_detection import OutlierDetection
+from dora_exp_pipeline.outlier_detection import select_results
+
+
+# Methods to update the DEMUD model after each selection: 'full' fits a new
+# SVD to all the items seen so far, and 'incremental' adds the selected item
+# to the current SVD (see update_model_incremental()).
+UPDATE_METHODS = ['full', 'incremental']
+
+# SVD solvers of the DEMUD model: 'full' computes all the singular vectors
+# with LAPACK and keeps the first k, 'arpack' only computes the first k with
+# the Lanczos method of ARPACK, and 'auto' uses 'arpack' for matrices with
+# min(d, n) >= AUTO_SVD_MIN_SIZE and k <= min(d, n) / AUTO_SVD_MIN_RATIO.
+SVD_SOLVERS = ['auto', 'full', 'arpack']
+AUTO_SVD_MIN_SIZE = 500
+AUTO_SVD_MIN_RATIO = 10
 
 
 class DEMUDOutlierDetection(OutlierDetection):
@@ -16,7 +32,8 @@ class DEMUDOutlierDetection(OutlierDetection):
         super(DEMUDOutlierDetection, self).__init__('demud')
 
     def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
-                       top_n, seed, k):
+                       top_n, seed, k, update='full', batch_size=1,
+                       batch_similarity=0.9, svd_solver='auto', svd_tol=0):
         """
         >>> data_to_score = np.array([[1,2,3],[4,5,6],[7,8,9]])
         >>> data_to_fit = np.array([[0,7,2],[3,9,3],[4,7,4]])
@@ -82,29 +99,42 @@ class DEMUDOutlierDetection(OutlierDetection):
             data_to_fit = np.array(())
 
         # Note: DEMUD expects data in d x n order
-        scores, sel_ind = DEMUDOutlierDetection.demud(data=data_to_score.T,
-                                                      initdata=data_to_fit.T,
-                                                      k=k, nsel=top_n)
+        scores, sel_ind = DEMUDOutlierDetection.demud(
+            data=data_to_score.T, initdata=data_to_fit.T, k=k, nsel=top_n,
+            update=update, batch_size=batch_size,
+            batch_similarity=batch_similarity, svd_solver=svd_solver,
+            svd_tol=svd_tol)
 
-        dts_ids = list()
-        for ind in sel_ind:
-            dts_ids.append(data_to_score_ids[ind])
-
-        return {
-            'scores': scores,
-            'sel_ind': sel_ind,
-            'dts_ids': dts_ids
-        }
+        return select_results(scores, sel_ind, data_to_score_ids)
 
     # Simplified DEMUD algorithm:
     # Specify data as numpy array (d x n), initdata (d x n2) can be [],
     # k >= 1, nsel = number of items in 'data' to rank.
+    # update = 'full' to fit a new SVD to initdata and all the selected items
+    # after each selection, or 'incremental' to add the selected item to the
+    # current SVD, which only costs O(d * k^2) per selection.
+    # batch_size = number of items selected with the same model before it is
+    # updated with all of them (see select_batch()). A batch doesn't take
+    # items whose residuals have a cosine similarity above batch_similarity
+    # with the residual of an item already in the batch. Batches trade
+    # ranking fidelity for speed: the model is updated nsel / batch_size
+    # times instead of nsel times, but within a batch, the items are ranked
+    # by a model that doesn't know about the items selected before them, so
+    # the ranking drifts from the ranking of batch_size = 1 (the DEMUD
+    # algorithm), mostly for near-duplicates that the similarity guard
+    # doesn't catch. Use batch_size = 1 when the order of the top items
+    # matters, and batches for the full ranking of large data sets.
+    # svd_solver = one of SVD_SOLVERS, to fit the SVD of initdata (or data)
+    # and of the selected items (see update_model()).
+    # svd_tol = relative accuracy of the singular values computed by
+    # 'arpack' (0 for machine precision).
     # Note: does not support other initialization methods.
     # Returns a dictionary with:
     #   'sels' (data indices in descending score order)
     #   'scores' (score for each data item in original order)
     @classmethod
-    def demud(cls, data, initdata, k, nsel):
+    def demud(cls, data, initdata, k, nsel, update='full', batch_size=1,
+              batch_similarity=0.9, svd_solver='auto', svd_tol=0):
         """
         >>> data = np.array([[0, 0], [-1, 1]]).T
         >>> demud_res = DEMUDOutlierDetection.demud(data, np.array([]), \
@@ -121,6 +151,23 @@ class DEMUDOutlierDetection(OutlierDetection):
         [1, 0]
         >>> demud_res[0]
         [2.0, 0.2222222222222222]
+
+        Incremental model updates select the same items
+        >>> demud_res = DEMUDOutlierDetection.demud(data, initdata, k=1, \
+                                                    nsel=2, \
+                                                    update='incremental')
+        >>> demud_res[1]
+        [1, 0]
+        >>> np.allclose(demud_res[0], [2.0, 0.2222222222222222])
+        True
+
+        A batch of two items is selected with the same model
+        >>> demud_res = DEMUDOutlierDetection.demud(data, initdata, k=1, \
+                                                    nsel=2, batch_size=2)
+        >>> demud_res[1]
+        [1, 0]
+        >>> demud_res[0]
+        [2.0, 0.0]
         """
 
         # Check arguments
@@ -128,6 +175,24 @@ class DEMUDOutlierDetection(OutlierDetection):
             raise RuntimeError('The number of principal components (k) must '
                                'be >= 1')
 
+        if update not in UPDATE_METHODS:
+            raise RuntimeError(f'The DEMUD model update method must be one '
+                               f'of {UPDATE_METHODS}')
+
+        if batch_size < 1:
+            raise RuntimeError('The DEMUD batch size must be >= 1')
+
+        if batch_similarity <= 0 or batch_similarity > 1:
+            raise RuntimeError('The DEMUD batch similarity must be in '
+                               '(0, 1]')
+
+        if svd_solver not in SVD_SOLVERS:
+            raise RuntimeError(f'The DEMUD SVD solver must be one of '
+                               f'{SVD_SOLVERS}')
+
+        if svd_tol < 0:
+            raise RuntimeError('The DEMUD SVD tolerance must be >= 0')
+
         res = {}
         res['sels'] = []
         res['scores'] = []
@@ -142,51 +207,104 @@ class DEMUDOutlierDetection(OutlierDetection):
         # If initial data set is provided, use it to initialize the model
         if len(initdata) > 0:
             U, S, mu, n = DEMUDOutlierDetection.update_model(
-                initdata, U, S, k, n=0, mu=[])
+                initdata, U, S, k, n=0, mu=[], svd_solver=svd_solver,
+                svd_tol=svd_tol)
         else:
             # Otherwise do full SVD on data
             U, S, mu, n = DEMUDOutlierDetection.update_model(
-                X, U, S, k, n=0, mu=[])
-
-        # Iterative ranking and selection
+                X, U, S, k, n=0, mu=[], svd_solver=svd_solver,
+                svd_tol=svd_tol)
+
+        # Iterative ranking and selection. The items that are not selected
+        # yet are kept in the first n_remaining columns of a copy of X: a
+        # selected item is swapped with the last remaining item, rather than
+        # removed from X with a copy of all the other items. The copy keeps the
+        # memory layout of X, which the scores are computed in.
         n_items = X.shape[1]
+        X = np.array(X, order='K')
         orig_ind = np.arange(n_items)
+        n_remaining = n_items
         seen = initdata
-        for i in tqdm(range(nsel), desc='DEMUD'):
-            # Select item with largest reconstruction error
-            ind, _, score, _ = DEMUDOutlierDetection.select_next(X, U, mu)
-            res['sels'] += [orig_ind[ind]]
-            res['scores'] += [score]
-
-            # Update model with new selection
-            x = X[:, ind]
-            if len(seen) == 0:
-                seen = x.reshape(-1, 1)
-            else:
-                seen = np.hstack((seen, x.reshape(-1, 1)))
-            U, S, mu, n = DEMUDOutlierDetection.update_model(
-                seen, U, S, k, n, mu)
 
-            # Remove this item from X
-            keep = list(range(X.shape[1]))
-            keep.remove(ind)
-            X = X[:, keep]
-            orig_ind = orig_ind[keep]
+        # Squared norms of the items, which are used to compute the scores
+        # from the projections of the items (see residual_scores())
+        sq_norms = np.einsum('ij,ij->j', X, X).astype(np.float64)
+        progress_bar = tqdm(total=nsel, desc='DEMUD')
+        while len(res['sels']) < nsel:
+            if batch_size == 1:
+                # Select item with largest reconstruction error. Ties are
+                # broken by the original order of the items.
+                ind, _, score, scores = DEMUDOutlierDetection.select_next(
+                    X[:, :n_remaining], U, mu, sq_norms[:n_remaining])
+                ties = np.flatnonzero(scores == score)
+                if len(ties) > 1:
+                    ind = ties[np.argmin(orig_ind[ties])]
+                batch = np.array([ind])
+                batch_scores = [score]
+            else:
+                # Select the items with largest reconstruction errors
+                batch, batch_scores = DEMUDOutlierDetection.select_batch(
+                    X[:, :n_remaining], U, mu, sq_norms[:n_remaining],
+                    min(batch_size, nsel - len(res['sels'])),
+                    batch_similarity, orig_ind[:n_remaining])
+            res['sels'] += list(orig_ind[batch])
+            res['scores'] += list(batch_scores)
+
+            # Update model with new selections. The model of the whole data
+            # set (if there is no initdata) is replaced by a model of the
+            # first selections, rather than updated with them.
+            x = X[:, batch]
+            if update == 'incremental' and len(seen) > 0:
+                U, S, mu, n = DEMUDOutlierDetection.update_model_incremental(
+                    x, U, S, k, n, mu)
+            else:
+                if len(seen) == 0:
+                    seen = x
+                else:
+                    seen = np.hstack((seen, x))
+                U, S, mu, n = DEMUDOutlierDetection.update_model(
+                    seen, U, S, k, n, mu, svd_solver=svd_solver,
+                    svd_tol=svd_tol)
+
+            # Remove these items from X, from the last one, so that the
+            # swaps don't move the other items of the batch
+            for ind in np.sort(batch)[::-1]:
+                last = n_remaining - 1
+                X[:, [ind, last]] = X[:, [last, ind]]
+                orig_ind[[ind, last]] = orig_ind[[last, ind]]
+                sq_norms[[ind, last]] = sq_norms[[last, ind]]
+                n_remaining -= 1
+            progress_bar.update(len(batch))
+        progress_bar.close()
 
         # return res
         return res['scores'], res['sels']
 
     @classmethod
-    def update_model(cls, X, U, S, k, n, mu):
-        """update_model(X, U, S, k, n, mu):
+    def update_model(cls, X, U, S, k, n, mu, svd_solver='auto', svd_tol=0):
+        """update_model(X, U, S, k, n, mu, svd_solver='auto', svd_tol=0):
 
         Update SVD model U, S (dimensionality k)
         by either adding items in X to it,
         or regenerating a new model from X,
         assuming U already models n items with mean mu.
         Technically we should have V as well, but it's not needed.
+        The SVD is computed with svd_solver (one of SVD_SOLVERS);
+        'arpack' only computes the first k components, to relative
+        accuracy svd_tol (0 for machine precision).
 
         Return new U, S, mu, n.
+
+        >>> rng = np.random.RandomState(0)
+        >>> X = rng.normal(size=(30, 40))
+        >>> U, S, mu, n = DEMUDOutlierDetection.update_model(\
+                X, [], [], k=3, n=0, mu=[], svd_solver='full')
+        >>> U2, S2, mu2, n2 = DEMUDOutlierDetection.update_model(\
+                X, [], [], k=3, n=0, mu=[], svd_solver='arpack')
+        >>> np.allclose(S, S2)
+        True
+        >>> np.allclose(np.abs(np.sum(U * U2, axis=0)), 1)
+        True
         """
 
         # Check arguments
@@ -205,10 +323,28 @@ class DEMUDOutlierDetection(OutlierDetection):
             n = 1
             return U, S, mu, n
 
-        # Do a full SVD of mean-subtracted X
+        # Do an SVD of mean-subtracted X. ARPACK needs k < min(d, n), and a
+        # full SVD is as fast for small matrices.
         mu = np.mean(X, axis=1).reshape(-1, 1)
         X = X - mu
-        U, S, _ = np.linalg.svd(X, full_matrices=False)
+        min_size = min(X.shape)
+        if svd_solver == 'auto':
+            if (min_size >= AUTO_SVD_MIN_SIZE and
+                    k <= min_size / AUTO_SVD_MIN_RATIO):
+                svd_solver = 'arpack'
+            else:
+                svd_solver = 'full'
+
+        if svd_solver == 'arpack' and k < min_size:
+            # Fixed starting vector, so that the model is deterministic.
+            # svds() doesn't sort the singular values in descending order.
+            v0 = np.random.RandomState(0).uniform(-1, 1, min_size)
+            U, S, _ = svds(X, k=k, tol=svd_tol, v0=v0)
+            order = np.argsort(S)[::-1]
+            U = U[:, order]
+            S = S[order]
+        else:
+            U, S, _ = np.linalg.svd(X, full_matrices=False)
 
         # Update n to number of new items in X
         n = X.shape[1]
@@ -220,15 +356,87 @@ class DEMUDOutlierDetection(OutlierDetection):
         return U, S, mu, n
 
     @classmethod
-    def select_next(cls, X, U, mu):
-        """select_next(X, U, mu)
+    def update_model_incremental(cls, X, U, S, k, n, mu):
+        """update_model_incremental(X, U, S, k, n, mu):
+
+        Update SVD model U, S (dimensionality k) of n items with mean mu
+        by adding the items in X to it, with the mean-corrected incremental
+        SVD of Ross et al. (2008) used by DEMUD.
+        Only the SVD of a small (k + n_new + 1) x (k + n_new + 1) matrix
+        is computed, instead of the SVD of all the items seen so far.
+
+        Return new U, S, mu, n.
+
+        >>> rng = np.random.RandomState(0)
+        >>> X = rng.normal(size=(5, 8))
+        >>> U, S, mu, n = DEMUDOutlierDetection.update_model(\
+                X[:, :6], [], [], k=5, n=0, mu=[])
+        >>> U, S, mu, n = DEMUDOutlierDetection.update_model_incremental(\
+                X[:, 6:], U, S, k=5, n=n, mu=mu)
+        >>> U2, S2, mu2, n2 = DEMUDOutlierDetection.update_model(\
+                X, [], [], k=5, n=0, mu=[])
+        >>> np.allclose(S, S2), np.allclose(mu, mu2), n == n2
+        (True, True, True)
+        >>> np.allclose(np.abs(np.dot(U.T, U2)), np.eye(5))
+        True
+        """
+
+        # Mean of the new items, and the mean of all the items
+        n_new = X.shape[1]
+        mu_new = np.mean(X, axis=1).reshape(-1, 1)
+        n_total = n + n_new
+        mu_total = (n * mu + n_new * mu_new) / n_total
+
+        # Mean-subtracted new items, plus a column that corrects for the
+        # shift of the mean
+        X_hat = np.hstack((X - mu_new,
+                           np.sqrt(n * n_new / n_total) * (mu_new - mu)))
+
+        # Split the new items into their projection onto U and an orthogonal
+        # residual
+        proj = np.dot(U.T, X_hat)
+        Q, R = np.linalg.qr(X_hat - np.dot(U, proj))
+
+        # SVD of the small matrix [[diag(S), proj], [0, R]]
+        n_comp = len(S)
+        R_full = np.zeros((n_comp + R.shape[0], n_comp + X_hat.shape[1]))
+        R_full[:n_comp, :n_comp] = np.diag(S)
+        R_full[:n_comp, n_comp:] = proj
+        R_full[n_comp:, n_comp:] = R
+        U_small, S, _ = np.linalg.svd(R_full, full_matrices=False)
+
+        # Rotate the extended basis [U, Q], and keep only the first k
+        # components
+        U = np.dot(np.hstack((U, Q)), U_small[:, 0:k])
+        S = S[0:k]
+
+        return U, S, mu_total, n_total
+
+    @classmethod
+    def select_next(cls, X, U, mu, sq_norms=None):
+        """select_next(X, U, mu, sq_norms=None)
 
         Select the next most-interesting (max recon. error) item in X,
         given model U, singular values S,
         and mean mu for uninteresting items.
+        If the squared norms of the items in X are given,
+        the scores are computed without reconstructing the items
+        (see residual_scores()), and only the items whose score is close to
+        the max score are reconstructed to select the item.
 
         Return the index of the selected item, its reconstruction,
         its reconstruction score, and all items' reconstruction scores.
+
+        >>> rng = np.random.RandomState(0)
+        >>> X = rng.normal(size=(6, 50))
+        >>> U, S, mu, n = DEMUDOutlierDetection.update_model(\
+                X[:, :10], [], [], k=2, n=0, mu=[])
+        >>> m, _, score, scores = DEMUDOutlierDetection.select_next(X, U, mu)
+        >>> sq_norms = np.sum(X ** 2, axis=0)
+        >>> m2, _, score2, scores2 = DEMUDOutlierDetection.select_next(\
+                X, U, mu, sq_norms)
+        >>> m == m2, score == score2, np.allclose(scores, scores2)
+        (True, True, True)
         """
 
         # Check arguments
@@ -244,6 +452,22 @@ class DEMUDOutlierDetection(OutlierDetection):
             print('Mismatch in dimensions; must have X mxn, U mxk, mu mx1.')
             return None, None, -1, []
 
+        if sq_norms is not None:
+            scores, tol = DEMUDOutlierDetection.residual_scores(X, U, mu,
+                                                                sq_norms)
+
+            # Compute the reconstruction error of the items whose score may
+            # be the max score, given the rounding errors of the scores
+            cand = np.flatnonzero(scores >= scores.max() - tol)
+            (cand_scores, cand_reproj) = DEMUDOutlierDetection.score_items(
+                X[:, cand], U, mu)
+            scores[cand] = cand_scores
+
+            # Select and return item with max reconstruction error
+            c = cand_scores.argmax()
+
+            return cand[c], cand_reproj[:, c], cand_scores[c], scores
+
         # Compute the score and projection for each item
         (scores, reproj) = DEMUDOutlierDetection.score_items(X, U, mu)
 
@@ -252,6 +476,100 @@ class DEMUDOutlierDetection(OutlierDetection):
 
         return m, reproj[:, m], scores[m], scores
 
+    @classmethod
+    def select_batch(cls, X, U, mu, sq_norms, batch_size, batch_similarity,
+                     order):
+        """select_batch(X, U, mu, sq_norms, batch_size, batch_similarity,
+                        order)
+
+        Select up to batch_size most-interesting (max recon. error) items
+        in X with the same model U and mean mu, given the squared norms of
+        the items in X (see residual_scores()).
+        The candidates are the 2 * batch_size items with largest scores, and
+        they are taken in decreasing order of score (ties are broken by
+        order, the original order of the items). A candidate is skipped if
+        the cosine similarity of its residual (the item minus its
+        reconstruction) with the residual of an item already in the batch
+        is above batch_similarity, so that a batch doesn't take all the
+        near-duplicates of an item. The item with max score is always
+        selected.
+
+        Return the indices of the selected items and their reconstruction
+        scores, in order of selection.
+
+        >>> X = np.array([[0., 3., 3.1, 0.], [0., 4., 4., 1.]])
+        >>> U = np.array([[0.], [1.]])
+        >>> mu = np.zeros((2, 1))
+        >>> sq_norms = np.sum(X ** 2, axis=0)
+        >>> sels, scores = DEMUDOutlierDetection.select_batch(\
+                X, U, mu, sq_norms, 2, 0.9, np.arange(4))
+        >>> sels
+        array([2, 0])
+        >>> [round(score, 6) for score in scores]
+        [9.61, 0.0]
+        """
+
+        # Candidates with the largest scores, and the items whose score may
+        # be the max score, given the rounding errors of the scores
+        scores, tol = DEMUDOutlierDetection.residual_scores(X, U, mu,
+                                                            sq_norms)
+        n_cand = min(X.shape[1], 2 * batch_size)
+        cand = np.union1d(np.argpartition(-scores, n_cand - 1)[:n_cand],
+                          np.flatnonzero(scores >= scores.max() - tol))
+
+        # Reconstruction errors and residuals of the candidates
+        (cand_scores, cand_reproj) = DEMUDOutlierDetection.score_items(
+            X[:, cand], U, mu)
+        resid = X[:, cand] - cand_reproj
+        resid_norms = np.linalg.norm(resid, axis=0)
+
+        sel = []
+        for c in np.lexsort((order[cand], -cand_scores)):
+            if len(sel) == batch_size:
+                break
+
+            # Residuals of zero norm are not similar to any residual
+            if len(sel) > 0 and resid_norms[c] > 0:
+                similarity = np.dot(resid[:, sel].T, resid[:, c]) / \
+                    (resid_norms[sel] * resid_norms[c])
+                if np.any(similarity > batch_similarity):
+                    continue
+            sel.append(c)
+
+        return cand[sel], cand_scores[sel]
+
+    @classmethod
+    def residual_scores(cls, X, U, mu, sq_norms):
+        """residual_scores(X, U, mu, sq_norms)
+        Calculate the score (reconstruction error) for every item x in X,
+        with respect to the SVD model in U (orthonormal) and mean mu, as
+        ||x - mu||^2 - ||U^T (x - mu)||^2, from the squared norms ||x||^2
+        of the items in sq_norms and the projection of X onto [U, mu].
+        Unlike score_items(), X is neither reconstructed nor copied, and
+        the cost is that of the projection.
+
+        Return an array of item reconstruction scores, and a bound on the
+        rounding errors of the scores, which are subject to cancellation.
+        """
+
+        # Project all data in X onto U and mu at once
+        proj = np.dot(np.hstack((U, mu)).T, X)
+        mu_proj = proj[-1]
+        proj = proj[:-1] - np.dot(U.T, mu)
+
+        # ||x - mu||^2 = ||x||^2 - 2 mu^T x + ||mu||^2
+        mu_sq_norm = np.dot(mu.ravel(), mu.ravel())
+        scores = sq_norms - 2 * mu_proj + mu_sq_norm
+        scores -= np.einsum('ij,ij->j', proj, proj)
+
+        # The rounding errors of the dot products over the d dimensions are
+        # bounded by d * eps * (||x|| + ||mu||)^2
+        eps = np.finfo(proj.dtype).eps
+        tol = 2 * X.shape[0] * eps * \
+            (np.sqrt(sq_norms.max()) + np.sqrt(mu_sq_norm)) ** 2
+
+        return scores, tol
+
     @classmethod
     def score_items(cls, X, U, mu):
         """score_items(X, U, mu)
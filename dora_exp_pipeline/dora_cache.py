@@ -0,0 +1,287 @@
+# This script provides an on-disk cache for the features extracted from a data
+# source, so that re-running an experiment with different outlier detection or
+# results organization settings doesn't need to load the data and extract
+# features again. See copyright notice at the end.
+#
+# Cache entries are keyed by a hash of the data source (path, and size and
+# modification time of every file), the data loader name and parameters, and
+# the features block and dtype of the config file. Each entry is a
+# sub-directory of the cache directory that contains the feature matrix as a
+# `.npy` file, which is opened with memory mapping, and the item ids as a
+# `.npy` file. When the total size of the cache exceeds the size limit, the
+# least recently used entries are removed.
+#
+# This script also saves the ranking of each outlier detection algorithm
+# (scores, selection indices, and ids) in the algorithm sub-directory, with a
+# manifest of the key of the ranking and the results organization methods
+# that were run on it. Re-running an experiment in which only the results
+# organization settings changed reuses the ranking, and only runs the results
+# organization methods whose parameters changed. The key of a ranking includes
+# a hash of the source code of the pipeline (see get_code_hash()), so rankings
+# saved before the code changed are not reused.
+
+import os
+import sys
+import glob
+import json
+import shutil
+import hashlib
+import numpy as np
+
+
+# Bump this version to invalidate existing cache entries when the format of the
+# cache or the output of the data loaders or feature extractors changes.
+CACHE_VERSION = 2
+
+FEATURES_FILE = 'features.npy'
+IDS_FILE = 'ids.npy'
+RANKING_FILE = 'ranking.npz'
+RANKING_MANIFEST_FILE = 'ranking.json'
+
+
+class FeatureCache(object):
+    def __init__(self, cache_dir: str, max_size_mb=None, logger=None):
+        self.cache_dir = cache_dir
+        self.max_size_mb = max_size_mb
+        self.logger = logger
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+            if self.logger:
+                self.logger.text(f'Created cache directory: '
+                                 f'{os.path.abspath(self.cache_dir)}')
+
+    def get_key(self, data_path: str, data_loader: dict, features: dict,
+                dtype=None) -> str:
+        key_dict = {
+            'version': CACHE_VERSION,
+            'path': os.path.realpath(data_path),
+            'files': get_file_stats(data_path),
+            'data_loader': data_loader,
+            'features': features,
+            'dtype': dtype
+        }
+
+        return get_hash(key_dict)
+
+    # Return the ids and features stored in the cache for `key`, or None if
+    # they are not in the cache. The features are returned as a read-only
+    # memmap.
+    def load(self, key: str):
+        entry_dir = os.path.join(self.cache_dir, key)
+        if not os.path.isdir(entry_dir):
+            return None
+
+        ids = np.load(os.path.join(entry_dir, IDS_FILE), allow_pickle=False)
+        features = np.load(os.path.join(entry_dir, FEATURES_FILE),
+                           mmap_mode='r', allow_pickle=False)
+
+        # Update the modification time of the entry, which is used to find
+        # the least recently used entries.
+        os.utime(entry_dir)
+
+        if self.logger:
+            self.logger.text(f'Loaded features from cache: '
+                             f'{os.path.abspath(entry_dir)}')
+
+        return ids, features
+
+    def save(self, key: str, ids, features) -> None:
+        entry_dir = os.path.join(self.cache_dir, key)
+        if os.path.isdir(entry_dir):
+            return
+
+        # Write the entry to a temporary directory and then rename it, so that
+        # an interrupted run never leaves an incomplete entry in the cache.
+        tmp_dir = os.path.join(self.cache_dir, f'.{key}.{os.getpid()}')
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.mkdir(tmp_dir)
+        np.save(os.path.join(tmp_dir, IDS_FILE), np.asarray(ids),
+                allow_pickle=False)
+        np.save(os.path.join(tmp_dir, FEATURES_FILE), features,
+                allow_pickle=False)
+
+        try:
+            os.rename(tmp_dir, entry_dir)
+        except OSError:
+            # Another process saved the same entry in the meantime
+            shutil.rmtree(tmp_dir)
+
+        if self.logger:
+            self.logger.text(f'Saved features to cache: '
+                             f'{os.path.abspath(entry_dir)}')
+
+        self.evict()
+
+    # Remove the least recently used entries until the total size of the cache
+    # is within the size limit.
+    def evict(self) -> None:
+        if self.max_size_mb is None:
+            return
+
+        entries = []
+        for entry_name in os.listdir(self.cache_dir):
+            entry_dir = os.path.join(self.cache_dir, entry_name)
+            if entry_name.startswith('.') or not os.path.isdir(entry_dir):
+                continue
+
+            entry_size = sum([os.path.getsize(os.path.join(entry_dir, f))
+                              for f in os.listdir(entry_dir)])
+            entries.append((os.path.getmtime(entry_dir), entry_size,
+                            entry_dir))
+
+        total_size = sum([entry[1] for entry in entries])
+        max_size = self.max_size_mb * 1024 * 1024
+        for _, entry_size, entry_dir in sorted(entries):
+            if total_size <= max_size:
+                break
+
+            shutil.rmtree(entry_dir)
+            total_size -= entry_size
+            if self.logger:
+                self.logger.text(f'Removed features from cache: '
+                                 f'{os.path.abspath(entry_dir)}')
+
+
+# Function to get the sha1 hash of a dictionary of JSON serializable values.
+# Values that are not JSON serializable are converted to strings.
+def get_hash(key_dict: dict) -> str:
+    key_string = json.dumps(key_dict, sort_keys=True, default=str)
+
+    return hashlib.sha1(key_string.encode('utf-8')).hexdigest()
+
+
+# Function to get a hash of the contents of the modules of the
+# dora_exp_pipeline package and of the modules named in `module_names` (e.g.,
+# the modules of outlier detection algorithms registered from outside the
+# package). Modules without a source file are skipped.
+def get_code_hash(module_names=()) -> str:
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    file_paths = set(glob.glob(os.path.join(package_dir, '*.py')))
+    for module_name in module_names:
+        module_file = getattr(sys.modules.get(module_name), '__file__', None)
+        if module_file is not None:
+            file_paths.add(os.path.abspath(module_file))
+
+    sha = hashlib.sha1()
+    for file_path in sorted(file_paths):
+        with open(file_path, 'rb') as f:
+            sha.update(f.read())
+
+    return sha.hexdigest()
+
+
+# Function to save the `results` of an outlier detection algorithm (see
+# OutlierDetection.run()) in `sub_dir`, with a manifest of the ranking `key`
+# and of the results organization methods in `done_results` (a dictionary of
+# method name to parameters) that were run on the ranking.
+def save_ranking(sub_dir: str, key: str, results: dict,
+                 done_results: dict) -> None:
+    np.savez(os.path.join(sub_dir, RANKING_FILE),
+             scores=results['scores'], sel_ind=results['sel_ind'],
+             dts_ids=results['dts_ids'])
+    save_ranking_manifest(sub_dir, key, done_results)
+
+
+# Function to save the manifest of a ranking saved with save_ranking(). The
+# manifest is written to a temporary file and then renamed, so that an
+# interrupted run never leaves an incomplete manifest.
+def save_ranking_manifest(sub_dir: str, key: str, done_results: dict) -> None:
+    manifest_file = os.path.join(sub_dir, RANKING_MANIFEST_FILE)
+    tmp_file = f'{manifest_file}.{os.getpid()}'
+    with open(tmp_file, 'w') as f:
+        json.dump({'key': key, 'results': done_results}, f, sort_keys=True,
+                  indent=2, default=str)
+    os.replace(tmp_file, manifest_file)
+
+
+# Function to load the manifest of the ranking saved in `sub_dir`. Returns the
+# dictionary of the results organization methods that were run on the ranking,
+# or None if there is no ranking saved for `key`.
+def load_ranking_manifest(sub_dir: str, key: str):
+    manifest_file = os.path.join(sub_dir, RANKING_MANIFEST_FILE)
+    if not os.path.isfile(manifest_file) or \
+            not os.path.isfile(os.path.join(sub_dir, RANKING_FILE)):
+        return None
+
+    with open(manifest_file, 'r') as f:
+        manifest = json.load(f)
+
+    if manifest.get('key') != key:
+        return None
+
+    return manifest['results']
+
+
+# Function to load the ranking saved in `sub_dir`. Returns the results and the
+# dictionary of the results organization methods that were run on them, or
+# None if there is no ranking saved for `key`.
+def load_ranking(sub_dir: str, key: str):
+    done_results = load_ranking_manifest(sub_dir, key)
+    if done_results is None:
+        return None
+
+    with np.load(os.path.join(sub_dir, RANKING_FILE),
+                 allow_pickle=False) as ranking_file:
+        results = {
+            'scores': ranking_file['scores'],
+            'sel_ind': ranking_file['sel_ind'],
+            'dts_ids': ranking_file['dts_ids']
+        }
+
+    return results, done_results
+
+
+# Function to normalize the parameters of a results organization method to
+# the values they have after being saved in and loaded from a manifest (e.g.,
+# tuples become lists), so that they can be compared with the parameters in
+# the manifest.
+def normalize_params(params: dict) -> dict:
+    return json.loads(json.dumps(params, sort_keys=True, default=str))
+
+
+# Function to get the relative path, size, and modification time of the file
+# at `data_path`, or of every file under `data_path` if it is a directory.
+def get_file_stats(data_path: str) -> list:
+    if os.path.isfile(data_path):
+        file_list = [data_path]
+    else:
+        file_list = []
+        for root, _, files in os.walk(data_path):
+            file_list.extend([os.path.join(root, f) for f in files])
+
+    file_stats = []
+    for f in sorted(file_list):
+        stat = os.stat(f)
+        file_stats.append((os.path.relpath(f, data_path), stat.st_size,
+                           stat.st_mtime_ns))
+
+    return file_stats
+
+
+# Copyright (c) 2021 California Institute of Technology ("Caltech").
+# U.S. Government sponsorship acknowledged.
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of Caltech nor its operating division, the Jet Propulsion
+#   Laboratory, nor the names of its contributors may be used to endorse or
+#   promote products derived from this software without specific prior written
+#   permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
@@ -12,6 +12,59 @@ CONFIG_KEYWORDS = ['data_loader', 'data_to_fit', 'data_to_score',
                    'zscore_normalization', 'out_dir', 'features',
                    'top_n', 'outlier_detection', 'results']
 
+# Optional keywords and their default values
+OPTIONAL_CONFIG_KEYWORDS = {
+    # Directory for temporary memory-mapped feature files. If specified, the
+    # features are written to disk block by block instead of being held in
+    # memory.
+    'memmap_dir': None,
+    # Directory of the on-disk cache of loaded data and extracted features. If
+    # specified, the features of a data source are loaded from the cache when
+    # the source files, data loader, and features are unchanged.
+    'cache_dir': None,
+    # Size limit of the cache in megabytes. The least recently used entries
+    # are removed when the cache grows beyond the limit.
+    'cache_max_size_mb': None,
+    # Data type of the features from feature extraction to outlier detection
+    # ('float32' or 'float64'). If specified, the features are created in
+    # this data type and are not converted again, and the data loaders that
+    # convert the values they read (FeatureVector and Time series) read them
+    # in this data type unless their `dtype` parameter is set. If not
+    # specified, features assembled from more than one feature extractor are
+    # float64, and the outlier detection algorithms receive float32 copies.
+    'dtype': None,
+    # Number of parallel jobs. The feature extractors run in a pool of
+    # threads, and the outlier detection algorithms run in a pool of worker
+    # processes. The worker processes import the script that calls
+    # dora_exp.start(), so the script must call it inside an
+    # `if __name__ == '__main__':` block.
+    'n_jobs': 1,
+    # Number of rows per chunk for z-score normalization. If specified, the
+    # mean and variance are computed chunk by chunk, and the features are
+    # normalized in place instead of into a copy.
+    'zscore_chunk_size': None,
+    # Whether to save the model of each outlier detection algorithm fitted to
+    # data_to_fit, with the z-score normalization scaler and the data loader
+    # and features settings, in the sub directory of the algorithm. New data
+    # can then be scored with the saved model by `dora_score`, without fitting
+    # the model again.
+    'save_models': False,
+    # Number of items of data_to_score per chunk for outlier detection. If
+    # specified, the algorithms that score each item independently of the
+    # others (RX, PCA, iForest, negative sampling, and PAE) score
+    # data_to_score chunk by chunk and only keep the top_n best scores in
+    # memory. With `memmap_dir` (or `cache_dir`) and `dtype`, the features of
+    # data_to_score then stay on disk.
+    'score_chunk_size': None,
+    # Whether to save the scores of all the items of data_to_score of the
+    # algorithms that support `score_chunk_size` as a `.npy` file in the sub
+    # directory of the algorithm. The scores are written chunk by chunk.
+    'save_all_scores': False
+}
+
+# Data types supported by the `dtype` keyword
+FEATURE_DTYPES = ['float32', 'float64']
+
 
 class DoraConfig(object):
     def __init__(self, config_file: str, logger=None):
@@ -24,7 +77,8 @@ class DoraConfig(object):
 
         # Verify keywords in config file
         for key in config.keys():
-            if key not in CONFIG_KEYWORDS:
+            if (key not in CONFIG_KEYWORDS and
+                    key not in OPTIONAL_CONFIG_KEYWORDS.keys()):
                 raise RuntimeError('Unrecognized keyword %s is provided in the '
                                    'config file' % key)
 
@@ -43,6 +97,22 @@ class DoraConfig(object):
         self.top_n = config['top_n']
         self.outlier_detection = config['outlier_detection']
         self.results = config['results']
+        self.memmap_dir = config.get('memmap_dir',
+                                     OPTIONAL_CONFIG_KEYWORDS['memmap_dir'])
+        self.cache_dir = config.get('cache_dir',
+                                    OPTIONAL_CONFIG_KEYWORDS['cache_dir'])
+        self.cache_max_size_mb = config.get(
+            'cache_max_size_mb', OPTIONAL_CONFIG_KEYWORDS['cache_max_size_mb'])
+        self.dtype = config.get('dtype', OPTIONAL_CONFIG_KEYWORDS['dtype'])
+        self.n_jobs = config.get('n_jobs', OPTIONAL_CONFIG_KEYWORDS['n_jobs'])
+        self.zscore_chunk_size = config.get(
+            'zscore_chunk_size', OPTIONAL_CONFIG_KEYWORDS['zscore_chunk_size'])
+        self.save_models = config.get(
+            'save_models', OPTIONAL_CONFIG_KEYWORDS['save_models'])
+        self.score_chunk_size = config.get(
+            'score_chunk_size', OPTIONAL_CONFIG_KEYWORDS['score_chunk_size'])
+        self.save_all_scores = config.get(
+            'save_all_scores', OPTIONAL_CONFIG_KEYWORDS['save_all_scores'])
         self.logger = logger
 
         # Log config settings
@@ -67,6 +137,15 @@ class DoraConfig(object):
         self.logger.text(f'top_n: {self.top_n}')
         self.logger.text(f'outlier_detection: {self.outlier_detection}')
         self.logger.text(f'results: {self.results}')
+        self.logger.text(f'memmap_dir: {self.memmap_dir}')
+        self.logger.text(f'cache_dir: {self.cache_dir}')
+        self.logger.text(f'cache_max_size_mb: {self.cache_max_size_mb}')
+        self.logger.text(f'dtype: {self.dtype}')
+        self.logger.text(f'n_jobs: {self.n_jobs}')
+        self.logger.text(f'zscore_chunk_size: {self.zscore_chunk_size}')
+        self.logger.text(f'save_models: {self.save_models}')
+        self.logger.text(f'score_chunk_size: {self.score_chunk_size}')
+        self.logger.text(f'save_all_scores: {self.save_all_scores}')
 
     def verify_config_parameters(self):
         # Verify `data_type` field
@@ -132,6 +211,65 @@ class DoraConfig(object):
         if not isinstance(self.results, dict):
             raise RuntimeError('results field must be a dictionary')
 
+        # Verify `memmap_dir`
+        if self.memmap_dir is not None:
+            if not isinstance(self.memmap_dir, str):
+                raise RuntimeError('memmap_dir field must be a string')
+
+            if not os.path.isdir(self.memmap_dir):
+                raise RuntimeError(f'memmap_dir not found: '
+                                   f'{os.path.abspath(self.memmap_dir)}')
+
+        # Verify `cache_dir` and `cache_max_size_mb`
+        if self.cache_dir is not None and not isinstance(self.cache_dir, str):
+            raise RuntimeError('cache_dir field must be a string')
+
+        if self.cache_max_size_mb is not None:
+            if (not isinstance(self.cache_max_size_mb, (int, float)) or
+                    isinstance(self.cache_max_size_mb, bool)):
+                raise RuntimeError('cache_max_size_mb field must be a number')
+            elif self.cache_max_size_mb < 0:
+                raise RuntimeError('cache_max_size_mb must be greater than or '
+                                   'equal to zero.')
+
+        # Verify `dtype`
+        if self.dtype is not None and self.dtype not in FEATURE_DTYPES:
+            raise RuntimeError(f'dtype field must be one of {FEATURE_DTYPES}')
+
+        # Verify `n_jobs`
+        if not isinstance(self.n_jobs, int) or isinstance(self.n_jobs, bool):
+            raise RuntimeError('n_jobs field must be an integer')
+        elif self.n_jobs < 1:
+            raise RuntimeError('n_jobs must be greater than or equal to one.')
+
+        # Verify `zscore_chunk_size`
+        if self.zscore_chunk_size is not None:
+            if (not isinstance(self.zscore_chunk_size, int) or
+                    isinstance(self.zscore_chunk_size, bool)):
+                raise RuntimeError('zscore_chunk_size field must be an '
+                                   'integer')
+            elif self.zscore_chunk_size < 1:
+                raise RuntimeError('zscore_chunk_size must be greater than or '
+                                   'equal to one.')
+
+        # Verify `save_models`
+        if not isinstance(self.save_models, bool):
+            raise RuntimeError('save_models field must be a boolean')
+
+        # Verify `score_chunk_size`
+        if self.score_chunk_size is not None:
+            if (not isinstance(self.score_chunk_size, int) or
+                    isinstance(self.score_chunk_size, bool)):
+                raise RuntimeError('score_chunk_size field must be an '
+                                   'integer')
+            elif self.score_chunk_size < 1:
+                raise RuntimeError('score_chunk_size must be greater than or '
+                                   'equal to one.')
+
+        # Verify `save_all_scores`
+        if not isinstance(self.save_all_scores, bool):
+            raise RuntimeError('save_all_scores field must be a boolean')
+
 
 # Copyright (c) 2021 California Institute of Technology ("Caltech").
 # U.S. Government sponsorship acknowledged.
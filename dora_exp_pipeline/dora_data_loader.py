@@ -6,19 +6,45 @@
 import os
 import glob
 import csv
+import struct
+import zipfile
 import numpy as np
 import pandas as pd
 import rasterio as rio
+from rasterio.windows import Window
 from PIL import Image
+from skimage import transform
+from functools import partial
 from six import add_metaclass
 from planetaryimage import PDS3Image
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+    import pyarrow.feather as pa_feather
+    import pyarrow.parquet as pa_parquet
+except ImportError:
+    pa = None
+    pa_csv = None
+    pa_feather = None
+    pa_parquet = None
 from abc import ABCMeta, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from numpy.lib.stride_tricks import as_strided
+try:
+    from numpy.lib.stride_tricks import sliding_window_view
+except ImportError:
+    # sliding_window_view is only available in numpy >= 1.20
+    sliding_window_view = None
 
 
 # The pool of data loaders. Data loaders can be registered into this pool using
 # register_data_loader() function.
 LOADER_POOL = []
 
+# Number of rows read at a time when the rows to load are selected with the
+# `max_rows`, `row_range`, or `sample` parameters
+CHUNK_ROWS = 100000
+
 
 # Function to get the data loader by data type
 def get_data_loader_by_name(loader_name):
@@ -48,8 +74,62 @@ def register_data_loader(data_loader):
                            'the base class DataLoader')
 
 
+# Image file types that can be decoded by ImageLoader
+IMAGE_FILE_TYPES = ['.jpg', '.png', '.img']
+
+
+# Function to decode a single image file into a numpy array. This is a module
+# level function so that it can be sent to worker processes. If `width` and
+# `height` are specified, the image is resized while it is decoded: JPEG
+# images are decoded at a reduced scale (Image.draft()), and PIL reduces the
+# image by an integer factor (Image.reduce()) before the final antialiased
+# resize, so the full resolution image is never resampled.
+def read_image(file_path, width=None, height=None):
+    file_ext = os.path.splitext(file_path)[1].lower()
+    do_resizing = width is not None and height is not None
+
+    if file_ext == '.jpg' or file_ext == '.png':
+        im_pil = Image.open(file_path)
+        if do_resizing:
+            im_pil.draft(im_pil.mode, (width, height))
+            if im_pil.size != (width, height):
+                im_pil = im_pil.resize((width, height), Image.BILINEAR,
+                                       reducing_gap=2.0)
+        im_data = np.array(im_pil)
+        im_pil.close()
+    elif file_ext == '.img':
+        im = PDS3Image.open(file_path)
+        im_data = im.image
+        if do_resizing and im_data.shape[:2] != (height, width):
+            im_data = transform.resize(
+                im_data, (height, width), anti_aliasing=True,
+                preserve_range=True).astype(im_data.dtype)
+    else:
+        raise RuntimeError(f'The format of the input is not '
+                           f'recognized: {os.path.abspath(file_path)}')
+
+    return im_data
+
+
+# Function to create a pool of workers. `pool_type` can be either `thread` or
+# `process`.
+def get_executor(pool_type, n_workers):
+    if pool_type == 'thread':
+        return ThreadPoolExecutor(max_workers=n_workers)
+    elif pool_type == 'process':
+        return ProcessPoolExecutor(max_workers=n_workers)
+    else:
+        raise RuntimeError(f'Unrecognized pool_type: {pool_type}. Valid '
+                           f'pool types: thread, process')
+
+
 @add_metaclass(ABCMeta)
 class DataLoader(object):
+    # Data loaders that convert the values they load to a `dtype` parameter
+    # set this to True, so that they are given the `dtype` of the pipeline
+    # (see get_params()).
+    converts_dtype = False
+
     def __init__(self, loader_name):
         self.loader_name = loader_name
 
@@ -59,6 +139,27 @@ class DataLoader(object):
         else:
             return False
 
+    # Get the parameters to load data with, from the `params` of the data
+    # loader in the config file and the `dtype` of the pipeline. The values
+    # are loaded in `dtype`, unless `params` sets another `dtype`, so that
+    # they are not rounded to a lower precision before feature extraction.
+    def get_params(self, params, dtype=None):
+        if (dtype is None or not self.converts_dtype or
+                params.get('dtype') is not None):
+            return params
+
+        return dict(params, dtype=dtype)
+
+    # Load the data at `path` into a dictionary with two keys: `id` and `data`.
+    # `data` is either a list of numpy arrays (one per item) or a numpy array
+    # (or memmap) with one item per index of the first axis (e.g., a 2-D array
+    # with one row per item, or a stack of images of the same size). The
+    # latter is preferred when all the items have the same dimension, because
+    # it is passed through feature extraction without another copy. `id` is
+    # a list or a numpy array of item ids in the same order as `data`: a 1-D
+    # array of strings or integers (e.g., pixel indices), or a 2-D array with
+    # one row of integer coordinates per item (e.g., patch centers). Ids are
+    # only converted to strings when they are written out (see ids_to_str()).
     def load(self, path: str, **kwargs):
         if path is None:
             return None
@@ -68,8 +169,24 @@ class DataLoader(object):
         if not isinstance(data_dict, dict):
             raise RuntimeError(f'Unexpected return type: {type(data_dict)}')
 
+        if len(data_dict['id']) != len(data_dict['data']):
+            raise RuntimeError(f'The number of ids ({len(data_dict["id"])}) '
+                               f'does not match the number of items '
+                               f'({len(data_dict["data"])})')
+
         return data_dict
 
+    # Iterate over the data at `path` in blocks of items. Each block is a
+    # dictionary in the same format returned by load(). Data loaders that can
+    # read a file piece by piece override this function, so that the pipeline
+    # can process data that doesn't fit in memory. By default, all the data
+    # is returned in one block.
+    def iter_blocks(self, path: str, **kwargs):
+        if path is None:
+            return
+
+        yield self.load(path, **kwargs)
+
     @abstractmethod
     def _load(self, file_path: str, **kwargs) -> dict:
         raise RuntimeError('Development error. This function should never be '
@@ -80,33 +197,53 @@ class ImageLoader(DataLoader):
     def __init__(self):
         super(ImageLoader, self).__init__('image')
 
-    def _load(self, dir_path: str) -> dict:
+    # If `width` and `height` are specified, the images are resized while
+    # they are decoded (see read_image()), and `data` is a numpy array of
+    # shape (n_images, height, width[, channels]) that the resized images are
+    # written into. Otherwise, `data` is a list of full resolution images.
+    def _load(self, dir_path: str, n_workers: int = 1,
+              pool_type: str = 'thread', width: int = None,
+              height: int = None) -> dict:
         if not os.path.exists(dir_path):
             raise RuntimeError(f'Directory not found: '
                                f'{os.path.abspath(dir_path)}')
 
+        if n_workers < 1:
+            raise RuntimeError('n_workers must be >= 1')
+
+        if (width is None) != (height is None):
+            raise RuntimeError('width and height must be specified together')
+
         data_dict = dict()
         data_dict.setdefault('id', [])
         data_dict.setdefault('data', [])
         file_list = glob.glob(os.path.join(dir_path, '*'))
 
+        # Check all the file formats up front, so that an unrecognized file is
+        # reported before any decoding work is scheduled.
         for f in file_list:
-            file_id = os.path.basename(f)
-            file_ext = os.path.splitext(file_id)[1]
-
-            if file_ext.lower() == '.jpg' or file_ext.lower() == '.png':
-                im_pil = Image.open(f)
-                im_data = np.array(im_pil)
-                im_pil.close()
-            elif file_ext.lower() == '.img':
-                im = PDS3Image.open(f)
-                im_data = im.image
-            else:
+            file_ext = os.path.splitext(f)[1]
+            if file_ext.lower() not in IMAGE_FILE_TYPES:
                 raise RuntimeError(f'The format of the input is not '
                                    f'recognized: {os.path.abspath(f)}')
 
-            data_dict['id'].append(file_id)
-            data_dict['data'].append(im_data)
+        data_dict['id'] = [os.path.basename(f) for f in file_list]
+        if width is None:
+            read_func = read_image
+        else:
+            read_func = partial(read_image, width=int(width),
+                                height=int(height))
+
+        if n_workers == 1 or len(file_list) <= 1:
+            data_dict['data'] = fill_images(map(read_func, file_list),
+                                            len(file_list), width)
+        else:
+            # Executor.map() yields results in the order of file_list, so the
+            # ids are in the same order as the serial path.
+            with get_executor(pool_type, n_workers) as executor:
+                data_dict['data'] = fill_images(
+                    executor.map(read_func, file_list), len(file_list),
+                    width)
 
         return data_dict
 
@@ -115,6 +252,31 @@ image_loader = ImageLoader()
 register_data_loader(image_loader)
 
 
+# Function to collect the decoded images from `im_iter`. If the images are
+# resized (`width` is not None), they all have the same shape and are written
+# into a preallocated array as they are decoded. Otherwise, they are returned
+# as a list.
+def fill_images(im_iter, n_images, width=None):
+    if width is None:
+        return list(im_iter)
+
+    im_stack = None
+    for ind, im_data in enumerate(im_iter):
+        if im_stack is None:
+            im_stack = np.empty((n_images,) + im_data.shape,
+                                dtype=im_data.dtype)
+        elif im_data.shape != im_stack.shape[1:]:
+            raise RuntimeError(f'All images must have the same number of '
+                               f'channels. Expected shape '
+                               f'{im_stack.shape[1:]}, got {im_data.shape}')
+        im_stack[ind] = im_data
+
+    if im_stack is None:
+        return []
+
+    return im_stack
+
+
 class ImageDirectoryLoader(DataLoader):
     def __init__(self):
         super(ImageDirectoryLoader, self).__init__('image_dir')
@@ -153,39 +315,72 @@ class RasterPixelLoader(DataLoader):
     def __init__(self):
         super(RasterPixelLoader, self).__init__('raster_pixels')
 
-    def _load(self, dir_path: str) -> dict:
-        if not os.path.exists(dir_path):
-            raise RuntimeError(f'Directory not found: '
-                               f'{os.path.abspath(dir_path)}')
-
-        # List of supported file types
-        file_types = ['.tif']
+    # If `tile_rows` is specified, the raster is read in bands of about
+    # `tile_rows` rows (see get_raster_bands()), and the pipeline extracts the
+    # features of each band as soon as it is read (see iter_blocks()). The
+    # features of all the bands are still collected in memory, unless
+    # `memmap_dir` is set in the config file to write them to a memory-mapped
+    # file: only then is the peak memory bounded by the size of a band.
+    def _load(self, dir_path: str, tile_rows: int = None) -> dict:
+        check_raster_path(dir_path)
 
         data_dict = dict()
         data_dict.setdefault('id', [])
         data_dict.setdefault('data', [])
 
-        if dir_path.endswith('.tif'):
-            # Load the raster
+        if tile_rows is not None:
+            # Fill a preallocated array tile by tile, so that the full raster
+            # and its flattened copy are never held in memory together.
             with rio.open(dir_path) as src:
-                img = src.read()
-                # rasterio reads images in channels-first order
-                # we want to put it in channels-last order
-                img = np.moveaxis(img, 0, -1)
-                # flatten the raster so we have an array of feature
-                # vectors where each pixel is a feature vector
-                img = np.reshape(img, [img.shape[0]*img.shape[1],
-                                       img.shape[2]])
-                # set the ID to the index of the pixel
-                data_dict['id'] = [str(i) for i in range(img.shape[0])]
-                data_dict['data'] = list(img)
-        else:
-            raise RuntimeError(f'File extension not supported. '
-                               f'Valid file extensions: '
-                               f'{file_types}')
+                n_pixels = src.height * src.width
+                data_dict['data'] = np.empty((n_pixels, src.count),
+                                             dtype=src.dtypes[0])
+            data_dict['id'] = list()
+            ind = 0
+            for block in self.iter_blocks(dir_path, tile_rows=tile_rows):
+                n_block = len(block['id'])
+                data_dict['data'][ind:ind + n_block] = block['data']
+                data_dict['id'].append(block['id'])
+                ind += n_block
+            data_dict['id'] = np.concatenate(data_dict['id'])
+
+            return data_dict
+
+        # Load the raster
+        with rio.open(dir_path) as src:
+            img = src.read()
+            # rasterio reads images in channels-first order
+            # we want to put it in channels-last order
+            img = np.moveaxis(img, 0, -1)
+            # flatten the raster so we have an array of feature
+            # vectors where each pixel is a feature vector
+            img = np.reshape(img, [img.shape[0]*img.shape[1],
+                                   img.shape[2]])
+            # set the ID to the index of the pixel
+            data_dict['id'] = np.arange(img.shape[0])
+            data_dict['data'] = img
 
         return data_dict
 
+    def iter_blocks(self, path: str, tile_rows: int = None):
+        if path is None:
+            return
+
+        if tile_rows is None:
+            yield from super(RasterPixelLoader, self).iter_blocks(path)
+            return
+
+        check_raster_path(path)
+
+        with rio.open(path) as src:
+            for row_start, row_stop in get_raster_bands(src, tile_rows):
+                band = read_raster_rows(src, row_start, row_stop)
+                yield {
+                    'id': np.arange(row_start * src.width,
+                                    row_stop * src.width),
+                    'data': band.reshape(-1, band.shape[2])
+                }
+
 
 raster_pixel_loader = RasterPixelLoader()
 register_data_loader(raster_pixel_loader)
@@ -195,58 +390,220 @@ class RasterPatchLoader(DataLoader):
     def __init__(self):
         super(RasterPatchLoader, self).__init__('raster_patches')
 
-    def _load(self, dir_path: str, patch_size: int) -> dict:
-        if not os.path.exists(dir_path):
-            raise RuntimeError(f'Directory not found: '
-                               f'{os.path.abspath(dir_path)}')
-
-        # List of supported file types
-        file_types = ['.tif']
+    # See RasterPixelLoader._load() for `tile_rows`. Each band is read with
+    # the rows of the patches that span its edges.
+    def _load(self, dir_path: str, patch_size: int,
+              tile_rows: int = None) -> dict:
+        check_raster_path(dir_path)
 
         data_dict = dict()
         data_dict.setdefault('id', [])
         data_dict.setdefault('data', [])
 
-        if dir_path.endswith('.tif'):
-            # Load the raster
+        if tile_rows is not None:
+            # Fill a preallocated array tile by tile, so that the full raster
+            # and the patches are never held in memory together.
+            s = 2 * int(patch_size / 2) + 1
             with rio.open(dir_path) as src:
-                img = src.read()
-                # rasterio reads images in channels-first order
-                # we want to put it in channels-last order
-                img = np.moveaxis(img, 0, -1)
-                # extract patches from raster image
-                # i, j are patch center coordinates
-                w = int(patch_size/2)
-                for i in range(w, img.shape[0]-w):
-                    for j in range(w, img.shape[1]-w):
-                        patch = img[i-w:i+(w + 1), j-w:j+(w + 1)]
-                        # append the patch coordinate as the id
-                        data_dict['id'].append('%d-%d' % (i, j))
-                        # append the patch data
-                        data_dict['data'].append(patch.flatten())
-        else:
-            raise RuntimeError(f'File extension not supported. '
-                               f'Valid file extensions: '
-                               f'{file_types}')
+                n_patches = (src.height - s + 1) * (src.width - s + 1)
+                data_dict['data'] = np.empty((n_patches, s * s * src.count),
+                                             dtype=src.dtypes[0])
+            data_dict['id'] = list()
+            ind = 0
+            for block in self.iter_blocks(dir_path, patch_size=patch_size,
+                                          tile_rows=tile_rows):
+                n_block = len(block['id'])
+                data_dict['data'][ind:ind + n_block] = block['data']
+                data_dict['id'].append(block['id'])
+                ind += n_block
+            data_dict['id'] = np.concatenate(data_dict['id'])
+
+            return data_dict
+
+        # Load the raster
+        with rio.open(dir_path) as src:
+            img = src.read()
+            # rasterio reads images in channels-first order
+            # we want to put it in channels-last order
+            img = np.moveaxis(img, 0, -1)
+            # extract patches from raster image
+            patches, coords = extract_patches(img, patch_size)
+            data_dict['data'] = patches
+            # the (row, col) patch center coordinates are used as the ids
+            data_dict['id'] = coords
 
         return data_dict
 
+    def iter_blocks(self, path: str, patch_size: int, tile_rows: int = None):
+        if path is None:
+            return
+
+        if tile_rows is None:
+            yield from super(RasterPatchLoader, self).iter_blocks(
+                path, patch_size=patch_size)
+            return
+
+        check_raster_path(path)
+
+        w = int(patch_size / 2)
+        with rio.open(path) as src:
+            for row_start, row_stop in get_raster_bands(src, tile_rows):
+                # Rows of patch centers in this tile
+                center_start = max(row_start, w)
+                center_stop = min(row_stop, src.height - w)
+                if center_start >= center_stop:
+                    continue
+
+                # Read the tile with a halo of w rows above and below, so
+                # that the patches at the tile edges are complete.
+                band = read_raster_rows(src, center_start - w,
+                                        center_stop + w)
+                patches, coords = extract_patches(band, patch_size)
+                coords[:, 0] += center_start - w
+
+                yield {
+                    'id': coords,
+                    'data': patches
+                }
+
 
 raster_patch_loader = RasterPatchLoader()
 register_data_loader(raster_patch_loader)
 
 
+# Function to verify that the path to a raster exists and is a supported file.
+def check_raster_path(file_path):
+    if not os.path.exists(file_path):
+        raise RuntimeError(f'Directory not found: '
+                           f'{os.path.abspath(file_path)}')
+
+    # List of supported file types
+    file_types = ['.tif']
+
+    if not file_path.endswith(tuple(file_types)):
+        raise RuntimeError(f'File extension not supported. '
+                           f'Valid file extensions: '
+                           f'{file_types}')
+
+
+# Function to split a raster into bands of rows for tiled reading. The number
+# of rows in each band is `tile_rows` rounded up to a multiple of the block
+# height of the raster, so that each read is aligned to the blocks (strips or
+# tiles) of the file. Bands span the full width of the raster so that the
+# items read band by band are in the same row-major order as reading the whole
+# raster at once.
+def get_raster_bands(src, tile_rows):
+    if tile_rows < 1:
+        raise RuntimeError('tile_rows must be >= 1')
+
+    block_rows = src.block_shapes[0][0]
+    band_rows = int(np.ceil(tile_rows / block_rows)) * block_rows
+
+    return [(row_start, min(row_start + band_rows, src.height))
+            for row_start in range(0, src.height, band_rows)]
+
+
+# Function to read rows [row_start, row_stop) of a raster in channels-last
+# order.
+def read_raster_rows(src, row_start, row_stop):
+    window = Window(0, row_start, src.width, row_stop - row_start)
+
+    return np.moveaxis(src.read(window=window), 0, -1)
+
+
+# Function to convert item ids (see DataLoader.load()) to a 1-D numpy array of
+# strings. Rows of coordinates are joined with '-' (e.g., 'row-col').
+def ids_to_str(ids):
+    ids = np.asarray(ids)
+    if ids.ndim == 1:
+        return ids.astype(str)
+
+    str_ids = ids[:, 0].astype(str)
+    for col in range(1, ids.shape[1]):
+        str_ids = np.char.add(np.char.add(str_ids, '-'),
+                              ids[:, col].astype(str))
+
+    return str_ids
+
+
+# Function to return a read-only strided view of all the (2w+1) x (2w+1)
+# windows of a channels-last image, where w = int(patch_size/2). The view has
+# shape (rows - 2w, cols - 2w, 2w+1, 2w+1, channels), and no data is copied.
+def patch_view(img, patch_size):
+    s = 2 * int(patch_size / 2) + 1
+    rows, cols, channels = img.shape
+    if rows < s or cols < s:
+        raise RuntimeError(f'patch_size {patch_size} is larger than the '
+                           f'raster ({rows} x {cols})')
+
+    if sliding_window_view is not None:
+        # The window dimensions are appended after the input dimensions, so
+        # the (rows, cols, 1, s, s, channels) view is squeezed on axis 2.
+        view = sliding_window_view(img, (s, s, channels))[:, :, 0]
+    else:
+        row_stride, col_stride, ch_stride = img.strides
+        view = as_strided(img,
+                          shape=(rows - s + 1, cols - s + 1, s, s, channels),
+                          strides=(row_stride, col_stride, row_stride,
+                                   col_stride, ch_stride),
+                          writeable=False)
+
+    return view
+
+
+# Function to extract all the patches of a channels-last image. The patches
+# are returned as a 2-D array with one flattened patch per row (in the same
+# row-major order of patch centers as a nested loop over rows and columns),
+# and the integer (row, col) coordinates of the patch centers as a 2-column
+# array.
+def extract_patches(img, patch_size):
+    w = int(patch_size / 2)
+    view = patch_view(img, patch_size)
+    n_rows, n_cols = view.shape[:2]
+
+    # One bulk copy of the strided view into a contiguous feature matrix
+    patches = view.reshape(n_rows * n_cols, -1)
+
+    rr, cc = np.meshgrid(np.arange(w, w + n_rows), np.arange(w, w + n_cols),
+                         indexing='ij')
+    coords = np.stack((rr.ravel(), cc.ravel()), axis=1)
+
+    return patches, coords
+
+
 class FeatureVectorLoader(DataLoader):
+    converts_dtype = True
+
     def __init__(self):
         super(FeatureVectorLoader, self).__init__('FeatureVector')
 
-    def _load(self, dir_path: str) -> dict:
+    # `columns` selects the feature columns to load (column names for .h5,
+    # Parquet, and Arrow files, and column indices for .npy and .npz files),
+    # and `id_column` is the name of the column that holds the item ids in
+    # Parquet and Arrow files. If `id_column` is not specified, the row index
+    # is used as the id. `dtype` is the data type of the returned values. If
+    # it is not specified, values are converted to float64, except that .npy
+    # and .npz arrays keep the stored data type so that they are returned
+    # memory-mapped rather than read into memory.
+    #
+    # `row_range` ([start, stop]) and `max_rows` select a range of rows, and
+    # `sample` draws a random sample of rows (seeded with `sample_seed`) from
+    # the selected range. The file is read in chunks, so only the selected
+    # rows are held in memory (see get_row_bounds() and collect_rows()).
+    def _load(self, dir_path: str, dtype: str = None, columns: list = None,
+              id_column: str = None, max_rows: int = None,
+              row_range: list = None, sample: int = None,
+              sample_seed: int = 1234) -> dict:
         if not os.path.exists(dir_path):
             raise RuntimeError(f'Directory not found: '
                                f'{os.path.abspath(dir_path)}')
 
+        start, stop = get_row_bounds(row_range, max_rows)
+        select_rows = start > 0 or stop is not None or sample is not None
+
         # List of supported file types
-        file_types = ['.h5', '.csv']
+        file_types = ['.h5', '.csv', '.parquet', '.arrow', '.feather',
+                      '.npy', '.npz']
 
         data_dict = dict()
         data_dict.setdefault('id', [])
@@ -254,22 +611,79 @@ class FeatureVectorLoader(DataLoader):
 
         # (e.g., .h5 dataframes, .npy)
         if dir_path.endswith('.h5'):
-            # Load the .h5
-            df = pd.read_hdf(dir_path)
-            data_dict['id'] = df.index.astype(str)
-            data_dict['data'] = df.values
+            if select_rows:
+                data_dict['id'], data_dict['data'] = collect_rows(
+                    iter_hdf_chunks(dir_path, dtype or 'float64', columns,
+                                    start, stop), sample, sample_seed)
+            else:
+                # Load the .h5
+                df = pd.read_hdf(dir_path)
+                if columns is not None:
+                    df = df[columns]
+                data_dict['id'] = np.asarray(df.index.astype(str))
+                data_dict['data'] = df.values.astype(dtype or 'float64',
+                                                     copy=False)
 
         elif dir_path.endswith('.csv'):
-            # Read in CSV.  Assume first column is the sample id
-            with open(dir_path, 'r') as csv_file:
-                csv_reader = csv.reader(csv_file)
-                # Read each row into the data_dict
-                for row in csv_reader:
-                    # Assumes the first column is the ID
-                    # and all other columns are (float) feature values
-                    data_dict['id'].append(row[0])
-                    data_dict['data'].append(np.array(
-                        [float(v) for v in row[1:]]))
+            # Read in CSV. Assumes the first column is the ID and all other
+            # columns are (float) feature values
+            if select_rows:
+                data_dict['id'], data_dict['data'] = collect_rows(
+                    iter_csv_chunks(dir_path, dtype or 'float64', start,
+                                    stop), sample, sample_seed)
+            else:
+                data_dict['id'], data_dict['data'] = read_csv_matrix(
+                    dir_path, dtype or 'float64')
+
+        elif dir_path.endswith('.parquet'):
+            check_pyarrow(dir_path)
+            if select_rows:
+                data_dict['id'], data_dict['data'] = collect_rows(
+                    iter_parquet_chunks(dir_path, dtype or 'float64',
+                                        columns, id_column, start, stop),
+                    sample, sample_seed)
+            else:
+                table = pa_parquet.read_table(
+                    dir_path, columns=get_table_columns(columns, id_column))
+                data_dict['id'], data_dict['data'] = table_to_matrix(
+                    table, id_column, dtype or 'float64')
+
+        elif dir_path.endswith('.arrow') or dir_path.endswith('.feather'):
+            # Arrow IPC files (Feather V2) are memory-mapped, so only the
+            # selected columns are read from disk.
+            check_pyarrow(dir_path)
+            table = pa_feather.read_table(
+                dir_path, columns=get_table_columns(columns, id_column),
+                memory_map=True)
+            data_dict['id'], data_dict['data'] = collect_rows(
+                iter_table_chunks(table, dtype or 'float64', id_column,
+                                  start, stop), sample, sample_seed)
+
+        elif dir_path.endswith('.npy') or dir_path.endswith('.npz'):
+            if dir_path.endswith('.npy'):
+                data = np.load(dir_path, mmap_mode='r')
+                ids = None
+            else:
+                data, ids = load_npz_arrays(dir_path)
+
+            if data.ndim != 2:
+                raise RuntimeError(f'Expected a 2-D array, but the array in '
+                                   f'{os.path.abspath(dir_path)} has shape '
+                                   f'{data.shape}')
+
+            # Slicing the memory-mapped array doesn't read it, so the
+            # selected rows are read only once they are sampled.
+            ids, data = collect_rows(
+                iter_array_chunks(data, ids, start, stop), sample,
+                sample_seed)
+
+            if columns is not None:
+                data = data[:, columns]
+            if dtype is not None:
+                data = data.astype(dtype, copy=False)
+
+            data_dict['id'] = ids
+            data_dict['data'] = data
 
         else:
             raise RuntimeError(f'File extension not supported. '
@@ -278,37 +692,405 @@ class FeatureVectorLoader(DataLoader):
 
         return data_dict
 
+    # Parquet files are read one row group at a time, so that a large file
+    # can be streamed through feature extraction. Other file types, and
+    # Parquet files from which a sample is drawn, are returned in one block.
+    def iter_blocks(self, path: str, dtype: str = None, columns: list = None,
+                    id_column: str = None, max_rows: int = None,
+                    row_range: list = None, sample: int = None,
+                    sample_seed: int = 1234):
+        if path is None:
+            return
+
+        if not path.endswith('.parquet') or sample is not None:
+            yield from super(FeatureVectorLoader, self).iter_blocks(
+                path, dtype=dtype, columns=columns, id_column=id_column,
+                max_rows=max_rows, row_range=row_range, sample=sample,
+                sample_seed=sample_seed)
+            return
+
+        check_pyarrow(path)
+
+        start, stop = get_row_bounds(row_range, max_rows)
+        for ids, data in iter_parquet_chunks(path, dtype or 'float64',
+                                             columns, id_column, start,
+                                             stop):
+            yield {
+                'id': ids,
+                'data': data
+            }
+
 
 catalog_loader = FeatureVectorLoader()
 register_data_loader(catalog_loader)
 
 
+# Function to check that pyarrow, which is needed to read Parquet and Arrow
+# files, is installed.
+def check_pyarrow(file_path):
+    if pa is None:
+        raise RuntimeError(f'pyarrow is required to load '
+                           f'{os.path.basename(file_path)}. It can be '
+                           f'installed with `pip install pyarrow`.')
+
+
+# Function to get the list of columns to read from a Parquet or Arrow file.
+# Returns None (all columns) if no feature columns are selected.
+def get_table_columns(columns, id_column):
+    if columns is None:
+        return None
+
+    if id_column is None:
+        return list(columns)
+
+    return [id_column] + [c for c in columns if c != id_column]
+
+
+# Function to get the first and the last (exclusive) row to load from
+# `row_range` ([start, stop]) and `max_rows`. `stop` is None if all the rows
+# after `start` are loaded.
+def get_row_bounds(row_range=None, max_rows=None):
+    start, stop = 0, None
+    if row_range is not None:
+        if not isinstance(row_range, (list, tuple)) or len(row_range) != 2:
+            raise RuntimeError('row_range must be a list of two integers '
+                               '[start, stop]')
+        start, stop = row_range
+        if start < 0 or (stop is not None and stop < start):
+            raise RuntimeError(f'Invalid row_range: {row_range}')
+
+    if max_rows is not None:
+        if max_rows < 0:
+            raise RuntimeError('max_rows must be greater than or equal to '
+                               'zero.')
+        if stop is None:
+            stop = start + max_rows
+        else:
+            stop = min(stop, start + max_rows)
+
+    return start, stop
+
+
+# Function to collect the rows of `chunks`, an iterator of (ids, data) tuples
+# in file order. If `sample` is specified, a uniform random sample of `sample`
+# rows is drawn with priority (reservoir) sampling: every row is assigned a
+# random priority, and only the rows with the `sample` smallest priorities are
+# kept while reading, so that the chunks are never concatenated. The
+# priorities only depend on `sample_seed` and the order of the rows, so the
+# sample doesn't depend on the chunk size. The rows are returned in file
+# order.
+def collect_rows(chunks, sample=None, sample_seed=1234):
+    if sample is None:
+        ids_list = []
+        data_list = []
+        for ids, data in chunks:
+            ids_list.append(ids)
+            data_list.append(data)
+
+        if len(data_list) == 1:
+            return ids_list[0], data_list[0]
+
+        return np.concatenate(ids_list), np.concatenate(data_list)
+
+    if sample < 1:
+        raise RuntimeError('sample must be greater than zero.')
+
+    random_state = np.random.RandomState(sample_seed)
+    keep_keys = keep_rows = keep_ids = keep_data = None
+    row_offset = 0
+    for ids, data in chunks:
+        n_rows = len(ids)
+        keys = random_state.random_sample(n_rows)
+        rows = np.arange(row_offset, row_offset + n_rows)
+        row_offset += n_rows
+
+        if keep_keys is not None:
+            keys = np.concatenate((keep_keys, keys))
+            rows = np.concatenate((keep_rows, rows))
+            ids = np.concatenate((keep_ids, ids))
+            data = np.concatenate((keep_data, data))
+
+        if len(keys) > sample:
+            ind = np.argpartition(keys, sample - 1)[:sample]
+        else:
+            ind = np.arange(len(keys))
+
+        keep_keys = keys[ind]
+        keep_rows = rows[ind]
+        keep_ids = np.asarray(ids)[ind]
+        keep_data = np.asarray(data)[ind]
+
+    if keep_keys is None:
+        raise RuntimeError('No rows were selected to sample from.')
+
+    order = np.argsort(keep_rows)
+
+    return keep_ids[order], keep_data[order]
+
+
+# Function to read the rows `start` to `stop` of a CSV file (see
+# read_csv_matrix()) in chunks of `chunk_rows` rows. Yields the ids and values
+# of each chunk. A single empty chunk is yielded if no rows are in the range.
+def iter_csv_chunks(file_path, dtype, start=0, stop=None,
+                    chunk_rows=CHUNK_ROWS):
+    col_dtypes, float_precision = get_csv_read_args(file_path, dtype)
+    empty_chunk = (np.empty(0, dtype=str),
+                   np.empty((0, len(col_dtypes) - 1), dtype=dtype))
+    if stop is not None and stop <= start:
+        yield empty_chunk
+        return
+
+    try:
+        reader = pd.read_csv(file_path, header=None, dtype=col_dtypes,
+                             float_precision=float_precision, skiprows=start,
+                             nrows=None if stop is None else stop - start,
+                             chunksize=chunk_rows)
+    except pd.errors.EmptyDataError:
+        # `start` is past the end of the file
+        yield empty_chunk
+        return
+
+    n_chunks = 0
+    for df in reader:
+        n_chunks += 1
+        yield df[0].to_numpy(dtype=str), df.iloc[:, 1:].to_numpy(dtype=dtype)
+
+    if n_chunks == 0:
+        yield empty_chunk
+
+
+# Function to read the rows `start` to `stop` of a .h5 dataframe in chunks of
+# `chunk_rows` rows. Both the fixed and the table formats support reading a
+# range of rows without reading the full dataframe. Yields the ids and values
+# of each chunk, or a single empty chunk if no rows are in the range.
+def iter_hdf_chunks(file_path, dtype, columns=None, start=0, stop=None,
+                    chunk_rows=CHUNK_ROWS):
+    with pd.HDFStore(file_path, 'r') as store:
+        key = store.keys()[0]
+        storer = store.get_storer(key)
+        if storer.is_table:
+            n_rows = storer.nrows
+        else:
+            n_rows = storer.shape[0]
+        stop = n_rows if stop is None else min(stop, n_rows)
+        if stop <= start:
+            # Read an empty chunk to get the columns
+            chunk_starts = [stop]
+        else:
+            chunk_starts = range(start, stop, chunk_rows)
+
+        for chunk_start in chunk_starts:
+            df = store.select(key, start=chunk_start,
+                              stop=min(chunk_start + chunk_rows, stop))
+            if columns is not None:
+                df = df[columns]
+
+            yield (np.asarray(df.index.astype(str)),
+                   df.values.astype(dtype, copy=False))
+
+
+# Function to read the rows `start` to `stop` of a Parquet file. Row groups
+# are read one at a time, and row groups outside of the range are skipped
+# without being read. Yields the ids and values of each row group, or a
+# single empty chunk if no rows are in the range.
+def iter_parquet_chunks(file_path, dtype, columns=None, id_column=None,
+                        start=0, stop=None):
+    parquet_file = pa_parquet.ParquetFile(file_path)
+    table_columns = get_table_columns(columns, id_column)
+    if stop is not None and stop <= start:
+        row_groups = []
+    else:
+        row_groups = range(parquet_file.num_row_groups)
+
+    n_chunks = 0
+    row_offset = 0
+    for row_group in row_groups:
+        group_start = row_offset
+        row_offset += parquet_file.metadata.row_group(row_group).num_rows
+        if row_offset <= start:
+            continue
+        if stop is not None and group_start >= stop:
+            break
+
+        table = parquet_file.read_row_group(row_group, columns=table_columns)
+        first = max(start - group_start, 0)
+        last = table.num_rows
+        if stop is not None:
+            last = min(stop - group_start, last)
+
+        n_chunks += 1
+        yield table_to_matrix(table.slice(first, last - first), id_column,
+                              dtype, group_start + first)
+
+    if n_chunks == 0:
+        table = parquet_file.schema_arrow.empty_table()
+        if table_columns is not None:
+            table = table.select(table_columns)
+        yield table_to_matrix(table, id_column, dtype)
+
+
+# Function to convert the rows `start` to `stop` of a pyarrow table in chunks
+# of `chunk_rows` rows. Yields the ids and values of each chunk.
+def iter_table_chunks(table, dtype, id_column=None, start=0, stop=None,
+                      chunk_rows=CHUNK_ROWS):
+    stop = table.num_rows if stop is None else min(stop, table.num_rows)
+    if stop <= start:
+        yield table_to_matrix(table.slice(0, 0), id_column, dtype)
+        return
+
+    for chunk_start in range(start, stop, chunk_rows):
+        chunk_stop = min(chunk_start + chunk_rows, stop)
+        yield table_to_matrix(
+            table.slice(chunk_start, chunk_stop - chunk_start), id_column,
+            dtype, chunk_start)
+
+
+# Function to slice the rows `start` to `stop` of a 2-D array (e.g., a memmap)
+# and its ids in chunks of `chunk_rows` rows. If `ids` is None, the integer
+# row indices are used as ids, which are only converted to strings when they
+# are written out (see ids_to_str()). Yields the ids and values of each chunk
+# as views of `data`.
+def iter_array_chunks(data, ids=None, start=0, stop=None,
+                      chunk_rows=CHUNK_ROWS):
+    stop = len(data) if stop is None else min(stop, len(data))
+    if stop <= start:
+        chunk_starts = [start]
+        chunk_rows = 0
+    elif start == 0 and stop == len(data):
+        # Return the full array in one chunk, so that it is not copied
+        chunk_starts = [0]
+        chunk_rows = stop
+    else:
+        chunk_starts = range(start, stop, chunk_rows)
+
+    for chunk_start in chunk_starts:
+        chunk_stop = min(chunk_start + chunk_rows, stop)
+        if ids is None:
+            chunk_ids = np.arange(chunk_start, chunk_stop)
+        else:
+            chunk_ids = np.asarray(ids[chunk_start:chunk_stop])
+
+        yield chunk_ids, data[chunk_start:chunk_stop]
+
+
+# Function to convert a pyarrow table into ids and a 2-D numpy array of
+# `dtype`. The ids are the values of `id_column`, or the integer row indices
+# (starting at `row_offset`) if `id_column` is None. Numeric ids are only
+# converted to strings when they are written out (see ids_to_str()). All
+# other columns are feature values.
+def table_to_matrix(table, id_column, dtype, row_offset=0):
+    if id_column is None:
+        ids = np.arange(row_offset, row_offset + table.num_rows)
+    else:
+        if id_column not in table.column_names:
+            raise RuntimeError(f'id_column {id_column} not found. Valid '
+                               f'columns: {table.column_names}')
+        ids = np.asarray(table.column(id_column).to_numpy())
+        # String columns are returned as object arrays, which can't be
+        # cached without pickling
+        if ids.dtype.hasobject:
+            ids = ids.astype(str)
+
+    value_columns = [c for c in table.column_names if c != id_column]
+    data = np.empty((table.num_rows, len(value_columns)), dtype=dtype)
+    for ind, column in enumerate(value_columns):
+        data[:, ind] = table.column(column).to_numpy()
+
+    return ids, data
+
+
+# Function to load the arrays in a .npz file. The features are the `data`
+# array, or the only array in the file. The item ids are the optional `ids`
+# array. Arrays stored without compression (np.savez) are memory-mapped.
+def load_npz_arrays(file_path):
+    with np.load(file_path) as npz_file:
+        names = npz_file.files
+
+    if 'data' in names:
+        data_name = 'data'
+    elif len(names) == 1:
+        data_name = names[0]
+    else:
+        raise RuntimeError(f'{os.path.abspath(file_path)} must contain a '
+                           f'`data` array or a single array. Found: {names}')
+
+    data = memmap_npz_array(file_path, data_name)
+    ids = None
+    if 'ids' in names and data_name != 'ids':
+        with np.load(file_path) as npz_file:
+            ids = npz_file['ids']
+
+    return data, ids
+
+
+# Function to memory-map an array in a .npz file. np.load() reads .npz arrays
+# into memory, but arrays stored without compression are plain .npy files in
+# the zip archive and can be memory-mapped at their offset. Compressed arrays
+# are read into memory.
+def memmap_npz_array(file_path, name):
+    with zipfile.ZipFile(file_path) as zip_file:
+        info = zip_file.getinfo(name + '.npy')
+
+    if info.compress_type == zipfile.ZIP_STORED:
+        with open(file_path, 'rb') as f:
+            # The local file header is 30 bytes, followed by the file name
+            # and the extra field.
+            f.seek(info.header_offset)
+            local_header = f.read(30)
+            name_len, extra_len = struct.unpack('<HH', local_header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                header = np.lib.format.read_array_header_1_0(f)
+            else:
+                header = np.lib.format.read_array_header_2_0(f)
+            shape, fortran_order, dtype = header
+            offset = f.tell()
+
+        if not dtype.hasobject:
+            return np.memmap(file_path, dtype=dtype, mode='r', offset=offset,
+                             shape=shape,
+                             order='F' if fortran_order else 'C')
+
+    with np.load(file_path) as npz_file:
+        return npz_file[name]
+
+
 class TimeSeriesLoader(DataLoader):
+    converts_dtype = True
+
     def __init__(self):
         super(TimeSeriesLoader, self).__init__('Time series')
 
-    def _load(self, dir_path: str) -> dict:
+    # See FeatureVectorLoader._load() for the `max_rows`, `row_range`,
+    # `sample`, and `sample_seed` parameters.
+    def _load(self, dir_path: str, dtype: str = 'float64',
+              max_rows: int = None, row_range: list = None,
+              sample: int = None, sample_seed: int = 1234) -> dict:
         if not os.path.exists(dir_path):
             raise RuntimeError(f'Directory not found: '
                                f'{os.path.abspath(dir_path)}')
 
         # List of supported file types
         file_types = ['.csv']
+        start, stop = get_row_bounds(row_range, max_rows)
 
         data_dict = dict()
         data_dict.setdefault('id', [])
         data_dict.setdefault('data', [])
 
         if dir_path.endswith('.csv'):
-            # Load the csv data
-            with open(dir_path, 'r') as csv_file:
-                csv_reader = csv.reader(csv_file, quoting=csv.QUOTE_NONNUMERIC)
-                # Read each row into the data_dict
-                for row in csv_reader:
-                    # Assumes the first column is the ID
-                    # and all other columns are time steps
-                    data_dict['id'].append(str(int(row[0])))
-                    data_dict['data'].append(np.array(row[1:]))
+            # Load the csv data. Assumes the first column is the (numeric)
+            # ID and all other columns are time steps
+            if start > 0 or stop is not None or sample is not None:
+                ids, data_dict['data'] = collect_rows(
+                    iter_csv_chunks(dir_path, dtype, start, stop), sample,
+                    sample_seed)
+            else:
+                ids, data_dict['data'] = read_csv_matrix(dir_path, dtype)
+            data_dict['id'] = ids.astype(np.float64).astype(np.int64).astype(
+                str)
         else:
             raise RuntimeError(f'File extension not supported. '
                                f'Valid file extensions: '
@@ -321,6 +1103,49 @@ time_series_loader = TimeSeriesLoader()
 register_data_loader(time_series_loader)
 
 
+# Function to parse a CSV file without a header row, in which the first column
+# is the item id and all other columns are numeric values. The file is parsed
+# in bulk with pyarrow if it is installed, or with the pandas C parser
+# otherwise. Returns the ids as a numpy string array and the values as a 2-D
+# numpy array of `dtype`.
+def read_csv_matrix(file_path, dtype='float64'):
+    if pa_csv is not None:
+        table = pa_csv.read_csv(
+            file_path,
+            read_options=pa_csv.ReadOptions(autogenerate_column_names=True),
+            convert_options=pa_csv.ConvertOptions(
+                column_types={'f0': pa.string()}))
+        ids = table.column(0).to_numpy().astype(str)
+        data = np.empty((table.num_rows, table.num_columns - 1), dtype=dtype)
+        for col in range(1, table.num_columns):
+            data[:, col - 1] = table.column(col).to_numpy()
+    else:
+        col_dtypes, float_precision = get_csv_read_args(file_path, dtype)
+        df = pd.read_csv(file_path, header=None, dtype=col_dtypes,
+                         float_precision=float_precision)
+        ids = df[0].to_numpy(dtype=str)
+        data = df.iloc[:, 1:].to_numpy(dtype=dtype)
+
+    return ids, data
+
+
+# Function to get the column data types and the float converter for reading
+# a CSV file (see read_csv_matrix()) with pandas.
+def get_csv_read_args(file_path, dtype):
+    with open(file_path, 'r') as csv_file:
+        n_cols = len(next(csv.reader(csv_file)))
+    col_dtypes = {col: dtype for col in range(1, n_cols)}
+    col_dtypes[0] = str
+    # The round-trip float converter is exact but slower, so it is only used
+    # when the values are kept in double precision.
+    if np.dtype(dtype) == np.float64:
+        float_precision = 'round_trip'
+    else:
+        float_precision = 'high'
+
+    return col_dtypes, float_precision
+
+
 # Copyright (c) 2021 California Institute of Technology ("Caltech").
 # U.S. Government sponsorship acknowledged.
 # All rights reserved.
@@ -10,9 +10,20 @@
 
 import os
 import sys
+import ast
 import logging
+import tempfile
+import numpy as np
+import multiprocessing
 from tqdm import tqdm
 from dora_exp_pipeline.dora_config import DoraConfig
+from dora_exp_pipeline.dora_cache import FeatureCache
+from dora_exp_pipeline.dora_cache import CACHE_VERSION
+from dora_exp_pipeline.dora_cache import get_file_stats
+from dora_exp_pipeline.dora_cache import get_code_hash
+from dora_exp_pipeline.dora_cache import get_hash
+from dora_exp_pipeline.dora_cache import load_ranking_manifest
+from dora_exp_pipeline.dora_cache import normalize_params
 from dora_exp_pipeline.dora_data_loader import get_data_loader_by_name
 from dora_exp_pipeline.outlier_detection import register_od_alg
 from dora_exp_pipeline.demud_outlier_detection import DEMUDOutlierDetection
@@ -25,9 +36,12 @@ from dora_exp_pipeline.negative_sampling_outlier_detection import \
     NegativeSamplingOutlierDetection
 from dora_exp_pipeline.pae_outlier_detection import PAEOutlierDetection
 from dora_exp_pipeline.util import LogUtil
-from dora_exp_pipeline.dora_feature import extract_feature
+from dora_exp_pipeline.dora_feature import extract_feature_blocks
 from dora_exp_pipeline.dora_feature import z_score_normalize
+from dora_exp_pipeline.dora_feature import fit_z_score_scaler
 from dora_exp_pipeline.outlier_detection import get_alg_by_name
+from dora_exp_pipeline.outlier_detection import prepare_features
+from dora_exp_pipeline.dora_results_organization import get_res_org_method
 
 
 def register_od_algs():
@@ -64,7 +78,122 @@ def register_od_algs():
     register_od_alg(pae_outlier_detection)
 
 
-def start(config_file: str, out_dir: str, log_file=None, seed=1234):
+# Load the data at `data_path` block by block (see DataLoader.iter_blocks())
+# and extract features from each block. Data loaders that support tiled
+# reading (e.g., `tile_rows` for raster loaders) stream blocks through feature
+# extraction. Returns the ids and features. If `cache` is given, the ids and
+# features are loaded from the cache when they are available, and saved to the
+# cache otherwise.
+def load_features(data_loader, data_path, config, cache=None):
+    if cache is not None and data_path:
+        key = cache.get_key(data_path, config.data_loader, config.features,
+                            config.dtype)
+        cached = cache.load(key)
+        if cached is not None:
+            return cached
+
+    params = data_loader.get_params(config.data_loader['params'],
+                                    config.dtype)
+    blocks = data_loader.iter_blocks(data_path, **params)
+    ids, features = extract_feature_blocks(blocks, config.features,
+                                           config.memmap_dir, config.dtype,
+                                           config.n_jobs)
+
+    if cache is not None and data_path and features is not None:
+        cache.save(key, ids, features)
+
+    return ids, features
+
+
+# Get the settings of the pipeline that are needed to score new data with a
+# saved model: the data loader, features, dtype, z-score normalization scaler
+# (None if the features are not normalized), top_n, and results organization
+# methods.
+def get_model_info(config, scaler):
+    return {
+        'data_loader': config.data_loader,
+        'features': config.features,
+        'dtype': config.dtype,
+        'scaler': scaler,
+        'zscore_chunk_size': config.zscore_chunk_size,
+        'top_n': config.top_n,
+        'results': config.results
+    }
+
+
+# Check if data_to_fit and data_to_score point at the same file or directory.
+# Both are loaded with the same data loader and parameters, so loading the
+# same source twice would give the same features.
+def is_same_source(data_to_fit, data_to_score):
+    if data_to_fit is None or data_to_score is None:
+        return False
+
+    return os.path.realpath(data_to_fit) == os.path.realpath(data_to_score)
+
+
+# Get the keys of the rankings of the outlier detection algorithms (see
+# OutlierDetection.run()). The key of a ranking is a hash of everything the
+# ranking depends on: the source code of the pipeline and of the algorithm
+# (see get_code_hash()), the data sources (path, and size and modification
+# time of every file), the data loader, features, normalization, dtype, top_n,
+# seed, and whether models and all the scores are saved, and the name and
+# parameters of the algorithm. Returns a dictionary of algorithm name to key.
+def get_ranking_keys(config, seed):
+    alg_modules = [type(get_alg_by_name(alg_name)).__module__
+                   for alg_name in config.outlier_detection.keys()]
+    data_dict = {
+        'version': CACHE_VERSION,
+        'code': get_code_hash(alg_modules),
+        'data_loader': config.data_loader,
+        'features': config.features,
+        'zscore_normalization': config.zscore_normalization,
+        'zscore_chunk_size': config.zscore_chunk_size,
+        'dtype': config.dtype,
+        'top_n': config.top_n,
+        'seed': seed,
+        'save_models': config.save_models,
+        'save_all_scores': config.save_all_scores
+    }
+    for data_name in ['data_to_fit', 'data_to_score']:
+        data_path = getattr(config, data_name)
+        if data_path:
+            data_dict[data_name] = (os.path.realpath(data_path),
+                                    get_file_stats(data_path))
+    data_key = get_hash(data_dict)
+
+    return {alg_name: get_hash({'data': data_key, 'alg_name': alg_name,
+                                'alg_params': alg_params})
+            for alg_name, alg_params in config.outlier_detection.items()}
+
+
+# Check if the features need to be loaded, i.e., if the ranking of at least one
+# outlier detection algorithm was not saved by a previous run with the same
+# key, or if a results organization method that uses data_to_score needs to
+# run again.
+def need_features(config, ranking_keys):
+    for alg_name, alg_params in config.outlier_detection.items():
+        sub_dir = get_alg_by_name(alg_name).get_sub_dir(config.out_dir,
+                                                        alg_params)
+        done_results = load_ranking_manifest(sub_dir, ranking_keys[alg_name])
+        if done_results is None:
+            return True
+
+        for res_org_name, res_org_params in config.results.items():
+            if done_results.get(res_org_name) == \
+                    normalize_params(res_org_params):
+                continue
+
+            if get_res_org_method(res_org_name).uses_data_to_score:
+                return True
+
+    return False
+
+
+# If `force` is True, the rankings of the outlier detection algorithms saved by
+# a previous run are ignored, and all the algorithms and results organization
+# methods are run again.
+def start(config_file: str, out_dir: str, log_file=None, seed=1234,
+          force=False):
     if not os.path.exists(config_file):
         print('[ERROR] Configuration file not found: %s' %
               os.path.abspath(config_file))
@@ -89,6 +218,11 @@ def start(config_file: str, out_dir: str, log_file=None, seed=1234):
             logger.text(f'Created out_dir: '
                         f'{os.path.abspath(config.out_dir)}')
 
+    # Fail before any data is loaded if the worker processes of
+    # run_od_algs_parallel() would run the calling script again
+    if config.n_jobs > 1 and len(config.outlier_detection) > 1:
+        check_main_guard()
+
     # Configure tensorflow
     os.environ['CUDA_VISIBLE_DEVICES'] = '0'
     os.environ['TF_FORCE_GPU_ALLOW_GROWTH'] = 'True'
@@ -98,22 +232,44 @@ def start(config_file: str, out_dir: str, log_file=None, seed=1234):
     # Register all ranking algorithms supported
     register_od_algs()
 
+    # Only run the results organization methods if the rankings of all the
+    # algorithms were saved by a previous run
+    ranking_keys = get_ranking_keys(config, seed)
+    if not force and not need_features(config, ranking_keys):
+        print('Reusing the saved rankings of all outlier detection algorithms')
+        for alg_name, alg_params in config.outlier_detection.items():
+            outlier_alg = get_alg_by_name(alg_name)
+            outlier_alg.run(None, None, None, config.out_dir, config.results,
+                            config.top_n, logger, seed, config.dtype,
+                            ranking_keys[alg_name], **alg_params)
+        return
+
     # Get data loader
     data_loader = get_data_loader_by_name(config.data_loader['name'])
 
-    # Read data_to_fit (dtf)
-    print('Loading data_to_fit')
-    dtf_dict = data_loader.load(config.data_to_fit,
-                                **config.data_loader['params'])
+    # Get the on-disk feature cache
+    cache = None
+    if config.cache_dir is not None:
+        cache = FeatureCache(config.cache_dir, config.cache_max_size_mb,
+                             logger)
 
-    # Read data_to_score (dts)
-    print('Loading data_to_score')
-    dts_dict = data_loader.load(config.data_to_score,
-                                **config.data_loader['params'])
+    # Read data_to_fit (dtf) and extract features
+    print('Loading data_to_fit')
+    dtf_ids, dtf_features = load_features(data_loader, config.data_to_fit,
+                                          config, cache)
 
-    # Feature extraction
-    dtf_features = extract_feature(dtf_dict, config.features)
-    dts_features = extract_feature(dts_dict, config.features)
+    # Read data_to_score (dts) and extract features. If data_to_score is the
+    # same source as data_to_fit, the loaded features are shared rather than
+    # loaded a second time.
+    if is_same_source(config.data_to_fit, config.data_to_score):
+        print('data_to_score is the same as data_to_fit. Reusing the features '
+              'of data_to_fit')
+        dts_ids, dts_features = dtf_ids, dtf_features
+    else:
+        print('Loading data_to_score')
+        dts_ids, dts_features = load_features(data_loader,
+                                              config.data_to_score, config,
+                                              cache)
     if logger:
         logger.text(f'data_to_fit dimension (row x column): '
                     f'{dtf_features.shape[0]} x {dtf_features.shape[1]}')
@@ -121,17 +277,174 @@ def start(config_file: str, out_dir: str, log_file=None, seed=1234):
                     f'{dts_features.shape[0]} x {dts_features.shape[1]}')
 
     # zscore normalization
+    scaler = None
     if config.zscore_normalization:
-        dtf_features, dts_features = z_score_normalize(dtf_features,
-                                                       dts_features)
+        if dtf_features is None:
+            scaler = fit_z_score_scaler(dts_features, config.zscore_chunk_size)
+        else:
+            scaler = fit_z_score_scaler(dtf_features, config.zscore_chunk_size)
+        dtf_features, dts_features = z_score_normalize(
+            dtf_features, dts_features, config.zscore_chunk_size,
+            config.memmap_dir, scaler)
+
+    # Settings saved with the model of each algorithm, which are needed to
+    # score new data with it (see dora_score.py)
+    model_info = None
+    if config.save_models:
+        model_info = get_model_info(config, scaler)
+
+    # Convert the features for outlier detection once, rather than once per
+    # algorithm
+    dtf_features, dts_features = prepare_features(dtf_features, dts_features,
+                                                  config.dtype)
 
     # Outlier detection
+    if config.n_jobs > 1 and len(config.outlier_detection) > 1:
+        run_od_algs_parallel(dtf_features, dts_features, dts_ids, config,
+                             log_file, seed, ranking_keys, force, model_info)
+        return
+
     for alg_name, alg_params in tqdm(config.outlier_detection.items(),
                                      desc='Outlier detection'):
         outlier_alg = get_alg_by_name(alg_name)
-        outlier_alg.run(dtf_features, dts_features, dts_dict['id'],
+        outlier_alg.run(dtf_features, dts_features, dts_ids,
                         config.out_dir, config.results, config.top_n, logger,
-                        seed, **alg_params)
+                        seed, config.dtype, ranking_keys[alg_name], force,
+                        model_info, config.score_chunk_size,
+                        config.save_all_scores, **alg_params)
+
+
+# State of an outlier detection worker process (see init_od_worker())
+WORKER_STATE = {}
+
+
+# Run the outlier detection algorithms in parallel, in a pool of
+# `config.n_jobs` worker processes. The features are saved once as .npy files
+# in `config.memmap_dir` (or `config.out_dir`), and each worker opens them as
+# read-only memmaps instead of receiving a copy. Each algorithm runs its
+# results organization methods in the worker as soon as it finishes.
+def run_od_algs_parallel(dtf, dts, dts_ids, config, log_file, seed,
+                         ranking_keys, force=False, model_info=None):
+    tmp_parent = config.memmap_dir or config.out_dir
+    with tempfile.TemporaryDirectory(dir=tmp_parent) as tmp_dir:
+        dts_file = os.path.join(tmp_dir, 'dts.npy')
+        np.save(dts_file, dts, allow_pickle=False)
+        if dtf is None:
+            dtf_file = None
+        elif dtf is dts:
+            dtf_file = dts_file
+        else:
+            dtf_file = os.path.join(tmp_dir, 'dtf.npy')
+            np.save(dtf_file, dtf, allow_pickle=False)
+
+        # Only the settings needed to run the algorithms are sent to the
+        # workers
+        run_args = (config.out_dir, config.results, config.top_n, seed,
+                    config.dtype, force, model_info, config.score_chunk_size,
+                    config.save_all_scores)
+        tasks = [(alg_name, alg_params, ranking_keys[alg_name], dtf_file,
+                  dts_file, dts_ids, run_args)
+                 for alg_name, alg_params in config.outlier_detection.items()]
+        n_workers = min(config.n_jobs, len(tasks))
+
+        # Worker processes are started with `spawn`, so that they don't
+        # inherit the state (e.g., tensorflow) of this process.
+        context = multiprocessing.get_context('spawn')
+        with context.Pool(n_workers, initializer=init_od_worker,
+                          initargs=(log_file,)) as pool:
+            for _ in tqdm(pool.imap_unordered(run_od_alg, tasks),
+                          total=len(tasks), desc='Outlier detection'):
+                pass
+
+
+# Check that the script run as `__main__` only calls start() in an
+# `if __name__ == '__main__':` block. The worker processes of
+# run_od_algs_parallel() are started with `spawn`, which imports the
+# `__main__` script in each worker: without the guard, each worker runs the
+# whole script again, and the pool never finishes. Scripts that can't be
+# parsed (e.g., interactive sessions) are not checked.
+def check_main_guard():
+    main_module = sys.modules.get('__main__')
+    main_file = getattr(main_module, '__file__', None)
+    if main_file is None:
+        return
+
+    # Find the top-level statement of `__main__` that is running
+    frame = sys._getframe()
+    while frame is not None:
+        if (frame.f_code.co_name == '<module>' and
+                frame.f_globals is vars(main_module)):
+            break
+        frame = frame.f_back
+    if frame is None:
+        return
+
+    try:
+        with open(main_file, 'r') as f:
+            tree = ast.parse(f.read())
+    except (OSError, SyntaxError, ValueError):
+        return
+
+    statements = [node for node in tree.body if node.lineno <= frame.f_lineno]
+    if len(statements) > 0 and is_main_guard(statements[-1]):
+        return
+
+    raise RuntimeError(f'n_jobs > 1 runs the outlier detection algorithms in '
+                       f'worker processes that import '
+                       f'{os.path.abspath(main_file)}. Call start() inside '
+                       f'an `if __name__ == \'__main__\':` block in this '
+                       f'script, or set n_jobs to 1.')
+
+
+# Check if an ast statement is `if __name__ == '__main__':`
+def is_main_guard(node):
+    if not isinstance(node, ast.If) or not isinstance(node.test, ast.Compare):
+        return False
+
+    test = node.test
+    if (not isinstance(test.left, ast.Name) or test.left.id != '__name__' or
+            len(test.ops) != 1 or not isinstance(test.ops[0], ast.Eq)):
+        return False
+
+    try:
+        return ast.literal_eval(test.comparators[0]) == '__main__'
+    except ValueError:
+        return False
+
+
+# Initialize an outlier detection worker process. The algorithm pool and the
+# logger are created once per process.
+def init_od_worker(log_file):
+    register_od_algs()
+
+    WORKER_STATE['logger'] = None
+    if log_file is not None:
+        WORKER_STATE['logger'] = LogUtil('dora_exp', log_file, filemode='a')
+
+
+# Run one outlier detection algorithm in a worker process. Returns the name of
+# the algorithm.
+def run_od_alg(task):
+    (alg_name, alg_params, ranking_key, dtf_file, dts_file, dts_ids,
+     run_args) = task
+    (out_dir, results, top_n, seed, dtype, force, model_info,
+     score_chunk_size, save_all_scores) = run_args
+
+    dts = np.load(dts_file, mmap_mode='r')
+    if dtf_file is None:
+        dtf = None
+    elif dtf_file == dts_file:
+        dtf = dts
+    else:
+        dtf = np.load(dtf_file, mmap_mode='r')
+
+    outlier_alg = get_alg_by_name(alg_name)
+    outlier_alg.run(dtf, dts, dts_ids, out_dir, results, top_n,
+                    WORKER_STATE['logger'], seed, dtype, ranking_key, force,
+                    model_info, score_chunk_size, save_all_scores,
+                    **alg_params)
+
+    return alg_name
 
 
 def main():
@@ -150,6 +463,11 @@ def main():
                         help='Integer used to seed the random generator '
                              'for the DORA experiment pipeline. Default is '
                              '1234.')
+    parser.add_argument('--force', action='store_true',
+                        help='Run all the outlier detection algorithms and '
+                             'results organization methods again, even if '
+                             'their outputs were saved by a previous run '
+                             'with the same data and parameters.')
 
     args = parser.parse_args()
     start(**vars(args))
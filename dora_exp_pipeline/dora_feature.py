@@ -3,7 +3,9 @@
 #
 # Steven Lu, June 29, 2020
 
+import tempfile
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 from tqdm import tqdm
 from skimage import transform
 from six import add_metaclass
@@ -25,22 +27,90 @@ def register_extractor(extractor_obj):
                            'FeatureExtractor')
 
 
-# z-score normalization
-def z_score_normalize(dtf, dts):
-    scaler = StandardScaler()
+# z-score normalization. If `dtf` and `dts` are the same array, it is only
+# normalized once and the result is shared. If `chunk_size` is specified, the
+# normalization is done in chunks of `chunk_size` rows (see
+# z_score_normalize_chunked()). If `scaler` is specified, the data is
+# normalized with it (e.g., a scaler saved with a model to score new data).
+# Otherwise, a scaler is fitted to `dtf` (or `dts` if `dtf` is None).
+def z_score_normalize(dtf, dts, chunk_size=None, memmap_dir=None,
+                      scaler=None):
+    if scaler is None:
+        scaler = fit_z_score_scaler(dts if dtf is None else dtf, chunk_size)
+
+    if chunk_size is not None:
+        return z_score_normalize_chunked(dtf, dts, scaler, chunk_size,
+                                         memmap_dir)
 
     if dtf is None:
-        scaler.fit(dts)
         ret_dtf = None
     else:
-        scaler.fit(dtf)
         ret_dtf = scaler.transform(dtf)
 
-    ret_dts = scaler.transform(dts)
+    if dts is dtf:
+        ret_dts = ret_dtf
+    else:
+        ret_dts = scaler.transform(dts)
 
     return ret_dtf, ret_dts
 
 
+# Function to fit a StandardScaler for z-score normalization to `data`. If
+# `chunk_size` is specified, the mean and variance are computed with
+# StandardScaler.partial_fit() over chunks of `chunk_size` rows, so that the
+# peak memory doesn't grow with the size of the data.
+def fit_z_score_scaler(data, chunk_size=None):
+    scaler = StandardScaler()
+
+    if chunk_size is None:
+        scaler.fit(data)
+    else:
+        for start in range(0, len(data), chunk_size):
+            scaler.partial_fit(data[start:start + chunk_size])
+
+    return scaler
+
+
+# Chunked z-score normalization with a fitted StandardScaler. The data is
+# normalized chunk by chunk in place, so that the peak memory doesn't grow
+# with the size of the data. Arrays that can't be normalized in place
+# (read-only arrays, e.g., memmaps of cached features, and arrays of integer
+# types) are normalized into a new float64 array, which is a memmap in
+# `memmap_dir` if it is specified.
+def z_score_normalize_chunked(dtf, dts, scaler, chunk_size, memmap_dir=None):
+    ret_dts = normalize_in_place(dts, scaler, chunk_size, memmap_dir)
+    if dtf is None:
+        ret_dtf = None
+    elif dtf is dts:
+        ret_dtf = ret_dts
+    else:
+        ret_dtf = normalize_in_place(dtf, scaler, chunk_size, memmap_dir)
+
+    return ret_dtf, ret_dts
+
+
+# Function to normalize `data` with a fitted StandardScaler, chunk by chunk.
+# Returns `data` itself if it can be normalized in place, or a new array.
+def normalize_in_place(data, scaler, chunk_size, memmap_dir=None):
+    if (np.issubdtype(data.dtype, np.floating) and
+            data.flags['WRITEABLE']):
+        ret_data = data
+    elif memmap_dir is not None:
+        ret_data = np.memmap(tempfile.TemporaryFile(dir=memmap_dir),
+                             dtype=np.float64, mode='w+', shape=data.shape)
+    else:
+        ret_data = np.empty(data.shape, dtype=np.float64)
+
+    for start in range(0, len(data), chunk_size):
+        chunk = ret_data[start:start + chunk_size]
+        if ret_data is not data:
+            chunk[:] = data[start:start + chunk_size]
+        chunk -= scaler.mean_
+        chunk /= scaler.scale_
+
+    return ret_data
+
+
 # Function to get the feature extractor by name
 def get_feature_extractor_by_name(feature_name):
     ret_feature_extractor = None
@@ -56,20 +126,121 @@ def get_feature_extractor_by_name(feature_name):
     return ret_feature_extractor
 
 
-def extract_feature(data_dict, features_dict):
+# Function to extract the features in `features_dict` from the data in
+# `data_dict`. The features are of `dtype` (float64 by default), also when
+# the data is of an integer type (e.g., uint8 images). If there is more than
+# one feature extractor, or the features must be converted to `dtype`, the
+# output width of each extractor is computed first, and each extractor writes
+# its features into a column slice of one preallocated matrix of `dtype`, so
+# that no intermediate matrix of another data type is created. The extractors
+# run concurrently in a pool of `n_jobs` threads.
+def extract_feature(data_dict, features_dict, progress_bar=True, dtype=None,
+                    n_jobs=1):
     if data_dict is None:
         return None
 
-    ret_features = np.empty((len(data_dict['data']), 0))
+    dtype = np.dtype(dtype or np.float64)
+    data = data_dict['data']
+    extractors = [(get_feature_extractor_by_name(method_name), method_params)
+                  for method_name, method_params in features_dict.items()]
+
+    # If there is only one feature extractor and the data is already of
+    # `dtype`, its output is used as-is to avoid copying the feature matrix.
+    if len(extractors) == 1 and isinstance(data, np.ndarray) and \
+            data.dtype == dtype:
+        extractor, method_params = extractors[0]
+        features = extractor.extract(data, **method_params)
+
+        return features.astype(dtype, copy=False)
+
+    # Extractors that can't compute their output width up front are run first,
+    # and their output is copied into the matrix.
+    widths = []
+    outputs = []
+    for extractor, method_params in extractors:
+        width = extractor.get_output_width(data, **method_params)
+        if width is None:
+            output = extractor.extract(data, **method_params)
+            width = output.shape[1]
+        else:
+            output = None
+        widths.append(width)
+        outputs.append(output)
+
+    ret_features = np.empty((len(data), sum(widths)), dtype=dtype)
+    col_ends = np.cumsum(widths)
+    col_slices = [ret_features[:, end - width:end]
+                  for width, end in zip(widths, col_ends)]
+
+    def extract_into(ind):
+        extractor, method_params = extractors[ind]
+        if outputs[ind] is None:
+            extractor.extract_into(data, col_slices[ind], **method_params)
+        else:
+            col_slices[ind][:] = outputs[ind]
+
+    with tqdm(total=len(extractors), desc='Feature extraction',
+              disable=not progress_bar) as pbar:
+        if n_jobs == 1:
+            for ind in range(len(extractors)):
+                extract_into(ind)
+                pbar.update()
+        else:
+            with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+                for _ in executor.map(extract_into, range(len(extractors))):
+                    pbar.update()
+
+    return ret_features
 
-    for method_name, method_params in tqdm(features_dict.items(),
-                                           desc='Feature extraction'):
-        extractor = get_feature_extractor_by_name(method_name)
-        features = extractor.extract(data_dict['data'], **method_params)
 
-        ret_features = np.concatenate((ret_features, features), axis=1)
+# Function to extract features from an iterator of data blocks (see
+# DataLoader.iter_blocks()). Each block goes through feature extraction as
+# soon as it is read, so only one block of raw data is held in memory at a
+# time. If `memmap_dir` is specified, the features are appended to a temporary
+# file in `memmap_dir` and returned as a memmap, so that the peak memory is
+# bounded by the block size. See extract_feature() for `dtype` and `n_jobs`.
+# Returns the ids and the features.
+def extract_feature_blocks(blocks, features_dict, memmap_dir=None, dtype=None,
+                           n_jobs=1):
+    ids_list = []
+    features_list = []
+    out_file = None
+    n_rows = 0
+
+    for block in tqdm(blocks, desc='Feature extraction'):
+        features = extract_feature(block, features_dict, progress_bar=False,
+                                   dtype=dtype, n_jobs=n_jobs)
+        ids_list.append(block['id'])
+        n_rows += len(features)
+
+        if memmap_dir is None:
+            features_list.append(features)
+            continue
+
+        if out_file is None:
+            out_file = tempfile.TemporaryFile(dir=memmap_dir)
+            dtype = features.dtype
+            n_cols = features.shape[1]
+        np.ascontiguousarray(features, dtype=dtype).tofile(out_file)
+
+    if len(ids_list) == 0:
+        return None, None
+
+    if len(ids_list) == 1:
+        ids = ids_list[0]
+    else:
+        ids = np.concatenate(ids_list)
+
+    if out_file is not None:
+        out_file.flush()
+        ret_features = np.memmap(out_file, dtype=dtype, mode='r+',
+                                 shape=(n_rows, n_cols))
+    elif len(features_list) == 1:
+        ret_features = features_list[0]
+    else:
+        ret_features = np.concatenate(features_list, axis=0)
 
-    return ret_features
+    return ids, ret_features
 
 
 @add_metaclass(ABCMeta)
@@ -84,11 +255,24 @@ class FeatureExtractor(object):
             return False
 
     # Sub-class must implement this function to extract features.
-    # `data` must be a list of numpy arrays, and `kwargs` must be a dictionary.
+    # `data` must be a list of numpy arrays or a 2-D numpy array, and `kwargs`
+    # must be a dictionary.
     @abstractmethod
     def extract(self, data, **kwargs):
         raise RuntimeError('This function must be implemented by sub-class.')
 
+    # Sub-class should implement this function to return the number of
+    # features extracted from each item of `data`, without extracting them.
+    # Returns None if the width is unknown until the features are extracted.
+    def get_output_width(self, data, **kwargs):
+        return None
+
+    # Extract features from `data` into `out`, a preallocated 2-D array (or
+    # a column slice of one) with one row per item. Sub-class should override
+    # this function to write the features without an intermediate matrix.
+    def extract_into(self, data, out, **kwargs):
+        out[:] = self.extract(data, **kwargs)
+
 
 # Feature extractor for extracting raw pixel values and then flatten the pixels
 # into a vector.
@@ -97,46 +281,74 @@ class FlattenedPixelValuesExtractor(FeatureExtractor):
         super(FlattenedPixelValuesExtractor, self).__init__(
             'flattened_pixel_values')
 
-    def extract(self, data_cube, **kwargs):
-        do_resizing = False
-        if 'width' in kwargs.keys():
-            width = int(kwargs['width'])
-            do_resizing = True
-
-        if 'height' in kwargs.keys():
-            height = int(kwargs['height'])
-            do_resizing = True
-
-        # Get data dimension from the first item in the data cube
+    # Get the height, width, and number of channels of the flattened images
+    # from the first item in the data cube. The height and width are the
+    # `height` and `width` parameters if the images are resized.
+    def get_image_shape(self, data_cube, **kwargs):
         if len(data_cube[0].shape) == 2:  # grayscale
             rows, cols = data_cube[0].shape
             channels = 1
         elif len(data_cube[0].shape) == 3:  # color
             rows, cols, channels = data_cube[0].shape
 
-        if do_resizing:
-            ret_features = np.zeros((len(data_cube),
-                                    height * width * channels),
-                                    dtype=np.uint8)
+        if 'width' in kwargs.keys():
+            cols = int(kwargs['width'])
+
+        if 'height' in kwargs.keys():
+            rows = int(kwargs['height'])
+
+        return rows, cols, channels
+
+    def get_output_width(self, data_cube, **kwargs):
+        rows, cols, channels = self.get_image_shape(data_cube, **kwargs)
+
+        return rows * cols * channels
+
+    def extract(self, data_cube, **kwargs):
+        rows, cols, channels = self.get_image_shape(data_cube, **kwargs)
+
+        # Images resized by the data loader (see ImageLoader) are already
+        # stacked in an array of the target size, so they are flattened
+        # without another copy.
+        if (isinstance(data_cube, np.ndarray) and
+                data_cube.shape[1:3] == (rows, cols)):
+            ret_features = data_cube.reshape(len(data_cube), -1)
+            if ret_features.dtype != np.uint8:
+                ret_features = ret_features.astype(np.uint8)
         else:
-            ret_features = np.zeros((len(data_cube),
-                                    rows * cols * channels),
+            ret_features = np.zeros((len(data_cube), rows * cols * channels),
                                     dtype=np.uint8)
-
-        for ind, data in enumerate(data_cube):
-            if do_resizing:
-                ret_features[ind, :] = transform.resize(
-                    data, (height, width), anti_aliasing=True,
-                    preserve_range=True
-                ).flatten()
-            else:
-                ret_features[ind, :] = data.flatten()
+            self.fill_pixels(data_cube, ret_features, rows, cols)
 
         if kwargs.get('normalize_pixels'):
             ret_features = ret_features / 255.
 
         return ret_features
 
+    def extract_into(self, data_cube, out, **kwargs):
+        rows, cols, _ = self.get_image_shape(data_cube, **kwargs)
+
+        if (isinstance(data_cube, np.ndarray) and
+                data_cube.shape[1:3] == (rows, cols)):
+            out[:] = data_cube.reshape(len(data_cube), -1).astype(
+                np.uint8, copy=False)
+        else:
+            self.fill_pixels(data_cube, out, rows, cols)
+
+        if kwargs.get('normalize_pixels'):
+            out /= 255.
+
+    # Write the flattened pixel values of each image in the data cube into a
+    # row of `out`, resizing the images that are not `rows` x `cols`. The
+    # pixel values are converted to uint8.
+    def fill_pixels(self, data_cube, out, rows, cols):
+        for ind, data in enumerate(data_cube):
+            if data.shape[:2] != (rows, cols):
+                data = transform.resize(data, (rows, cols),
+                                        anti_aliasing=True,
+                                        preserve_range=True)
+            out[ind, :] = data.flatten().astype(np.uint8)
+
 
 # Register flattened pixel values extractor into the feature extractor pool
 flattened_pixel_values_extractor = FlattenedPixelValuesExtractor()
@@ -150,7 +362,15 @@ class RawValuesExtractor(FeatureExtractor):
             'raw_values')
 
     def extract(self, data_cube, **kwargs):
-        return np.array(data_cube)
+        # np.asarray() doesn't copy if the data loader already returned a 2-D
+        # numpy array.
+        return np.asarray(data_cube)
+
+    def get_output_width(self, data_cube, **kwargs):
+        return len(data_cube[0])
+
+    def extract_into(self, data_cube, out, **kwargs):
+        out[:] = data_cube
 
 
 # Register flattened pixel values extractor into the feature extractor pool
@@ -11,6 +11,7 @@ import numpy as np
 import rasterio as rio
 from sklearn.cluster import KMeans
 from sklearn_som.som import SOM
+from dora_exp_pipeline.dora_data_loader import ids_to_str
 
 
 METHOD_POOL = []
@@ -43,6 +44,10 @@ def register_org_method(org_method):
 
 @add_metaclass(ABCMeta)
 class ResultsOrganization(object):
+    # Whether the method uses the features of data_to_score. Methods that
+    # don't can be run on a saved ranking without loading the data again.
+    uses_data_to_score = False
+
     def __init__(self, method_name):
         self.method_name = method_name
 
@@ -77,6 +82,7 @@ class SaveScoresCSV(ResultsOrganization):
 
         out_file = open(f'{out_dir}/selections-{outlier_alg_name}.csv', 'w')
 
+        data_ids = ids_to_str(data_ids)
         for ind, (s_ind, dts_id, score) in enumerate(zip(dts_sels, data_ids,
                                                          dts_scores)):
             out_file.write(f'{ind}, {s_ind}, {dts_id}, {score}\n')
@@ -99,6 +105,7 @@ class SaveComparisonPlot(ResultsOrganization):
 
         # Outliers will be 1s and inliers will be 0s.
         labels = self._get_validation_labels(validation_dir)
+        data_ids = ids_to_str(data_ids)
 
         x = list(range(1, len(labels)+1))
         y = []
@@ -142,6 +149,8 @@ register_org_method(save_comparison_plot)
 
 
 class KmeansCluster(ResultsOrganization):
+    uses_data_to_score = True
+
     def __init__(self):
         super(KmeansCluster, self).__init__('kmeans')
 
@@ -166,6 +175,7 @@ class KmeansCluster(ResultsOrganization):
         kmeans = KMeans(n_clusters=n_clusters, random_state=seed)
         groups = kmeans.fit_predict(data_to_cluster)
 
+        data_ids = ids_to_str(data_ids)
         for ind, (s_ind, dts_id, group) in enumerate(zip(dts_sels, data_ids,
                                                          groups)):
             out_file.write(f'{ind}, {s_ind}, {dts_id}, {group}\n')
@@ -178,6 +188,8 @@ register_org_method(kmeans_cluster)
 
 
 class SOMCluster(ResultsOrganization):
+    uses_data_to_score = True
+
     def __init__(self):
         super(SOMCluster, self).__init__('som')
 
@@ -199,6 +211,7 @@ class SOMCluster(ResultsOrganization):
         som.fit(data_to_cluster)
         groups = som.predict(data_to_cluster)
 
+        data_ids = ids_to_str(data_ids)
         for ind, (s_ind, dts_id, group) in enumerate(zip(dts_sels, data_ids,
                                                          groups)):
             out_file.write(f'{ind}, {s_ind}, {dts_id}, {group}\n')
@@ -232,22 +245,19 @@ class ReshapeRaster(ResultsOrganization):
             # Check that top_n wasn't specified to be a subset of the pixels
             if top_n != (height*width):
                 raise RuntimeError('Cannot use top_n with ReshapeRaster')
-            # Reorder scores to be in original index order, not sorted by score
-            scores = [s for _, s in sorted(zip(data_ids, dts_scores),
-                                           key=lambda pair: pair[0])]
-            scores = np.reshape(np.array(scores), [height, width])
+            # Put the scores back in original pixel order, not sorted by
+            # score. The ids are the pixel indices.
+            scores = np.zeros(height * width)
+            scores[np.asarray(data_ids, dtype=int)] = dts_scores
+            scores = np.reshape(scores, [height, width])
         elif data_format == 'patches':
             # Check that top_n wasn't specified to be a subset of the pixels
             if top_n != ((height-(patch_size-1))*(width-(patch_size-1))):
                 raise RuntimeError('Cannot use top_n with ReshapeRaster')
+            # The ids are the (row, col) patch center coordinates
+            coords = np.asarray(data_ids, dtype=int)
             scores = np.zeros([height, width])
-            for ex, idx in enumerate(data_ids):
-                # get the patch center coordinates
-                i, j = idx.split('-')
-                i = int(i)
-                j = int(j)
-                # fill in the score for that index
-                scores[i, j] = dts_scores[ex]
+            scores[coords[:, 0], coords[:, 1]] = dts_scores
         else:
             raise RuntimeError("data_format must be 'pixels' or 'patches'")
 
@@ -277,7 +287,7 @@ class SaveHistogram(ResultsOrganization):
         super(SaveHistogram, self).__init__('histogram')
 
     def _run(self, data_ids, dts_scores, dts_sels, data_to_score, alg_name,
-             out_dir, logger, seed, bins):
+             out_dir, logger, seed, top_n, bins):
         if(not(os.path.exists(out_dir))):
             os.makedirs(out_dir)
 
@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# Entry script to score new data with the model of an outlier detection
+# algorithm saved by the DORA experiment pipeline (see the `save_models` option
+# of the config file). The data is loaded, its features are extracted and
+# normalized with the settings saved with the model, and it is scored without
+# fitting the model again. See copyright notice at the end.
+
+import os
+import sys
+from dora_exp_pipeline.dora_data_loader import get_data_loader_by_name
+from dora_exp_pipeline.dora_exp import register_od_algs
+from dora_exp_pipeline.dora_feature import extract_feature_blocks
+from dora_exp_pipeline.dora_feature import z_score_normalize
+from dora_exp_pipeline.dora_results_organization import get_res_org_method
+from dora_exp_pipeline.outlier_detection import get_alg_by_name
+from dora_exp_pipeline.outlier_detection import load_model
+from dora_exp_pipeline.outlier_detection import prepare_features
+from dora_exp_pipeline.outlier_detection import rank_scores
+from dora_exp_pipeline.util import LogUtil
+
+
+# Score the data at `data_to_score` with the model saved in `model_file`, and
+# run the results organization methods saved with the model on the ranking.
+# The results are saved in the sub directory of the algorithm in `out_dir`.
+# If `top_n` is not specified, the top_n saved with the model is used.
+def start(model_file: str, data_to_score: str, out_dir: str, log_file=None,
+          seed=None, top_n=None):
+    if not os.path.exists(data_to_score):
+        print('[ERROR] data_to_score not found: %s' %
+              os.path.abspath(data_to_score))
+        sys.exit(1)
+
+    logger = None
+    if log_file is not None:
+        logger = LogUtil('dora_score', log_file)
+
+    model_dict = load_model(model_file)
+    if logger:
+        logger.text(f'Loaded the model of outlier detection algorithm '
+                    f'{model_dict["alg_name"]} from '
+                    f'{os.path.abspath(model_file)}')
+
+    if seed is None:
+        seed = model_dict['seed']
+
+    if top_n is None:
+        top_n = model_dict['top_n']
+
+    register_od_algs()
+    outlier_alg = get_alg_by_name(model_dict['alg_name'])
+
+    # Read data_to_score (dts) and extract features
+    print('Loading data_to_score')
+    data_loader = get_data_loader_by_name(model_dict['data_loader']['name'])
+    params = data_loader.get_params(model_dict['data_loader']['params'],
+                                    model_dict['dtype'])
+    blocks = data_loader.iter_blocks(data_to_score, **params)
+    dts_ids, dts_features = extract_feature_blocks(blocks,
+                                                   model_dict['features'],
+                                                   dtype=model_dict['dtype'])
+    if dts_features is None:
+        raise RuntimeError(f'No data found in {os.path.abspath(data_to_score)}')
+
+    if logger:
+        logger.text(f'data_to_score dimension (row x column): '
+                    f'{dts_features.shape[0]} x {dts_features.shape[1]}')
+
+    # zscore normalization with the scaler fitted to data_to_fit
+    if model_dict['scaler'] is not None:
+        _, dts_features = z_score_normalize(None, dts_features,
+                                            model_dict['zscore_chunk_size'],
+                                            scaler=model_dict['scaler'])
+
+    _, dts_features = prepare_features(None, dts_features, model_dict['dtype'])
+
+    # Score and rank data_to_score
+    scores = outlier_alg.score(model_dict['model'], dts_features)
+    results = rank_scores(scores, dts_ids, top_n, outlier_alg.rank_descending)
+
+    if not os.path.exists(out_dir):
+        os.mkdir(out_dir)
+        if logger:
+            logger.text(f'Created out_dir: {os.path.abspath(out_dir)}')
+
+    sub_dir = outlier_alg.get_sub_dir(out_dir, model_dict['alg_params'])
+    if not os.path.exists(sub_dir):
+        os.mkdir(sub_dir)
+
+    # Run results organization methods
+    for res_org_name, res_org_params in model_dict['results'].items():
+        res_org_method = get_res_org_method(res_org_name)
+        res_org_method.run(results['dts_ids'], results['scores'],
+                           results['sel_ind'], dts_features,
+                           model_dict['alg_name'], sub_dir, logger, seed,
+                           len(results['sel_ind']), **res_org_params)
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Score new data with a model '
+                                                 'saved by the DORA Experiment '
+                                                 'Pipeline')
+
+    parser.add_argument('model_file', type=str,
+                        help='Path to a model file (model.pkl) saved in the '
+                             'sub directory of an outlier detection algorithm')
+    parser.add_argument('data_to_score', type=str,
+                        help='Path to the data to score')
+    parser.add_argument('out_dir', type=str,
+                        help='Output directory')
+    parser.add_argument('-l', '--log_file', type=str,
+                        help='Log file. This is optional. If enabled, a log '
+                             'file will be saved. ')
+    parser.add_argument('--seed', type=int,
+                        help='Integer used to seed the random generator of '
+                             'the results organization methods. Default is '
+                             'the seed the model was fitted with.')
+    parser.add_argument('--top_n', type=int,
+                        help='Number of top ranked items to save. Default is '
+                             'the top_n of the config file the model was '
+                             'fitted with.')
+
+    args = parser.parse_args()
+    start(**vars(args))
+
+
+if __name__ == '__main__':
+    main()
+
+
+# Copyright (c) 2021 California Institute of Technology ("Caltech").
+# U.S. Government sponsorship acknowledged.
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+# - Redistributions of source code must retain the above copyright notice,
+#   this list of conditions and the following disclaimer.
+# - Redistributions in binary form must reproduce the above copyright notice,
+#   this list of conditions and the following disclaimer in the documentation
+#   and/or other materials provided with the distribution.
+# - Neither the name of Caltech nor its operating division, the Jet Propulsion
+#   Laboratory, nor the names of its contributors may be used to endorse or
+#   promote products derived from this software without specific prior written
+#   permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS "AS IS"
+# AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE
+# IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE
+# FOR ANY DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL
+# DAMAGES (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR
+# SERVICES; LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY,
+# OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE
+# OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
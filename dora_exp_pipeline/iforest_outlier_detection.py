@@ -1,51 +1,48 @@
 import numpy as np
-from copy import deepcopy
 from sklearn.ensemble import IsolationForest
 from dora_exp_pipeline.outlier_detection import OutlierDetection
 
 
 class IForestOutlierDetection(OutlierDetection):
+    # Lower isolation forest scores are more anomalous
+    rank_descending = False
+
     def __init__(self):
         super(IForestOutlierDetection, self).__init__('iforest')
 
     def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
                        top_n, seed, n_trees, fit_single_trees):
-        if data_to_fit is None:
-            data_to_fit = deepcopy(data_to_score)
-
-        if not fit_single_trees:
-            scores = train_and_run_ISO(data_to_fit, data_to_score,
-                                       n_trees, seed)
-        else:
-            scores = single_tree_ISO(data_to_fit, data_to_score,
-                                     n_trees, seed)
-        selection_indices = np.argsort(scores)
-
-        results = dict()
-        results.setdefault('scores', list())
-        results.setdefault('sel_ind', list())
-        results.setdefault('dts_ids', list())
-        for ind in selection_indices[:top_n]:
-            results['scores'].append(scores[ind])
-            results['sel_ind'].append(ind)
-            results['dts_ids'].append(data_to_score_ids[ind])
+        results, _ = self._fit_and_rank(data_to_fit, data_to_score,
+                                        data_to_score_ids, top_n, seed,
+                                        n_trees=n_trees,
+                                        fit_single_trees=fit_single_trees)
 
         return results
 
+    # The model is a list of isolation forests. If `fit_single_trees` is
+    # True, it has `n_trees` forests of a single tree each, and the score of
+    # an item is the mean of the scores of all the forests.
+    def _fit(self, data_to_fit, seed, n_trees, fit_single_trees):
+        if not fit_single_trees:
+            return [train_ISO(data_to_fit, n_trees, seed)]
 
-def single_tree_ISO(train, test, n_trees, seed):
+        random_state = np.random.RandomState(seed)
 
-    random_state = np.random.RandomState(seed)
-    scores = np.empty((test.shape[0], n_trees))
+        return [train_ISO(data_to_fit, 1, random_state.randint(0, 1000000))
+                for _ in range(n_trees)]
+
+    def _score(self, model, data_to_score):
+        if len(model) == 1:
+            return model[0].decision_function(data_to_score)
 
-    for i in range(n_trees):
-        scores[:, i] = train_and_run_ISO(train, test, 1,
-                                         random_state.randint(0, 1000000))
+        scores = np.empty((data_to_score.shape[0], len(model)))
+        for i, clf_iso in enumerate(model):
+            scores[:, i] = clf_iso.decision_function(data_to_score)
 
-    return np.mean(scores, axis=1)
+        return np.mean(scores, axis=1)
 
 
-def train_and_run_ISO(train, test, n_trees, seed):
+def train_ISO(train, n_trees, seed):
     random_state = np.random.RandomState(seed)
 
     # initialize isolation forest
@@ -55,10 +52,7 @@ def train_and_run_ISO(train, test, n_trees, seed):
     # train isolation forest
     clf_iso.fit(train)
 
-    # novelty scores of the test items
-    scores_iso = clf_iso.decision_function(test)
-
-    return scores_iso
+    return clf_iso
 
 
 # Copyright (c) 2021 California Institute of Technology ("Caltech").
@@ -10,6 +10,7 @@
 import numpy as np
 from tqdm import tqdm
 from dora_exp_pipeline.outlier_detection import OutlierDetection
+from dora_exp_pipeline.outlier_detection import rank_scores
 
 
 class LocalRXOutlierDetection(OutlierDetection):
@@ -25,18 +26,7 @@ class LocalRXOutlierDetection(OutlierDetection):
         scores, vis = get_LRX_scores(data_to_score, inner_window, outer_window,
                                      bands)
 
-        selection_indices = np.argsort(scores)[::-1]
-
-        results = dict()
-        results.setdefault('scores', list())
-        results.setdefault('sel_ind', list())
-        results.setdefault('dts_ids', list())
-        for ind in selection_indices[:top_n]:
-            results['scores'].append(scores[ind])
-            results['sel_ind'].append(ind)
-            results['dts_ids'].append(data_to_score_ids[ind])
-
-        return results
+        return rank_scores(scores, data_to_score_ids, top_n)
 
 
 # Local RX (LRX)
@@ -12,7 +12,6 @@
 
 import numpy as np
 from tqdm import tqdm
-from copy import deepcopy
 from dora_exp_pipeline.outlier_detection import OutlierDetection
 from sklearn.model_selection import KFold
 from sklearn.model_selection import GridSearchCV
@@ -26,28 +25,18 @@ class NegativeSamplingOutlierDetection(OutlierDetection):
 
     def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
                        top_n, seed, percent_increase):
-        if percent_increase < 0 or percent_increase > 100:
-            raise RuntimeError('percent_increase parameter must be a number '
-                               'between 0 and 100.')
-
-        scores = self._rank_targets(data_to_fit, data_to_score,
-                                    percent_increase, seed)
-        selection_indices = np.argsort(scores)[::-1]
-
-        results = dict()
-        results.setdefault('scores', list())
-        results.setdefault('sel_ind', list())
-        results.setdefault('dts_ids', list())
-        for ind in selection_indices[:top_n]:
-            results['scores'].append(scores[ind])
-            results['sel_ind'].append(ind)
-            results['dts_ids'].append(data_to_score_ids[ind])
+        results, _ = self._fit_and_rank(data_to_fit, data_to_score,
+                                        data_to_score_ids, top_n, seed,
+                                        percent_increase=percent_increase)
 
         return results
 
-    def _rank_targets(self, positive_train, data_test, percent_increase, seed):
-        if positive_train is None:
-            positive_train = deepcopy(data_test)
+    # The model is a random forest classifier trained to separate data_to_fit
+    # (positive examples) from generated negative examples.
+    def _fit(self, positive_train, seed, percent_increase):
+        if percent_increase < 0 or percent_increase > 100:
+            raise RuntimeError('percent_increase parameter must be a number '
+                               'between 0 and 100.')
 
         random_state = np.random.RandomState(seed)
 
@@ -85,8 +74,11 @@ class NegativeSamplingOutlierDetection(OutlierDetection):
                                         random_state=random_state)
         rf_clf.fit(x, y)
 
+        return rf_clf
+
+    def _score(self, model, data_to_score):
         # Make predictions for test data
-        probs = rf_clf.predict_proba(data_test)
+        probs = model.predict_proba(data_to_score)
 
         # Keeping only the probabilities for negative (novel) class, and use
         # them as novelty scores to rank selections
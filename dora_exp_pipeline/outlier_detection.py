@@ -4,12 +4,27 @@
 # May 21, 2021
 
 import os
+import pickle
+import warnings
 import numpy as np
 from six import add_metaclass
 from abc import ABCMeta
 from abc import abstractmethod
 from dora_exp_pipeline.util import LogUtil
 from dora_exp_pipeline.dora_results_organization import get_res_org_method
+from dora_exp_pipeline.dora_cache import save_ranking
+from dora_exp_pipeline.dora_cache import save_ranking_manifest
+from dora_exp_pipeline.dora_cache import load_ranking
+from dora_exp_pipeline.dora_cache import normalize_params
+
+
+# Name of the file in which the fitted model of an algorithm is saved (see
+# OutlierDetection.run())
+MODEL_FILE = 'model.pkl'
+
+# Name of the file in which the scores of all the items of data_to_score are
+# saved (see OutlierDetection.run())
+SCORES_FILE = 'all_scores.npy'
 
 
 def register_od_alg(ranking_alg):
@@ -35,11 +50,204 @@ def get_alg_by_name(alg_name):
     return ret_ranking_alg
 
 
+# Function to convert the features to `dtype` (float32 by default) once for
+# all the outlier detection algorithms. Features that are already of `dtype`
+# are not copied, and if `dtf` and `dts` are the same array, it is only
+# converted once. Returns read-only views of the features, so that an
+# algorithm that modifies its input fails instead of changing the input of
+# the next algorithm.
+def prepare_features(dtf, dts, dtype=None):
+    dtype = np.dtype(dtype or np.float32)
+
+    # Don't try to convert strings (i.e. filenames) to float32
+    if dts.dtype.type is not np.str_:
+        # If dtf and dts are the same array, only convert it once
+        if dtf is dts:
+            dtf = dts = dts.astype(dtype, copy=False)
+        else:
+            if dtf is not None:
+                dtf = dtf.astype(dtype, copy=False)
+            dts = dts.astype(dtype, copy=False)
+
+    if dtf is dts:
+        dtf = dts = read_only_view(dts)
+    else:
+        dtf = read_only_view(dtf)
+        dts = read_only_view(dts)
+
+    return dtf, dts
+
+
+# Function to get a read-only view of an array. The array itself stays
+# writeable.
+def read_only_view(data):
+    if data is None or not data.flags['WRITEABLE']:
+        return data
+
+    ret_data = data.view()
+    ret_data.flags['WRITEABLE'] = False
+
+    return ret_data
+
+
+# Function to rank the items of data_to_score by their scores, and return the
+# scores, indices, and ids of the `top_n` highest scoring items (or lowest
+# scoring items if `descending` is False) as numpy arrays, in the results
+# format expected by OutlierDetection.run(). Tied scores are ranked in the
+# order of the items in data_to_score. If `top_n` is less than the number of
+# items, the top_n items are found with select_top_n() and only they are
+# sorted, so the ranking is the first top_n items of the full ranking.
+def rank_scores(scores, dts_ids, top_n, descending=True) -> dict:
+    scores = np.asarray(scores)
+    n_items = len(scores)
+    if top_n is None or top_n > n_items:
+        top_n = n_items
+
+    if top_n < n_items:
+        sel_ind = select_top_n(scores, top_n, descending)
+    else:
+        sel_ind = np.arange(n_items)
+
+    sel_ind = sel_ind[stable_order(scores[sel_ind], descending)]
+
+    return select_results(scores[sel_ind], sel_ind, dts_ids)
+
+
+# Function to sort `scores` in descending (or ascending) order with a stable
+# sort, so that tied scores keep their order. Returns the sorting indices.
+def stable_order(scores, descending=True):
+    if not descending:
+        return np.argsort(scores, kind='stable')
+
+    # The reverse of the stable ascending sort of the reversed scores
+    n_items = len(scores)
+    return n_items - 1 - np.argsort(scores[::-1], kind='stable')[::-1]
+
+
+# Function to find the indices of the `top_n` highest scores (or lowest scores
+# if `descending` is False) with np.partition(), which doesn't sort the
+# scores. Scores tied with the top_n-th score are selected from the lowest
+# index, as in rank_scores(). Returns the indices in ascending order.
+def select_top_n(scores, top_n, descending=True):
+    n_items = len(scores)
+    if top_n >= n_items:
+        return np.arange(n_items)
+    elif top_n <= 0:
+        return np.empty(0, dtype=np.intp)
+
+    if descending:
+        kth = np.partition(scores, n_items - top_n)[n_items - top_n]
+        better = scores > kth
+    else:
+        kth = np.partition(scores, top_n - 1)[top_n - 1]
+        better = scores < kth
+
+    tied = np.flatnonzero(scores == kth)
+    n_tied = top_n - np.count_nonzero(better)
+    if n_tied < 0 or n_tied > len(tied):
+        # NaN scores are not ordered by comparisons
+        return np.sort(stable_order(scores, descending)[:top_n])
+
+    better[tied[:n_tied]] = True
+
+    return np.flatnonzero(better)
+
+
+# Function to rank the items of data_to_score from their scores computed chunk
+# by chunk, in the results format of rank_scores(). `score_chunks` is an
+# iterable of the scores of consecutive chunks of items. Only the `top_n` best
+# scores seen so far and their indices are kept between chunks, so the memory
+# used doesn't grow with the number of items. If `scores_out` (e.g., a memmap
+# with one element per item) is specified, the scores of each chunk are also
+# written to it. The selected items and their order are the same as those of
+# rank_scores() on all the scores.
+def rank_score_chunks(score_chunks, dts_ids, top_n, descending=True,
+                      scores_out=None) -> dict:
+    best_scores = None
+    best_ind = np.empty(0, dtype=np.intp)
+    start = 0
+    for chunk_scores in score_chunks:
+        chunk_scores = np.asarray(chunk_scores)
+        end = start + len(chunk_scores)
+        if scores_out is not None:
+            scores_out[start:end] = chunk_scores
+
+        if best_scores is None:
+            best_scores = chunk_scores
+        else:
+            best_scores = np.concatenate((best_scores, chunk_scores))
+        best_ind = np.concatenate((best_ind, np.arange(start, end)))
+
+        # Keep the top_n best scores, in index order, so that tied scores
+        # are selected as in rank_scores()
+        if top_n is not None and len(best_scores) > top_n:
+            keep_ind = select_top_n(best_scores, top_n, descending)
+            best_scores = best_scores[keep_ind]
+            best_ind = best_ind[keep_ind]
+
+        start = end
+
+    if best_scores is None:
+        best_scores = np.empty(0)
+
+    # Sort the kept scores. The `dts_ids` of the ranked candidates are their
+    # indices in data_to_score.
+    results = rank_scores(best_scores, best_ind, top_n, descending)
+
+    return select_results(results['scores'], results['dts_ids'], dts_ids)
+
+
+# Function to create the results of an outlier detection algorithm from the
+# scores and indices of the selected items, in order of selection. The ids of
+# the selected items are looked up in `dts_ids`.
+def select_results(sel_scores, sel_ind, dts_ids) -> dict:
+    sel_ind = np.asarray(sel_ind, dtype=np.intp)
+    if isinstance(dts_ids, np.ndarray):
+        sel_ids = dts_ids[sel_ind]
+    else:
+        sel_ids = np.array([dts_ids[ind] for ind in sel_ind])
+
+    return {
+        'scores': np.asarray(sel_scores),
+        'sel_ind': sel_ind,
+        'dts_ids': sel_ids
+    }
+
+
+# Function to save the fitted `model` of an outlier detection algorithm, with
+# the pipeline settings in `model_info` that are needed to score new data with
+# it (see dora_score.py).
+def save_model(model_file: str, model, model_info: dict) -> None:
+    model_dict = dict(model_info)
+    model_dict['model'] = model
+    with open(model_file, 'wb') as f:
+        pickle.dump(model_dict, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+# Function to load a model saved with save_model(). Returns the dictionary of
+# the pipeline settings, in which `model` is the fitted model.
+def load_model(model_file: str) -> dict:
+    if not os.path.exists(model_file):
+        raise RuntimeError(f'Model file not found: '
+                           f'{os.path.abspath(model_file)}')
+
+    with open(model_file, 'rb') as f:
+        return pickle.load(f)
+
+
 @add_metaclass(ABCMeta)
 class OutlierDetection(object):
 
     algorithm_pool = []
 
+    # Whether higher scores are more anomalous. The items are ranked by
+    # descending scores if True, and by ascending scores otherwise.
+    rank_descending = True
+
+    # Whether the model returned by _fit() can be pickled, so that it can be
+    # saved (see can_save_model())
+    model_picklable = True
+
     def __init__(self, ranking_alg_name):
         self._ranking_alg_name = ranking_alg_name
 
@@ -49,42 +257,222 @@ class OutlierDetection(object):
         else:
             return False
 
+    # `dtype` is the data type the features are converted to before they are
+    # passed to the algorithm (see prepare_features()). Features that were
+    # already prepared are neither converted nor copied again.
+    #
+    # If `ranking_key` is specified, the ranking is saved in the algorithm sub
+    # directory, and a ranking saved with the same key by a previous run is
+    # reused instead of running the algorithm again (unless `force` is True).
+    # The results organization methods that were already run on a reused
+    # ranking with the same parameters are skipped. `dtf` and `dts` may be
+    # None if the ranking is reused and none of the results organization
+    # methods that are run use data_to_score.
+    #
+    # If `model_info` is specified, the model fitted to data_to_fit is saved
+    # with `model_info` (see save_model()) in the algorithm sub directory, so
+    # that new data can be scored without fitting it again.
+    #
+    # If `score_chunk_size` is specified, data_to_score is scored in chunks of
+    # `score_chunk_size` items (see score_chunk()), and only the top_n best
+    # scores are kept in memory, so that a memory-mapped data_to_score is
+    # never loaded in memory at once. If `save_all_scores` is True, the scores
+    # of all the items are written chunk by chunk to a `.npy` file in the
+    # algorithm sub directory. Both options are only supported by the
+    # algorithms that can score data in chunks (see can_score_chunks()).
     def run(self, dtf: np.ndarray, dts: np.ndarray, dts_ids: list, out_dir: str,
             results_org_dict: dict, top_n: int, logger: LogUtil, seed: int,
-            **kwargs) -> None:
-        # Don't try to convert strings (i.e. filenames) to float32
-        if dts.dtype.type is not np.str_:
-            if dtf is not None:
-                dtf = dtf.astype(np.float32)
-            dts = dts.astype(np.float32)
+            dtype=None, ranking_key=None, force=False, model_info=None,
+            score_chunk_size=None, save_all_scores=False, **kwargs) -> None:
+        sub_dir = self.get_sub_dir(out_dir, kwargs)
+        saved_ranking = None
+        if ranking_key is not None and not force:
+            saved_ranking = load_ranking(sub_dir, ranking_key)
 
-        if top_n is None:
-            top_n = len(dts)
+        if dts is not None:
+            dtf, dts = prepare_features(dtf, dts, dtype)
 
-        if top_n > len(dts):
-            raise RuntimeError('top_n must be greater than or equal to the '
-                               'number of items in data_to_score')
+        model = None
+        if saved_ranking is None:
+            if top_n is None:
+                top_n = len(dts)
 
-        # Run outlier detection algorithm
-        results = self._rank_internal(dtf, dts, dts_ids, top_n, seed, **kwargs)
+            if top_n > len(dts):
+                raise RuntimeError('top_n must be greater than or equal to '
+                                   'the number of items in data_to_score')
 
-        # Create algorithm specific sub directory
-        kwargs_string = OutlierDetection.dict_to_str(kwargs)
-        sub_dir = os.path.join(out_dir, self._ranking_alg_name + kwargs_string)
-        if not os.path.exists(sub_dir):
-            os.mkdir(sub_dir)
+            use_chunks = score_chunk_size is not None or save_all_scores
+            if use_chunks and not self.can_score_chunks(dts):
+                warnings.warn(f'Outlier detection algorithm '
+                              f'{self._ranking_alg_name} does not support '
+                              f'scoring data in chunks')
+                use_chunks = False
+
+            # Run outlier detection algorithm
+            if use_chunks:
+                scores_file = None
+                if save_all_scores:
+                    self._make_sub_dir(sub_dir, logger)
+                    scores_file = os.path.join(sub_dir, SCORES_FILE)
+                results, model = self._fit_and_rank(
+                    dtf, dts, dts_ids, top_n, seed,
+                    score_chunk_size=score_chunk_size or len(dts),
+                    scores_file=scores_file, **kwargs)
+                if scores_file is not None and logger:
+                    logger.text(f'Saved the scores of outlier detection '
+                                f'algorithm {self._ranking_alg_name} to '
+                                f'{os.path.abspath(scores_file)}')
+                if model_info is None or not self.can_save_model():
+                    model = None
+            elif model_info is not None and self.can_save_model():
+                results, model = self._fit_and_rank(dtf, dts, dts_ids, top_n,
+                                                    seed, **kwargs)
+            else:
+                if model_info is not None:
+                    warnings.warn(f'Outlier detection algorithm '
+                                  f'{self._ranking_alg_name} does not support '
+                                  f'saving models')
+                results = self._rank_internal(dtf, dts, dts_ids, top_n, seed,
+                                              **kwargs)
+            done_results = dict()
+        else:
+            results, done_results = saved_ranking
+            top_n = len(results['sel_ind'])
             if logger:
-                logger.text(f'Created sub directory for outlier detection '
-                            f'algorithm {self._ranking_alg_name} at '
+                logger.text(f'Reused the ranking of outlier detection '
+                            f'algorithm {self._ranking_alg_name} saved in '
                             f'{os.path.abspath(sub_dir)}')
 
+        # Create algorithm specific sub directory
+        self._make_sub_dir(sub_dir, logger)
+
+        if saved_ranking is None and model is not None:
+            model_file = os.path.join(sub_dir, MODEL_FILE)
+            model_info = dict(model_info, alg_name=self._ranking_alg_name,
+                              alg_params=kwargs, seed=seed)
+            save_model(model_file, model, model_info)
+            if logger:
+                logger.text(f'Saved the model of outlier detection algorithm '
+                            f'{self._ranking_alg_name} to '
+                            f'{os.path.abspath(model_file)}')
+
+        if ranking_key is not None and saved_ranking is None:
+            save_ranking(sub_dir, ranking_key, results, done_results)
+
         # Run results organization methods
         for res_org_name, res_org_params in results_org_dict.items():
+            params = normalize_params(res_org_params)
+            if done_results.get(res_org_name) == params:
+                if logger:
+                    logger.text(f'Skipped results organization method '
+                                f'{res_org_name} for outlier detection '
+                                f'algorithm {self._ranking_alg_name}, because '
+                                f'its parameters did not change')
+                continue
+
             res_org_method = get_res_org_method(res_org_name)
             res_org_method.run(results['dts_ids'], results['scores'],
                                results['sel_ind'], dts, self._ranking_alg_name,
                                sub_dir, logger, seed, top_n, **res_org_params)
 
+            if ranking_key is not None:
+                done_results[res_org_name] = params
+                save_ranking_manifest(sub_dir, ranking_key, done_results)
+
+    def _make_sub_dir(self, sub_dir: str, logger: LogUtil) -> None:
+        if not os.path.exists(sub_dir):
+            os.mkdir(sub_dir)
+            if logger:
+                logger.text(f'Created sub directory for outlier detection '
+                            f'algorithm {self._ranking_alg_name} at '
+                            f'{os.path.abspath(sub_dir)}')
+
+    # Check if the algorithm implements _fit() and _score() and its model can
+    # be pickled, so that its model can be saved and used to score new data.
+    def can_save_model(self) -> bool:
+        return self.can_score_chunks() and self.model_picklable
+
+    # Check if the algorithm implements _fit() and _score(), so that
+    # data_to_score can be scored in chunks with score_chunk(). Data that
+    # isn't numeric (e.g., a list of image files) can't be scored in chunks.
+    def can_score_chunks(self, data_to_score=None) -> bool:
+        if data_to_score is not None and \
+                data_to_score.dtype.type is np.str_:
+            return False
+
+        return type(self)._fit is not OutlierDetection._fit
+
+    # Fit the model of the algorithm to data_to_fit, score data_to_score with
+    # it, and rank the items of data_to_score. If `score_chunk_size` is
+    # specified, data_to_score is scored chunk by chunk (see
+    # rank_score_chunks()), and the scores of all the items are saved in
+    # `scores_file` if it is specified. Returns the results (see
+    # rank_scores()) and the model.
+    def _fit_and_rank(self, data_to_fit, data_to_score, data_ids, top_n, seed,
+                      score_chunk_size=None, scores_file=None, **kwargs):
+        if data_to_fit is None:
+            # The data is not modified, so data_to_score is used without a
+            # copy
+            data_to_fit = data_to_score
+
+        model = self._fit(data_to_fit, seed, **kwargs)
+        if score_chunk_size is None:
+            scores = self._score(model, data_to_score)
+            results = rank_scores(scores, data_ids, top_n,
+                                  self.rank_descending)
+
+            return results, model
+
+        n_items = len(data_to_score)
+        score_chunks = (self.score_chunk(model,
+                                         data_to_score[i:i + score_chunk_size])
+                        for i in range(0, n_items, score_chunk_size))
+        scores_out = None
+        if scores_file is not None:
+            scores_out = np.lib.format.open_memmap(
+                scores_file, mode='w+', dtype=np.float64, shape=(n_items,))
+        results = rank_score_chunks(score_chunks, data_ids, top_n,
+                                    self.rank_descending, scores_out)
+        if scores_out is not None:
+            scores_out.flush()
+            del scores_out
+
+        return results, model
+
+    # Score a chunk of consecutive items of data_to_score with a model
+    # returned by _fit(). The score of an item doesn't depend on the other
+    # items, so scoring data_to_score chunk by chunk gives the same scores as
+    # scoring it at once.
+    def score_chunk(self, model, block: np.ndarray) -> np.ndarray:
+        return self._score(model, block)
+
+    # Score data_to_score with a model returned by _fit(). Returns one score
+    # per item.
+    def score(self, model, data_to_score: np.ndarray) -> np.ndarray:
+        if not self.can_save_model():
+            raise RuntimeError(f'Outlier detection algorithm '
+                               f'{self._ranking_alg_name} does not support '
+                               f'scoring with a saved model')
+
+        return self._score(model, data_to_score)
+
+    # Fit the model of the algorithm to data_to_fit. Algorithms that can score
+    # new data with a saved model override this function and _score(). The
+    # model must be picklable.
+    def _fit(self, data_to_fit, seed, **kwargs):
+        raise RuntimeError('This function must be implemented in the child '
+                           'class to save models.')
+
+    def _score(self, model, data_to_score):
+        raise RuntimeError('This function must be implemented in the child '
+                           'class to save models.')
+
+    # Get the sub directory of `out_dir` in which the results of the algorithm
+    # run with `params` are saved.
+    def get_sub_dir(self, out_dir: str, params: dict) -> str:
+        return os.path.join(out_dir, self._ranking_alg_name +
+                            OutlierDetection.dict_to_str(params))
+
     @staticmethod
     def dict_to_str(params_dict: dict()) -> str:
         """ Convert a dictionary of parameters to a string representation. Note
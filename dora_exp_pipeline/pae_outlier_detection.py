@@ -12,12 +12,12 @@
 # Date created: August 16, 2021
 
 from dora_exp_pipeline.outlier_detection import OutlierDetection
+from dora_exp_pipeline.outlier_detection import rank_scores
 import os
 import math
 import numpy as np
 from PIL import Image
 from itertools import accumulate
-from copy import deepcopy
 import tensorflow as tf
 import tensorflow_addons as tfa
 from tensorflow import keras
@@ -37,50 +37,64 @@ class PAEOutlierDetection(OutlierDetection):
                        val_split=0.25, optimizer='adam', log_dir=None,
                        use_flow=True):
         if data_to_fit is None:
-            data_to_fit = deepcopy(data_to_score)
-
-        if latent_dim < 1:
-            raise RuntimeError('The dimensionality of the latent space must be '
-                               '>= 1')
+            data_to_fit = data_to_score
 
         # Autoencoder used in convolutional mode if list of images passed in
-        if is_list_of_images(data_to_fit):
-            sample_shape = get_image_dimensions(data_to_fit)
-            train_fn = train_and_run_conv_PAE
-        else:
-            sample_shape = data_to_fit.shape[1]
-            train_fn = train_and_run_PAE
-
-        num_features = np.prod(sample_shape)
-        if latent_dim > num_features:
-            raise RuntimeError(f'The dimensionality of the latent space'
-                               f'(latent_dim = {latent_dim}) '
-                               f'must be <= number of features '
-                               f'({num_features})')
+        if not is_list_of_images(data_to_fit):
+            results, _ = self._fit_and_rank(
+                data_to_fit, data_to_score, data_to_score_ids, top_n, seed,
+                latent_dim=latent_dim, max_epochs=max_epochs,
+                patience=patience, val_split=val_split, optimizer=optimizer,
+                log_dir=log_dir, use_flow=use_flow)
+
+            return results
+
+        sample_shape = get_image_dimensions(data_to_fit)
+        check_latent_dim(latent_dim, sample_shape)
 
         # Set seed
         tf.random.set_seed(seed)
 
         # Rank targets
-        scores = train_fn(data_to_fit, data_to_score, latent_dim,
-                          sample_shape, seed, max_epochs, patience, val_split,
-                          optimizer, log_dir, use_flow)
-        selection_indices = np.argsort(scores)[::-1]
+        scores = train_and_run_conv_PAE(data_to_fit, data_to_score,
+                                        latent_dim, sample_shape, seed,
+                                        max_epochs, patience, val_split,
+                                        optimizer, log_dir, use_flow)
+        return rank_scores(scores, data_to_score_ids, top_n)
+
+    # The model is a PAEModel. Only feature vectors are supported; lists of
+    # images are ranked by _rank_internal().
+    def _fit(self, data_to_fit, seed, latent_dim, max_epochs=1000,
+             patience=10, val_split=0.25, optimizer='adam', log_dir=None,
+             use_flow=True):
+        num_features = data_to_fit.shape[1]
+        check_latent_dim(latent_dim, num_features)
+
+        # Set seed
+        tf.random.set_seed(seed)
+
+        return train_PAE(data_to_fit, latent_dim, num_features, max_epochs,
+                         patience, val_split, optimizer, log_dir, use_flow)
+
+    def _score(self, model, data_to_score):
+        return score_PAE(model, data_to_score)
 
-        results = dict()
-        results.setdefault('scores', list())
-        results.setdefault('sel_ind', list())
-        results.setdefault('dts_ids', list())
-        for ind in selection_indices[:top_n]:
-            results['scores'].append(scores[ind])
-            results['sel_ind'].append(ind)
-            results['dts_ids'].append(data_to_score_ids[ind])
 
-        return results
+def check_latent_dim(latent_dim, sample_shape):
+    if latent_dim < 1:
+        raise RuntimeError('The dimensionality of the latent space must be '
+                           '>= 1')
 
+    num_features = np.prod(sample_shape)
+    if latent_dim > num_features:
+        raise RuntimeError(f'The dimensionality of the latent space'
+                           f'(latent_dim = {latent_dim}) '
+                           f'must be <= number of features '
+                           f'({num_features})')
 
-def train_and_run_PAE(train, test, latent_dim, num_features, seed, max_epochs,
-                      patience, val_split, optimizer, log_dir, use_flow):
+
+def train_PAE(train, latent_dim, num_features, max_epochs, patience,
+              val_split, optimizer, log_dir, use_flow):
     # Train autoencoder
     autoencoder = Autoencoder(latent_dim, num_features)
     autoencoder.compile(optimizer=optimizer, loss=losses.MeanSquaredError())
@@ -88,9 +102,9 @@ def train_and_run_PAE(train, test, latent_dim, num_features, seed, max_epochs,
                     callbacks=make_tf_callbacks(
                         'Autoencoder training', patience, log_dir),
                     validation_split=val_split)
-    encoded_test = autoencoder.encoder(test).numpy()
 
     # Train flow
+    flow = None
     if use_flow:
         encoded_train = autoencoder.encoder(train).numpy()
         flow = NormalizingFlow(latent_dim)
@@ -101,12 +115,19 @@ def train_and_run_PAE(train, test, latent_dim, num_features, seed, max_epochs,
                  callbacks=make_tf_callbacks('Flow training', patience,
                                              log_dir),
                  validation_split=val_split)
-        trained_dist = flow.dist(np.zeros(0,))
-        log_probs = trained_dist.log_prob(encoded_test).numpy()
+
+    return PAEModel(latent_dim, num_features, autoencoder, flow)
+
+
+def score_PAE(model, test):
+    encoded_test = model.autoencoder.encoder(test).numpy()
+
+    if model.trained_dist is not None:
+        log_probs = model.trained_dist.log_prob(encoded_test).numpy()
         scores = np.negative(log_probs)
     # Use reconstruction error
     else:
-        pred = autoencoder.decoder(encoded_test).numpy()
+        pred = model.autoencoder.decoder(encoded_test).numpy()
         scores = [mean_squared_error(y_true, y_pred) for y_true, y_pred in
                   zip(test, pred)]
 
@@ -346,6 +367,46 @@ class NormalizingFlow(Model):
         return self.dist(x)
 
 
+# Model of the PAE algorithm: the trained autoencoder, and the trained flow if
+# `use_flow` is True (or None otherwise). Keras models can't be pickled, so
+# the model is pickled as the constructor parameters and the weights of the
+# autoencoder and the flow, and both are rebuilt from them when the model is
+# unpickled (see save_model() and load_model()).
+class PAEModel(object):
+    def __init__(self, latent_dim, num_features, autoencoder, flow=None):
+        self.latent_dim = latent_dim
+        self.num_features = num_features
+        self.autoencoder = autoencoder
+        self.flow = flow
+        self.trained_dist = None
+        if flow is not None:
+            self.trained_dist = flow.dist(np.zeros(0,))
+
+    def __getstate__(self):
+        flow_weights = None
+        if self.flow is not None:
+            flow_weights = self.flow.get_weights()
+
+        return {
+            'latent_dim': self.latent_dim,
+            'num_features': self.num_features,
+            'autoencoder_weights': self.autoencoder.get_weights(),
+            'flow_weights': flow_weights
+        }
+
+    def __setstate__(self, state):
+        autoencoder = Autoencoder(state['latent_dim'], state['num_features'])
+        autoencoder.set_weights(state['autoencoder_weights'])
+
+        flow = None
+        if state['flow_weights'] is not None:
+            flow = NormalizingFlow(state['latent_dim'])
+            flow.set_weights(state['flow_weights'])
+
+        self.__init__(state['latent_dim'], state['num_features'],
+                      autoencoder, flow)
+
+
 # Copyright (c) 2021 California Institute of Technology ("Caltech").
 # U.S. Government sponsorship acknowledged.
 # All rights reserved.
@@ -1,5 +1,4 @@
 import numpy as np
-from copy import deepcopy
 from sklearn.decomposition import PCA
 from dora_exp_pipeline.outlier_detection import OutlierDetection
 
@@ -10,9 +9,12 @@ class PCAOutlierDetection(OutlierDetection):
 
     def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
                        top_n, seed, k):
-        if data_to_fit is None:
-            data_to_fit = deepcopy(data_to_score)
+        results, _ = self._fit_and_rank(data_to_fit, data_to_score,
+                                        data_to_score_ids, top_n, seed, k=k)
 
+        return results
+
+    def _fit(self, data_to_fit, seed, k):
         if k < 1:
             raise RuntimeError('The number of principal components (k) must '
                                'be >= 1')
@@ -23,30 +25,20 @@ class PCAOutlierDetection(OutlierDetection):
                                f'must be < number of features '
                                f'({data_to_fit.shape[1]})')
 
-        # Rank targets
-        scores = train_and_run_PCA(data_to_fit, data_to_score, k, seed)
-        selection_indices = np.argsort(scores)[::-1]
+        return fit_PCA(data_to_fit, k, seed)
 
-        results = dict()
-        results.setdefault('scores', list())
-        results.setdefault('sel_ind', list())
-        results.setdefault('dts_ids', list())
-        for ind in selection_indices[:top_n]:
-            results['scores'].append(scores[ind])
-            results['sel_ind'].append(ind)
-            results['dts_ids'].append(data_to_score_ids[ind])
-
-        return results
+    def _score(self, model, data_to_score):
+        return compute_score(data_to_score, model)
 
 
-def train_and_run_PCA(train, test, k, seed):
+def fit_PCA(train, k, seed):
     # initialize the PCA model (deterministically)
     pca = PCA(n_components=k, random_state=seed)
 
     # fit the PCA model
     pca.fit(train)
 
-    return compute_score(test, pca)
+    return pca
 
 
 def compute_score(images, pca):
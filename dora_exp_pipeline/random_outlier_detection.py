@@ -11,6 +11,7 @@
 
 import numpy as np
 from dora_exp_pipeline.outlier_detection import OutlierDetection
+from dora_exp_pipeline.outlier_detection import select_results
 
 
 class RandomOutlierDetection(OutlierDetection):
@@ -20,25 +21,14 @@ class RandomOutlierDetection(OutlierDetection):
     def _random(self, data_to_fit, data_to_score, data_to_score_ids, top_n,
                 seed):
         # Random ranking
-        indices = list(range(0, data_to_score.shape[0]))
         random_state = np.random.RandomState(seed)
-        random_state.shuffle(indices)
+        sel_ind = random_state.permutation(data_to_score.shape[0])[:top_n]
 
-        # This interprets the indices as the scores so when
-        # the scores are sorted later they will have the
+        # All the items have a score of 0, so the selections are in the
         # random order.
-        scores = list(np.zeros(data_to_score.shape[0], dtype=float))
+        scores = np.zeros(len(sel_ind), dtype=float)
 
-        results = dict()
-        results.setdefault('scores', list())
-        results.setdefault('sel_ind', list())
-        results.setdefault('dts_ids', list())
-        for ind in indices[:top_n]:
-            results['scores'].append(scores[ind])
-            results['sel_ind'].append(ind)
-            results['dts_ids'].append(data_to_score_ids[ind])
-
-        return results
+        return select_results(scores, sel_ind, data_to_score_ids)
 
     def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
                        top_n, seed):
@@ -12,7 +12,6 @@
 
 import warnings
 import numpy as np
-from copy import deepcopy
 from tqdm import tqdm
 from dora_exp_pipeline.outlier_detection import OutlierDetection
 
@@ -23,27 +22,26 @@ class RXOutlierDetection(OutlierDetection):
 
     def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
                        top_n, seed):
-        if data_to_fit is None:
-            data_to_fit = deepcopy(data_to_score)
+        results, _ = self._fit_and_rank(data_to_fit, data_to_score,
+                                        data_to_score_ids, top_n, seed)
 
-        scores = get_RX_scores(data_to_fit, data_to_score)
-        selection_indices = np.argsort(scores)[::-1]
+        return results
 
-        results = dict()
-        results.setdefault('scores', list())
-        results.setdefault('sel_ind', list())
-        results.setdefault('dts_ids', list())
-        for ind in selection_indices[:top_n]:
-            results['scores'].append(scores[ind])
-            results['sel_ind'].append(ind)
-            results['dts_ids'].append(data_to_score_ids[ind])
+    # The model is the mean and the inverse covariance matrix of the
+    # background (data_to_fit)
+    def _fit(self, data_to_fit, seed):
+        return compute_bg(data_to_fit)
 
-        return results
+    def _score(self, model, data_to_score):
+        mu, cov = model
+
+        return compute_score(data_to_score, mu, cov)
 
 
 def compute_bg(train_images):
-    # compute mean image
-    mu = np.mean(train_images, axis=0)
+    # compute mean image. The mean and the covariance matrix are accumulated
+    # in float64 even if the images are float32.
+    mu = np.mean(train_images, axis=0, dtype=np.float64)
     # compute the covariance matrix for training images
     if train_images.shape[0] < train_images.shape[1]:
         warnings.warn('There are fewer image samples than features. '
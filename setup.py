@@ -27,12 +27,17 @@ setup(
         'tensorflow-addons==0.13.0',
         'sklearn-som==1.1.0'
     ],
+    extras_require={
+        # Faster CSV parsing in the data loaders
+        'arrow': ['pyarrow']
+    },
     provide=[
         'dora_exp_pipeline'
     ],
     entry_points={
         'console_scripts': [
-            'dora_exp = dora_exp_pipeline.dora_exp:main'
+            'dora_exp = dora_exp_pipeline.dora_exp:main',
+            'dora_score = dora_exp_pipeline.dora_score:main'
         ]
     },
     include_package_data=True
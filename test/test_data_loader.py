@@ -0,0 +1,434 @@
+#!/usr/bin/env python
+# Tests for the data loaders in the data loading module.
+
+import os
+import csv
+import tempfile
+from unittest import TestCase, skipIf
+import numpy as np
+import pandas as pd
+import yaml
+import rasterio as rio
+from dora_exp_pipeline.dora_data_loader import get_data_loader_by_name
+from dora_exp_pipeline.dora_data_loader import extract_patches
+from dora_exp_pipeline.dora_data_loader import ids_to_str
+from dora_exp_pipeline.dora_data_loader import pa
+from dora_exp_pipeline.dora_data_loader import collect_rows
+from dora_exp_pipeline.dora_data_loader import iter_csv_chunks
+from dora_exp_pipeline.dora_feature import extract_feature
+from dora_exp_pipeline.dora_config import DoraConfig
+from dora_exp_pipeline.dora_exp import load_features
+
+
+class TestImageLoader(TestCase):
+
+    def setUp(self):
+
+        self.loader = get_data_loader_by_name('image')
+        self.image_dir = 'sample_data/planetary_rover/png/images'
+
+    def test_parallel_load(self):
+
+        serial = self.loader.load(self.image_dir)
+
+        for pool_type in ['thread', 'process']:
+            parallel = self.loader.load(self.image_dir, n_workers=3,
+                                        pool_type=pool_type)
+
+            # The ids must be in the same order as the serial path
+            assert parallel['id'] == serial['id']
+            for s_data, p_data in zip(serial['data'], parallel['data']):
+                assert np.array_equal(s_data, p_data)
+
+    def test_resized_load(self):
+
+        serial = self.loader.load(self.image_dir)
+        correct_features = extract_feature(
+            serial, {'flattened_pixel_values': {'width': 10, 'height': 10}},
+            progress_bar=False)
+
+        for n_workers in [1, 3]:
+            resized = self.loader.load(self.image_dir, n_workers=n_workers,
+                                       width=10, height=10)
+            assert resized['id'] == serial['id']
+            assert resized['data'].shape == (len(serial['id']), 10, 10)
+
+            # Resizing while decoding is close to resizing the full images
+            features = extract_feature(
+                resized,
+                {'flattened_pixel_values': {'width': 10, 'height': 10}},
+                progress_bar=False)
+            assert features.shape == correct_features.shape
+            assert np.abs(features.astype(float) -
+                          correct_features).mean() < 2
+
+        # Images already at the target size are not resampled
+        resized = self.loader.load(self.image_dir, width=64, height=64)
+        assert np.array_equal(resized['data'], np.stack(serial['data']))
+
+
+# Write a small GeoTIFF with blocks smaller than the raster: strips of 3 rows,
+# or tiles of 16 x 16 pixels. The sample GeoTIFF is a single block, so it is
+# read in one tile for any tile_rows.
+def write_blocked_rasters(dir_path):
+    data = np.random.RandomState(1234).randint(
+        0, 1000, size=(2, 37, 23)).astype(np.uint16)
+    profiles = {
+        'striped.tif': {'tiled': False, 'blockysize': 3},
+        'tiled.tif': {'tiled': True, 'blockxsize': 16, 'blockysize': 16}
+    }
+
+    file_paths = []
+    for file_name, profile in profiles.items():
+        file_path = os.path.join(dir_path, file_name)
+        with rio.open(file_path, 'w', driver='GTiff', width=data.shape[2],
+                      height=data.shape[1], count=data.shape[0],
+                      dtype=data.dtype, **profile) as dst:
+            dst.write(data)
+        file_paths.append(file_path)
+
+    return file_paths
+
+
+class TestRasterPatchLoader(TestCase):
+
+    def setUp(self):
+
+        self.loader = get_data_loader_by_name('raster_patches')
+        self.raster = 'sample_data/earth_volcanoes/' \
+                      'AST_08_00310252015145234_20170919180811_13210_small.tif'
+        self.tmp_dir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def test_extract_patches(self):
+
+        img = np.arange(7 * 9 * 2).reshape(7, 9, 2)
+
+        for patch_size in [1, 3, 4, 5]:
+            patches, coords = extract_patches(img, patch_size)
+
+            # Reference implementation with a nested loop over patch centers
+            w = int(patch_size / 2)
+            correct_patches = []
+            correct_coords = []
+            for i in range(w, img.shape[0] - w):
+                for j in range(w, img.shape[1] - w):
+                    patch = img[i - w:i + (w + 1), j - w:j + (w + 1)]
+                    correct_patches.append(patch.flatten())
+                    correct_coords.append((i, j))
+
+            assert np.array_equal(patches, np.array(correct_patches))
+            assert np.array_equal(coords, np.array(correct_coords))
+
+    def test_load(self):
+
+        data_dict = self.loader.load(self.raster, patch_size=5)
+
+        # The ids are the patch center coordinates
+        assert data_dict['id'].shape == (len(data_dict['data']), 2)
+        assert list(data_dict['id'][0]) == [2, 2]
+        assert ids_to_str(data_dict['id'][:1])[0] == '2-2'
+        assert data_dict['data'].shape == (len(data_dict['id']), 25)
+
+    def test_tiled_load(self):
+
+        for raster in write_blocked_rasters(self.tmp_dir.name):
+            data_dict = self.loader.load(raster, patch_size=5)
+
+            # Tiled reading must give the same patches and ids in the same
+            # order, including the patches that span the edges of the tiles
+            for tile_rows in [1, 4, 16, 100]:
+                tiled_dict = self.loader.load(raster, patch_size=5,
+                                              tile_rows=tile_rows)
+                assert np.array_equal(tiled_dict['id'], data_dict['id'])
+                assert np.array_equal(tiled_dict['data'], data_dict['data'])
+
+                blocks = list(self.loader.iter_blocks(raster, patch_size=5,
+                                                      tile_rows=tile_rows))
+                assert (len(blocks) > 1) == (tile_rows < 37)
+                assert np.array_equal(
+                    np.concatenate([block['data'] for block in blocks]),
+                    data_dict['data'])
+
+
+class TestRasterPixelLoader(TestCase):
+
+    def test_load(self):
+
+        loader = get_data_loader_by_name('raster_pixels')
+        raster = 'sample_data/earth_volcanoes/' \
+                 'AST_08_00310252015145234_20170919180811_13210_small.tif'
+
+        # The ids are the pixel indices
+        data_dict = loader.load(raster)
+        assert np.array_equal(data_dict['id'],
+                              np.arange(len(data_dict['data'])))
+
+    def test_tiled_load(self):
+
+        loader = get_data_loader_by_name('raster_pixels')
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for raster in write_blocked_rasters(tmp_dir):
+                data_dict = loader.load(raster)
+
+                for tile_rows in [1, 4, 100]:
+                    blocks = list(loader.iter_blocks(raster,
+                                                     tile_rows=tile_rows))
+                    assert (len(blocks) > 1) == (tile_rows < 37)
+
+                    tiled_dict = loader.load(raster, tile_rows=tile_rows)
+                    assert np.array_equal(tiled_dict['id'], data_dict['id'])
+                    assert np.array_equal(tiled_dict['data'],
+                                          data_dict['data'])
+
+
+class TestIdsToStr(TestCase):
+
+    def test_ids_to_str(self):
+
+        assert list(ids_to_str(['a', 'b'])) == ['a', 'b']
+        assert list(ids_to_str(np.arange(3))) == ['0', '1', '2']
+        assert list(ids_to_str(np.array([[2, 10], [3, 4]]))) == \
+            ['2-10', '3-4']
+
+
+class TestFeatureVectorLoader(TestCase):
+
+    def setUp(self):
+
+        self.loader = get_data_loader_by_name('FeatureVector')
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.data = np.random.RandomState(1234).normal(size=(100, 4))
+        self.ids = np.array([f'obj{i}' for i in range(100)])
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def test_load_npy(self):
+
+        file_path = os.path.join(self.tmp_dir.name, 'data.npy')
+        np.save(file_path, self.data)
+
+        data_dict = self.loader.load(file_path)
+        assert isinstance(data_dict['data'], np.memmap)
+        assert np.array_equal(data_dict['data'], self.data)
+        assert np.array_equal(data_dict['id'], np.arange(100))
+
+        data_dict = self.loader.load(file_path, columns=[1, 3],
+                                     dtype='float32')
+        assert data_dict['data'].dtype == np.float32
+        assert np.array_equal(data_dict['data'],
+                              self.data[:, [1, 3]].astype(np.float32))
+
+    def test_load_npz(self):
+
+        for save, memmap in [(np.savez, True),
+                             (np.savez_compressed, False)]:
+            file_path = os.path.join(self.tmp_dir.name, 'data.npz')
+            save(file_path, data=self.data, ids=self.ids)
+
+            data_dict = self.loader.load(file_path)
+            assert isinstance(data_dict['data'], np.memmap) == memmap
+            assert np.array_equal(data_dict['data'], self.data)
+            assert np.array_equal(data_dict['id'], self.ids)
+
+    @skipIf(pa is None, 'pyarrow is not installed')
+    def test_load_parquet(self):
+
+        df = pd.DataFrame(self.data, columns=['a', 'b', 'c', 'd'])
+        df['name'] = self.ids
+        file_path = os.path.join(self.tmp_dir.name, 'data.parquet')
+        df.to_parquet(file_path, row_group_size=30)
+
+        data_dict = self.loader.load(file_path, columns=['c', 'a'],
+                                     id_column='name')
+        assert np.array_equal(data_dict['id'], self.ids)
+        assert data_dict['data'].dtype == np.float64
+        assert np.array_equal(data_dict['data'], self.data[:, [2, 0]])
+
+        # Row groups are returned as separate blocks
+        blocks = list(self.loader.iter_blocks(file_path, columns=['c', 'a'],
+                                              id_column='name'))
+        assert len(blocks) == 4
+        assert np.array_equal(np.concatenate([b['id'] for b in blocks]),
+                              data_dict['id'])
+        assert np.array_equal(np.concatenate([b['data'] for b in blocks]),
+                              data_dict['data'])
+
+    @skipIf(pa is None, 'pyarrow is not installed')
+    def test_load_feather(self):
+
+        df = pd.DataFrame(self.data, columns=['a', 'b', 'c', 'd'])
+        file_path = os.path.join(self.tmp_dir.name, 'data.feather')
+        df.to_feather(file_path)
+
+        data_dict = self.loader.load(file_path, dtype='float64')
+        assert np.array_equal(data_dict['id'], np.arange(100))
+        assert np.array_equal(data_dict['data'], self.data)
+
+    def test_select_rows(self):
+
+        df = pd.DataFrame(self.data, index=self.ids,
+                          columns=['a', 'b', 'c', 'd'])
+        file_paths = [os.path.join(self.tmp_dir.name, 'data.csv'),
+                      os.path.join(self.tmp_dir.name, 'data.h5'),
+                      os.path.join(self.tmp_dir.name, 'data.npz')]
+        df.to_csv(file_paths[0], header=False)
+        df.to_hdf(file_paths[1], key='data')
+        np.savez(file_paths[2], data=self.data, ids=self.ids)
+        if pa is not None:
+            file_paths.append(os.path.join(self.tmp_dir.name,
+                                           'data.parquet'))
+            df.rename_axis('name').reset_index().to_parquet(
+                file_paths[-1], row_group_size=30)
+
+        for file_path in file_paths:
+            kwargs = {'dtype': 'float64'}
+            if file_path.endswith('.parquet'):
+                kwargs['id_column'] = 'name'
+
+            data_dict = self.loader.load(file_path, row_range=[10, 50],
+                                         max_rows=25, **kwargs)
+            assert np.array_equal(data_dict['id'], self.ids[10:35])
+            assert np.allclose(data_dict['data'], self.data[10:35])
+
+            data_dict = self.loader.load(file_path, max_rows=500, **kwargs)
+            assert np.array_equal(data_dict['id'], self.ids)
+
+            # The sample is a subset of the row range in file order, and it
+            # is the same for every file type
+            data_dict = self.loader.load(file_path, row_range=[20, 90],
+                                         sample=15, sample_seed=3, **kwargs)
+            rows = [int(i[3:]) for i in data_dict['id']]
+            assert len(rows) == 15
+            assert rows == sorted(rows)
+            assert min(rows) >= 20 and max(rows) < 90
+            assert np.allclose(data_dict['data'], self.data[rows])
+            if file_path == file_paths[0]:
+                sample_rows = rows
+            else:
+                assert rows == sample_rows
+
+    def test_empty_row_range(self):
+
+        df = pd.DataFrame(self.data, index=self.ids,
+                          columns=['a', 'b', 'c', 'd'])
+        file_paths = [os.path.join(self.tmp_dir.name, 'data.csv'),
+                      os.path.join(self.tmp_dir.name, 'data.h5'),
+                      os.path.join(self.tmp_dir.name, 'data.npz')]
+        df.to_csv(file_paths[0], header=False)
+        df.to_hdf(file_paths[1], key='data')
+        np.savez(file_paths[2], data=self.data, ids=self.ids)
+        if pa is not None:
+            file_paths.append(os.path.join(self.tmp_dir.name,
+                                           'data.parquet'))
+            df.rename_axis('name').reset_index().to_parquet(
+                file_paths[-1], row_group_size=30)
+
+        for file_path in file_paths:
+            kwargs = {'dtype': 'float64'}
+            if file_path.endswith('.parquet'):
+                kwargs['id_column'] = 'name'
+
+            for range_kwargs in [{'max_rows': 0},
+                                 {'row_range': [1, 1]},
+                                 {'row_range': [150, 200]},
+                                 {'row_range': [150, None]}]:
+                data_dict = self.loader.load(file_path, **range_kwargs,
+                                             **kwargs)
+                assert len(data_dict['id']) == 0
+                assert data_dict['data'].shape == (0, 4)
+
+    def test_sample_chunk_size(self):
+
+        file_path = os.path.join(self.tmp_dir.name, 'data.csv')
+        pd.DataFrame(self.data, index=self.ids).to_csv(file_path,
+                                                       header=False)
+
+        # The sample doesn't depend on the size of the chunks that are read
+        samples = []
+        for chunk_rows in [1, 7, 100]:
+            ids, _ = collect_rows(iter_csv_chunks(file_path, 'float32',
+                                                  chunk_rows=chunk_rows),
+                                  sample=10, sample_seed=5)
+            samples.append(list(ids))
+        assert samples[0] == samples[1] == samples[2]
+
+        ids, _ = collect_rows(iter_csv_chunks(file_path, 'float32'),
+                              sample=10, sample_seed=6)
+        assert list(ids) != samples[0]
+
+    def test_global_dtype(self):
+
+        file_path = os.path.join(self.tmp_dir.name, 'data.csv')
+        pd.DataFrame(self.data, index=self.ids).to_csv(file_path,
+                                                       header=False)
+
+        # The values are read in the dtype of the pipeline, unless the data
+        # loader params set another dtype
+        assert self.loader.get_params({}, 'float32') == {'dtype': 'float32'}
+        assert self.loader.get_params({'dtype': 'float64'}, 'float32') == \
+            {'dtype': 'float64'}
+        assert get_data_loader_by_name('image').get_params(
+            {}, 'float32') == {}
+
+        for dtype, correct_dtype in [('float64', np.float64),
+                                     ('float32', np.float32)]:
+            config_file = os.path.join(self.tmp_dir.name, 'config.yml')
+            with open(config_file, 'w') as f:
+                yaml.safe_dump({
+                    'data_loader': {'name': 'FeatureVector',
+                                    'params': {}},
+                    'data_to_fit': file_path,
+                    'data_to_score': file_path,
+                    'zscore_normalization': False,
+                    'out_dir': self.tmp_dir.name,
+                    'features': {'raw_values': {}},
+                    'top_n': 10,
+                    'outlier_detection': {'rx': {}},
+                    'results': {'save_scores': {}},
+                    'dtype': dtype
+                }, f)
+            config = DoraConfig(config_file)
+
+            ids, features = load_features(self.loader, file_path, config)
+            assert np.array_equal(ids, self.ids)
+            assert features.dtype == correct_dtype
+            assert np.array_equal(features, self.data.astype(correct_dtype))
+
+
+class TestTimeSeriesLoader(TestCase):
+
+    def setUp(self):
+
+        self.loader = get_data_loader_by_name('Time series')
+        self.csv_file = 'sample_data/earth_fieldsamples/points_to_fit.csv'
+
+    def test_load(self):
+
+        # Reference values parsed row by row with the csv module
+        correct_ids = []
+        correct_data = []
+        with open(self.csv_file, 'r') as csv_file:
+            for row in csv.reader(csv_file, quoting=csv.QUOTE_NONNUMERIC):
+                correct_ids.append(str(int(row[0])))
+                correct_data.append(row[1:])
+        correct_data = np.array(correct_data)
+
+        data_dict = self.loader.load(self.csv_file)
+        assert list(data_dict['id']) == correct_ids
+        assert data_dict['data'].dtype == np.float64
+        assert np.array_equal(data_dict['data'], correct_data)
+
+        data_dict = self.loader.load(self.csv_file, dtype='float32')
+        assert np.array_equal(data_dict['data'],
+                              correct_data.astype(np.float32))
+
+        data_dict = self.loader.load(self.csv_file, dtype='float64',
+                                     row_range=[5, 20])
+        assert list(data_dict['id']) == correct_ids[5:20]
+        assert np.array_equal(data_dict['data'], correct_data[5:20])
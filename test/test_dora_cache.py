@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# Tests for the on-disk feature cache.
+
+import os
+import sys
+import time
+import tempfile
+import importlib
+from unittest import TestCase
+import numpy as np
+from dora_exp_pipeline.dora_cache import FeatureCache
+from dora_exp_pipeline.dora_cache import get_code_hash
+
+
+class TestFeatureCache(TestCase):
+
+    def setUp(self):
+
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp_dir.name, 'cache')
+        self.data_file = os.path.join(self.tmp_dir.name, 'data.csv')
+        with open(self.data_file, 'w') as f:
+            f.write('0,1.0,2.0\n1,3.0,4.0\n')
+
+        self.data_loader = {'name': 'FeatureVector', 'params': {}}
+        self.features = {'raw_values': {}}
+
+    def tearDown(self):
+
+        self.tmp_dir.cleanup()
+
+    def test_save_load(self):
+
+        cache = FeatureCache(self.cache_dir)
+        key = cache.get_key(self.data_file, self.data_loader, self.features)
+        assert cache.load(key) is None
+
+        ids = ['0', '1']
+        features = np.array([[1.0, 2.0], [3.0, 4.0]], dtype=np.float32)
+        cache.save(key, ids, features)
+
+        cached_ids, cached_features = cache.load(key)
+        assert list(cached_ids) == ids
+        assert isinstance(cached_features, np.memmap)
+        assert cached_features.dtype == np.float32
+        assert np.array_equal(cached_features, features)
+
+    def test_key(self):
+
+        cache = FeatureCache(self.cache_dir)
+        key = cache.get_key(self.data_file, self.data_loader, self.features)
+
+        # The key changes with the loader params, the features, and the files
+        assert key != cache.get_key(self.data_file,
+                                    {'name': 'FeatureVector',
+                                     'params': {'dtype': 'float64'}},
+                                    self.features)
+        assert key != cache.get_key(self.data_file, self.data_loader, {})
+        with open(self.data_file, 'a') as f:
+            f.write('2,5.0,6.0\n')
+        assert key != cache.get_key(self.data_file, self.data_loader,
+                                    self.features)
+
+    def test_evict(self):
+
+        features = np.zeros((256, 256), dtype=np.float64)
+        cache = FeatureCache(self.cache_dir, max_size_mb=1.2)
+
+        cache.save('a', ['0'] * 256, features)
+        cache.save('b', ['0'] * 256, features)
+        assert cache.load('a') is not None
+        assert cache.load('b') is not None
+
+        # Entry `a` was used before `b`, so it is removed first
+        os.utime(os.path.join(self.cache_dir, 'a'),
+                 (time.time() - 10, time.time() - 10))
+        cache.save('c', ['0'] * 256, features)
+        assert cache.load('a') is None
+        assert cache.load('b') is not None
+        assert cache.load('c') is not None
+
+
+class TestCodeHash(TestCase):
+
+    def test_module_changes(self):
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            module_file = os.path.join(tmp_dir, 'dora_test_alg.py')
+            with open(module_file, 'w') as f:
+                f.write('SCORE = 1\n')
+
+            sys.path.insert(0, tmp_dir)
+            try:
+                importlib.import_module('dora_test_alg')
+                code_hash = get_code_hash(['dora_test_alg'])
+
+                # The hash changes with the code of the modules outside of
+                # the package, and unknown modules are skipped
+                assert code_hash == get_code_hash(['dora_test_alg'])
+                assert code_hash != get_code_hash()
+                assert get_code_hash() == get_code_hash(['no_such_module'])
+                with open(module_file, 'w') as f:
+                    f.write('SCORE = 2\n')
+                assert code_hash != get_code_hash(['dora_test_alg'])
+            finally:
+                sys.path.remove(tmp_dir)
+                sys.modules.pop('dora_test_alg', None)
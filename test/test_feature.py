@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# Tests for the feature extraction module.
+
+from unittest import TestCase
+import numpy as np
+from dora_exp_pipeline.dora_data_loader import get_data_loader_by_name
+from dora_exp_pipeline.dora_feature import FeatureExtractor
+from dora_exp_pipeline.dora_feature import register_extractor
+from dora_exp_pipeline.dora_feature import extract_feature
+from dora_exp_pipeline.dora_feature import z_score_normalize
+from dora_exp_pipeline.dora_feature import get_feature_extractor_by_name
+
+
+# Feature extractor that doesn't know its output width up front
+class SquaredValuesExtractor(FeatureExtractor):
+    def __init__(self):
+        super(SquaredValuesExtractor, self).__init__('test_squared_values')
+
+    def extract(self, data_cube, **kwargs):
+        return np.asarray(data_cube, dtype=np.float64) ** 2
+
+
+register_extractor(SquaredValuesExtractor())
+
+
+class TestExtractFeature(TestCase):
+
+    def setUp(self):
+
+        random_state = np.random.RandomState(1234)
+        self.data = random_state.randint(0, 255, size=(50, 6)).astype(np.uint8)
+
+    def test_multiple_extractors(self):
+
+        data_dict = {'id': list(range(50)), 'data': self.data}
+        features_dict = {'raw_values': {}, 'test_squared_values': {}}
+        correct_features = np.concatenate(
+            (self.data, self.data.astype(np.float64) ** 2), axis=1)
+
+        for n_jobs in [1, 2]:
+            features = extract_feature(data_dict, features_dict,
+                                       progress_bar=False, n_jobs=n_jobs)
+            assert features.dtype == np.float64
+            assert np.array_equal(features, correct_features)
+
+        features = extract_feature(data_dict, features_dict,
+                                   progress_bar=False, dtype='float32')
+        assert features.dtype == np.float32
+        assert np.array_equal(features, correct_features.astype(np.float32))
+
+    def test_single_extractor(self):
+
+        data_dict = {'id': list(range(50)), 'data': self.data}
+
+        # Integer data is converted to float64 by default
+        features = extract_feature(data_dict, {'raw_values': {}},
+                                   progress_bar=False)
+        assert features.dtype == np.float64
+        assert np.array_equal(features, self.data)
+
+        # The output of a single extractor is not copied if it is already
+        # float64
+        data_dict['data'] = features
+        assert extract_feature(data_dict, {'raw_values': {}},
+                               progress_bar=False) is features
+
+    def test_single_extractor_dtype(self):
+
+        data_dict = {'id': list(range(50)), 'data': self.data}
+
+        # The features are written into a float32 matrix without a float64
+        # intermediate
+        features = extract_feature(data_dict, {'raw_values': {}},
+                                   progress_bar=False, dtype='float32')
+        assert features.dtype == np.float32
+        assert np.array_equal(features, self.data)
+
+        # Data that is already float32 is not copied
+        data_dict['data'] = features
+        assert extract_feature(data_dict, {'raw_values': {}},
+                               progress_bar=False,
+                               dtype='float32') is features
+
+    def test_flattened_pixel_values_into(self):
+
+        data_dict = get_data_loader_by_name('image').load(
+            'sample_data/planetary_rover/png/images')
+        extractor = get_feature_extractor_by_name('flattened_pixel_values')
+        params = {'width': 10, 'height': 12, 'normalize_pixels': True}
+
+        features = extractor.extract(data_dict['data'], **params)
+        assert extractor.get_output_width(data_dict['data'],
+                                          **params) == 120
+
+        out = np.empty((len(data_dict['id']), 120))
+        extractor.extract_into(data_dict['data'], out, **params)
+        assert np.array_equal(out, features)
+
+
+class TestZScoreNormalize(TestCase):
+
+    def setUp(self):
+
+        random_state = np.random.RandomState(1234)
+        self.dtf = random_state.normal(3, 2, size=(103, 5))
+        self.dts = random_state.normal(1, 4, size=(57, 5))
+
+    def test_chunked(self):
+
+        correct_dtf, correct_dts = z_score_normalize(self.dtf, self.dts)
+
+        dtf = self.dtf.copy()
+        dts = self.dts.copy()
+        ret_dtf, ret_dts = z_score_normalize(dtf, dts, chunk_size=10)
+
+        # Float arrays are normalized in place
+        assert ret_dtf is dtf and ret_dts is dts
+        assert np.allclose(ret_dtf, correct_dtf)
+        assert np.allclose(ret_dts, correct_dts)
+
+        # If dtf and dts are the same array, it is only normalized once
+        ret_dtf, ret_dts = z_score_normalize(self.dtf, self.dtf,
+                                             chunk_size=10)
+        assert ret_dtf is ret_dts
+        assert np.allclose(ret_dtf, correct_dtf)
+
+    def test_chunked_copy(self):
+
+        # Read-only and integer arrays are normalized into a new array
+        dtf = np.round(self.dtf * 10).astype(np.int32)
+        dts = self.dts.copy()
+        dts.flags['WRITEABLE'] = False
+        correct_dtf, correct_dts = z_score_normalize(dtf, dts)
+
+        ret_dtf, ret_dts = z_score_normalize(dtf, dts, chunk_size=7)
+        assert ret_dtf is not dtf and ret_dts is not dts
+        assert np.array_equal(dts, self.dts)
+        assert np.allclose(ret_dtf, correct_dtf)
+        assert np.allclose(ret_dts, correct_dts)
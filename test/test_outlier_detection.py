@@ -0,0 +1,356 @@
+#!/usr/bin/env python
+# Tests for the outlier detection base class.
+
+import os
+import tempfile
+from unittest import TestCase
+from unittest import skipIf
+import numpy as np
+from dora_exp_pipeline.dora_results_organization import ResultsOrganization
+from dora_exp_pipeline.dora_results_organization import register_org_method
+from dora_exp_pipeline.outlier_detection import OutlierDetection
+from dora_exp_pipeline.outlier_detection import prepare_features
+from dora_exp_pipeline.outlier_detection import rank_scores
+from dora_exp_pipeline.outlier_detection import rank_score_chunks
+from dora_exp_pipeline.outlier_detection import load_model
+from dora_exp_pipeline.outlier_detection import save_model
+from dora_exp_pipeline.outlier_detection import MODEL_FILE
+from dora_exp_pipeline.outlier_detection import SCORES_FILE
+from dora_exp_pipeline.rx_outlier_detection import RXOutlierDetection
+from dora_exp_pipeline.pca_outlier_detection import PCAOutlierDetection
+from dora_exp_pipeline.iforest_outlier_detection import \
+    IForestOutlierDetection
+try:
+    from dora_exp_pipeline.pae_outlier_detection import PAEOutlierDetection
+except ImportError:
+    PAEOutlierDetection = None
+
+
+# Outlier detection algorithm that modifies its input
+class MutatingOutlierDetection(OutlierDetection):
+    def __init__(self):
+        super(MutatingOutlierDetection, self).__init__('test_mutating')
+
+    def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
+                       top_n, seed):
+        data_to_score -= np.mean(data_to_score, axis=0)
+
+
+# Outlier detection algorithm that counts how many times it is run
+class CountingOutlierDetection(OutlierDetection):
+    def __init__(self):
+        super(CountingOutlierDetection, self).__init__('test_counting')
+        self.n_runs = 0
+
+    def _rank_internal(self, data_to_fit, data_to_score, data_to_score_ids,
+                       top_n, seed, scale):
+        self.n_runs += 1
+        return rank_scores(scale * data_to_score[:, 0], data_to_score_ids,
+                           top_n)
+
+
+# Results organization method that records the parameters it is run with
+class RecordingResults(ResultsOrganization):
+    def __init__(self):
+        super(RecordingResults, self).__init__('test_recording')
+        self.runs = []
+
+    def _run(self, data_ids, dts_scores, dts_sels, data_to_score,
+             outlier_alg_name, out_dir, logger, seed, top_n, value):
+        self.runs.append((value, list(data_ids), top_n))
+
+
+recording_results = RecordingResults()
+register_org_method(recording_results)
+
+
+class TestPrepareFeatures(TestCase):
+
+    def setUp(self):
+
+        random_state = np.random.RandomState(1234)
+        self.data = random_state.normal(size=(20, 3))
+
+    def test_convert_once(self):
+
+        dtf, dts = prepare_features(self.data, self.data)
+
+        # The same array is converted once, and the view is read-only
+        assert dtf is dts
+        assert dts.dtype == np.float32
+        assert not dts.flags['WRITEABLE']
+        assert self.data.flags['WRITEABLE']
+
+        # Features that were already prepared are not copied again
+        dtf_2, dts_2 = prepare_features(dtf, dts)
+        assert dtf_2 is dtf and dts_2 is dts
+
+        dtf, dts = prepare_features(None, self.data, 'float64')
+        assert dtf is None
+        assert np.shares_memory(dts, self.data)
+
+    def test_mutating_algorithm(self):
+
+        alg = MutatingOutlierDetection()
+        with self.assertRaises(ValueError):
+            alg.run(None, self.data, list(range(20)), tempfile.gettempdir(),
+                    {}, None, None, 1234)
+
+
+class TestRankScores(TestCase):
+
+    def setUp(self):
+
+        random_state = np.random.RandomState(1234)
+        self.scores = random_state.normal(size=50)
+        self.ids = [f'item{i}' for i in range(50)]
+
+    def test_rank_scores(self):
+
+        # Reference ranking with a full sort
+        correct_ind = np.argsort(self.scores)[::-1]
+
+        for top_n in [1, 10, 49, 50, None]:
+            results = rank_scores(self.scores, self.ids, top_n)
+            n = 50 if top_n is None else top_n
+            assert np.array_equal(results['sel_ind'], correct_ind[:n])
+            assert np.array_equal(results['scores'],
+                                  self.scores[correct_ind[:n]])
+            assert list(results['dts_ids']) == \
+                [self.ids[i] for i in correct_ind[:n]]
+
+        results = rank_scores(self.scores, np.array(self.ids), 10,
+                              descending=False)
+        correct_ind = np.argsort(self.scores)[:10]
+        assert np.array_equal(results['sel_ind'], correct_ind)
+        assert np.array_equal(results['dts_ids'],
+                              np.array(self.ids)[correct_ind])
+
+    def test_ties(self):
+
+        # Tied scores are ranked in index order, for any top_n
+        scores = np.array([1.0, 3.0, 3.0, 2.0, 3.0, 0.0, 1.0])
+        for top_n, correct_ind in [(None, [1, 2, 4, 3, 0, 6, 5]),
+                                   (4, [1, 2, 4, 3]), (2, [1, 2])]:
+            results = rank_scores(scores, list(range(7)), top_n)
+            assert list(results['sel_ind']) == correct_ind
+
+        for top_n, correct_ind in [(None, [5, 0, 6, 3, 1, 2, 4]),
+                                   (2, [5, 0]), (1, [5])]:
+            results = rank_scores(scores, list(range(7)), top_n,
+                                  descending=False)
+            assert list(results['sel_ind']) == correct_ind
+
+        # Partial and chunked rankings are the first top_n items of the full
+        # ranking
+        scores = np.random.RandomState(1234).randint(0, 5, size=200)
+        for descending in [True, False]:
+            full_ind = rank_scores(scores, list(range(200)), None,
+                                   descending)['sel_ind']
+            for top_n in [1, 7, 50, 199]:
+                results = rank_scores(scores, list(range(200)), top_n,
+                                      descending)
+                assert np.array_equal(results['sel_ind'], full_ind[:top_n])
+
+                chunks = [scores[start:start + 30]
+                          for start in range(0, 200, 30)]
+                results = rank_score_chunks(chunks, list(range(200)), top_n,
+                                            descending)
+                assert np.array_equal(results['sel_ind'], full_ind[:top_n])
+
+
+class TestSavedRanking(TestCase):
+
+    def setUp(self):
+
+        self.out_dir = tempfile.TemporaryDirectory()
+        self.data = np.random.RandomState(1234).normal(size=(20, 3))
+        self.ids = [f'item{i}' for i in range(20)]
+        self.alg = CountingOutlierDetection()
+        recording_results.runs = []
+
+    def tearDown(self):
+
+        self.out_dir.cleanup()
+
+    def run_alg(self, results_dict, key='key', force=False, data=True):
+
+        dts = self.data if data else None
+        dts_ids = self.ids if data else None
+        self.alg.run(None, dts, dts_ids, self.out_dir.name, results_dict, 5,
+                     None, 1234, None, key, force, scale=2)
+
+    def test_reuse_ranking(self):
+
+        self.run_alg({'test_recording': {'value': 1}})
+        assert self.alg.n_runs == 1
+        correct_ids = [self.ids[i] for i in
+                       np.argsort(self.data[:, 0])[::-1][:5]]
+        assert recording_results.runs == [(1, correct_ids, 5)]
+
+        # Nothing is run again if nothing changed, even without the data
+        self.run_alg({'test_recording': {'value': 1}}, data=False)
+        assert self.alg.n_runs == 1
+        assert len(recording_results.runs) == 1
+
+        # Only the results organization method is run again if its
+        # parameters changed
+        self.run_alg({'test_recording': {'value': 2}}, data=False)
+        assert self.alg.n_runs == 1
+        assert recording_results.runs[-1] == (2, correct_ids, 5)
+
+        # Everything is run again with a different key, or if forced
+        self.run_alg({'test_recording': {'value': 2}}, key='other')
+        assert self.alg.n_runs == 2
+        assert len(recording_results.runs) == 3
+        self.run_alg({'test_recording': {'value': 2}}, key='other',
+                     force=True)
+        assert self.alg.n_runs == 3
+        assert len(recording_results.runs) == 4
+
+
+class TestSavedModel(TestCase):
+
+    def setUp(self):
+
+        self.out_dir = tempfile.TemporaryDirectory()
+        random_state = np.random.RandomState(1234)
+        self.dtf = random_state.normal(size=(50, 4))
+        self.dts = random_state.normal(size=(30, 4))
+        self.ids = [f'item{i}' for i in range(30)]
+
+    def tearDown(self):
+
+        self.out_dir.cleanup()
+
+    def test_score_saved_model(self):
+
+        for alg, params in [(RXOutlierDetection(), {}),
+                            (PCAOutlierDetection(), {'k': 2}),
+                            (IForestOutlierDetection(),
+                             {'n_trees': 3, 'fit_single_trees': True})]:
+            alg.run(self.dtf, self.dts, self.ids, self.out_dir.name, {},
+                    None, None, 1234, model_info={'top_n': None}, **params)
+            model_file = os.path.join(
+                alg.get_sub_dir(self.out_dir.name, params), MODEL_FILE)
+            model_dict = load_model(model_file)
+            assert model_dict['alg_name'] == alg._ranking_alg_name
+            assert model_dict['alg_params'] == params
+
+            # Scoring new data with the saved model gives the same ranking
+            # as fitting the model again
+            correct_results = alg._rank_internal(
+                self.dtf.astype(np.float32), self.dts.astype(np.float32),
+                self.ids, 10, 1234, **params)
+            _, dts = prepare_features(None, self.dts)
+            scores = alg.score(model_dict['model'], dts)
+            results = rank_scores(scores, self.ids, 10, alg.rank_descending)
+            for key in ['scores', 'sel_ind', 'dts_ids']:
+                assert np.array_equal(results[key], correct_results[key])
+
+    @skipIf(PAEOutlierDetection is None, 'tensorflow is not installed')
+    def test_pae_saved_model(self):
+
+        alg = PAEOutlierDetection()
+        assert alg.can_save_model()
+
+        # The Keras models are rebuilt from their weights when the model is
+        # loaded, and they give the same scores
+        dtf, dts = prepare_features(self.dtf, self.dts)
+        model_file = os.path.join(self.out_dir.name, MODEL_FILE)
+        for use_flow in [True, False]:
+            _, model = alg._fit_and_rank(dtf, dts, self.ids, 10, 1234,
+                                         latent_dim=2, max_epochs=2,
+                                         use_flow=use_flow)
+            save_model(model_file, model, {'alg_name': 'pae'})
+            loaded_model = load_model(model_file)['model']
+            assert (loaded_model.flow is None) == (not use_flow)
+            assert np.array_equal(alg.score(loaded_model, dts),
+                                  alg.score(model, dts))
+
+    def test_unsupported_algorithm(self):
+
+        alg = MutatingOutlierDetection()
+        assert not alg.can_save_model()
+        assert RXOutlierDetection().can_save_model()
+        with self.assertRaises(RuntimeError):
+            alg.score(None, self.dts)
+
+
+class TestScoreChunks(TestCase):
+
+    def setUp(self):
+
+        self.out_dir = tempfile.TemporaryDirectory()
+        random_state = np.random.RandomState(1234)
+        self.dtf = random_state.normal(size=(50, 4)).astype(np.float32)
+        self.dts = random_state.normal(size=(37, 4)).astype(np.float32)
+        self.ids = np.array([f'item{i}' for i in range(37)])
+
+    def tearDown(self):
+
+        self.out_dir.cleanup()
+
+    def test_rank_score_chunks(self):
+
+        scores = np.random.RandomState(5).normal(size=37)
+        for descending in [True, False]:
+            for top_n in [0, 1, 10, 37, None]:
+                correct_results = rank_scores(scores, self.ids, top_n,
+                                              descending)
+                for chunk_size in [1, 5, 37]:
+                    chunks = [scores[i:i + chunk_size]
+                              for i in range(0, 37, chunk_size)]
+                    scores_out = np.zeros(37)
+                    results = rank_score_chunks(chunks, self.ids, top_n,
+                                                descending, scores_out)
+                    for key in ['scores', 'sel_ind', 'dts_ids']:
+                        assert np.array_equal(results[key],
+                                              correct_results[key])
+                    assert np.array_equal(scores_out, scores)
+
+    def test_chunked_run(self):
+
+        for alg, params in [(RXOutlierDetection(), {}),
+                            (PCAOutlierDetection(), {'k': 2}),
+                            (IForestOutlierDetection(),
+                             {'n_trees': 3, 'fit_single_trees': True})]:
+            assert alg.can_score_chunks(self.dts)
+            model = alg._fit(self.dtf, 1234, **params)
+            correct_scores = alg.score(model, self.dts)
+            correct_results = alg._rank_internal(self.dtf, self.dts,
+                                                 self.ids, 10, 1234, **params)
+            for chunk_size in [1, 8, 100]:
+                results, _ = alg._fit_and_rank(self.dtf, self.dts, self.ids,
+                                               10, 1234,
+                                               score_chunk_size=chunk_size,
+                                               **params)
+
+                assert np.array_equal(results['scores'],
+                                      correct_results['scores'])
+                assert np.array_equal(results['sel_ind'],
+                                      correct_results['sel_ind'])
+                assert np.array_equal(correct_scores[results['sel_ind']],
+                                      results['scores'])
+                assert np.array_equal(results['dts_ids'],
+                                      self.ids[results['sel_ind']])
+
+            # The scores of all the items are saved in the sub directory
+            alg.run(self.dtf, self.dts, self.ids, self.out_dir.name, {}, 10,
+                    None, 1234, score_chunk_size=8, save_all_scores=True,
+                    **params)
+            scores = np.load(os.path.join(
+                alg.get_sub_dir(self.out_dir.name, params), SCORES_FILE))
+            assert np.array_equal(scores, correct_scores)
+
+        # Algorithms that can't score data in chunks run on all the data
+        alg = CountingOutlierDetection()
+        assert not alg.can_score_chunks()
+        with self.assertWarns(UserWarning):
+            alg.run(self.dtf, self.dts, self.ids, self.out_dir.name, {}, 10,
+                    None, 1234, score_chunk_size=8, scale=1)
+        assert alg.n_runs == 1
+
+        # Lists of image files can't be scored in chunks
+        assert not RXOutlierDetection().can_score_chunks(
+            np.array([['a.png'], ['b.png']]))